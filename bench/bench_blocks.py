@@ -0,0 +1,52 @@
+#!/usr/bin/env python3.7
+
+# microbenchmarks for handing out and giving back the blocks of large pieces
+# run from the root tree: PYTHONPATH=. python bench/bench_blocks.py
+import timeit
+
+from bitsnpieces.client import Piece
+
+
+class StubPieceManager(object):
+    torrent = None
+
+
+class StubPeer(object):
+    def __init__(self):
+        self.pieces_downloading = set()
+
+
+def allocate_all(num_blocks, num_peers):
+    """requests every block of a piece, round robin over the peers"""
+
+    piece = Piece(StubPieceManager(), 0, num_blocks * Piece.BLOCK_LENGTH)
+    peers = [StubPeer() for _ in range(num_peers)]
+    i = 0
+    while piece.get_next_request(peers[i % num_peers]) is not None:
+        i += 1
+    return piece, peers
+
+
+def churn(num_blocks, num_peers):
+    """requests every block, drops half the peers and requests their blocks again"""
+
+    piece, peers = allocate_all(num_blocks, num_peers)
+    for peer in peers[:num_peers // 2]:
+        piece.remove_peer(peer)
+    while piece.get_next_request(peers[-1]) is not None:
+        pass
+
+
+def main():
+    for num_blocks in (16, 256, 1024, 4096):
+        for num_peers in (1, 50):
+            for bench in (allocate_all, churn):
+                number = max(1, 20000 // num_blocks)
+                total = timeit.timeit(lambda: bench(num_blocks, num_peers), number=number)
+                per_block = total / number / num_blocks * 1e6
+                print(f"{bench.__name__:>12} blocks: {num_blocks:>5} peers: {num_peers:>3} "
+                    f"{per_block:0.3f} us/block")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3.7
+
+# measures the memory used by piece state on large synthetic torrents
+# run from the root tree: PYTHONPATH=. python bench/bench_memory.py
+import gc
+import tempfile
+import tracemalloc
+from collections import OrderedDict
+
+from bitsnpieces.torrent import Torrent
+from bitsnpieces.client import PieceManager
+
+
+GiB = 2 ** 30
+
+
+def make_torrent(total_length, piece_length):
+    """builds a single file torrent with dummy piece hashes"""
+
+    num_pieces = -(-total_length // piece_length)
+    info = OrderedDict([(b'length', total_length), (b'name', b'synthetic.bin'),
+        (b'piece length', piece_length), (b'pieces', bytes(20 * num_pieces))])
+    return Torrent(OrderedDict([(b'announce', b'http://localhost/announce'), (b'info', info)]))
+
+
+def measure(total_length, piece_length):
+    """returns the bytes allocated by creating a piece manager for the torrent"""
+
+    torrent = make_torrent(total_length, piece_length)
+    with tempfile.TemporaryDirectory() as download_directory:
+        gc.collect()
+        tracemalloc.start()
+        piece_manager = PieceManager(torrent, download_directory)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del piece_manager
+    return size
+
+
+def main():
+    for total_length, piece_length in ((1 * GiB, 2 ** 18), (16 * GiB, 2 ** 20), (64 * GiB, 2 ** 20),
+            (1024 * GiB, 2 ** 22)):
+        size = measure(total_length, piece_length)
+        print(f"torrent: {total_length // GiB:>5} GiB piece length: {piece_length // 1024:>5} KiB "
+            f"piece state: {size / 2 ** 20:0.2f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import time
+import random
+import asyncio
+
+
+class Announcer(object):
+    """
+    Schedules a torrent client's announces: waits the interval the trackers ask for, announces
+    early (but not before the minimum interval) when the client is short of peers or finished
+    downloading, and backs off exponentially from trackers that do not answer.
+    If the client has a DHT node the torrent is announced to the DHT as well.
+    """
+
+    BACKOFF_BASE = 15           # in seconds
+    BACKOFF_MAX = 1800          # in seconds
+    DEFAULT_INTERVAL = 1800     # in seconds, if the tracker does not send one
+    MIN_INTERVAL = 120          # in seconds, between early announces if the tracker does not send one
+    LOW_PEERS = 10              # announce early when fewer peers than this are connected
+    STOP_TIMEOUT = 5            # in seconds, for the stopped announce
+    DHT_INTERVAL = 900          # in seconds, between DHT announces
+    DHT_MIN_INTERVAL = 60       # in seconds, between DHT announces when short of peers
+
+    def __init__(self, client):
+        # parameters
+        self.client = client
+        self.tracker = client.tracker
+
+        self.num_failures = 0
+        self.last_response = None
+
+        # woken up when the number of peers drops or the download completes
+        self.wakeup = None
+        self.is_running = False
+        self.task = None
+        self.dht_task = None
+
+    def get_backoff(self, failures: int) -> float:
+        """
+        Returns the time to wait before announcing again after a number of consecutive failures,
+        jittered so that clients that failed together do not retry together
+        """
+
+        backoff = min(Announcer.BACKOFF_MAX, Announcer.BACKOFF_BASE * 2 ** (failures - 1))
+        return backoff * random.uniform(0.5, 1.5)
+
+    def get_numwant(self) -> int:
+        """
+        Returns the number of peers to ask for: enough to fill the free peer slots, none if the
+        peer database already has that many addresses we are not connected to
+        """
+
+        free_slots = self.client.MAX_PEERS - len(self.client.peers)
+        known = len(self.client.peer_db) - len(self.client.peers)
+        return max(0, free_slots - max(0, known))
+
+    def is_short_of_peers(self) -> bool:
+        return len(self.client.peers) < Announcer.LOW_PEERS
+
+    def wake(self):
+        """
+        Called when the client might want to announce early
+        """
+
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def wait(self, interval: float, min_interval: float):
+        """
+        Waits for the interval, or only for the minimum interval if the download completes
+        or the client is short of peers
+        """
+
+        start = time.monotonic()
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= interval:
+                return
+
+            if self.client.piece_manager.is_complete or self.is_short_of_peers():
+                if elapsed >= min_interval:
+                    return
+                timeout = min_interval - elapsed
+            else:
+                timeout = interval - elapsed
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def sleep_unless_complete(self, delay: float):
+        """
+        Sleeps for the delay, or until the download completes
+        """
+
+        deadline = time.monotonic() + delay
+        while not self.client.piece_manager.is_complete:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def announce(self, event: str):
+        piece_manager = self.client.piece_manager
+        return await self.tracker.announce(self.client.peer_id, self.client.port, piece_manager.uploaded,
+            piece_manager.downloaded, event, numwant=self.get_numwant(), left=piece_manager.left,
+            on_response=lambda response: self.client.add_peers(response.peers or []))
+
+    async def run(self, event: str='started'):
+        """
+        Announces until the download is complete and the tracker was told so
+        """
+
+        self.is_running = True
+        try:
+            await self.announce_until_complete(event)
+        finally:
+            self.is_running = False
+
+    async def announce_until_complete(self, event: str):
+        self.wakeup = asyncio.Event()
+        if self.client.dht is not None and self.dht_task is None:
+            self.dht_task = asyncio.create_task(self.run_dht())
+
+        while True:
+            if event == "" and self.client.piece_manager.is_complete:
+                event = 'completed'
+
+            try:
+                response = await self.announce(event)
+            except ConnectionError:
+                # with the download complete there is nothing left to get from the trackers
+                if self.client.piece_manager.is_complete:
+                    return
+                self.num_failures += 1
+                backoff = self.get_backoff(self.num_failures)
+                print(f"Tracker announce failed, retrying in {backoff:0.0f} seconds")
+                await self.sleep_unless_complete(backoff)
+                continue
+
+            self.num_failures = 0
+            self.last_response = response
+            interval = response.interval or Announcer.DEFAULT_INTERVAL
+            min_interval = min(interval, response.min_interval or Announcer.MIN_INTERVAL)
+            print(f"Announce to tracker {self.tracker.url}, next request in {interval} seconds")
+
+            # the download may have become incomplete again during the announce
+            if event == 'completed' and self.client.piece_manager.is_complete:
+                return
+            if event == 'started' and self.client.piece_manager.is_complete:
+                # nothing was downloaded in this session, there is nothing to report
+                return
+            event = ""
+            await self.wait(interval, min_interval)
+
+    async def run_dht(self):
+        """
+        Announces to the DHT and adds the peers found on the way, more often while short of peers
+        """
+
+        info_hash = self.client.info_hash
+        while True:
+            try:
+                peers = await self.client.dht.announce_peer(info_hash, self.client.port)
+            except (ConnectionError, OSError) as e:
+                print(f"DHT announce failed: {e!r}")
+                peers = []
+            if peers:
+                await self.client.add_peers(peers, source="dht")
+
+            if self.is_short_of_peers():
+                await asyncio.sleep(Announcer.DHT_MIN_INTERVAL)
+            else:
+                await asyncio.sleep(Announcer.DHT_INTERVAL)
+
+    def start(self):
+        """
+        Starts announcing in a background task
+        """
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def resume(self):
+        """
+        Called when a complete download became incomplete again, announces in a background task
+        until it is complete once more, unless the announces never stopped
+        """
+
+        if not self.is_running:
+            self.task = asyncio.create_task(self.run(""))
+
+    async def stop(self):
+        """
+        Stops announcing and tells the trackers we are leaving, unless the first announce never succeeded
+        """
+
+        for task in (self.task, self.dht_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self.task = None
+        self.dht_task = None
+
+        if self.last_response is not None:
+            try:
+                await asyncio.wait_for(self.tracker.announce(self.client.peer_id, self.client.port,
+                    self.client.piece_manager.uploaded, self.client.piece_manager.downloaded, 'stopped',
+                    numwant=0, left=self.client.piece_manager.left), Announcer.STOP_TIMEOUT)
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                pass
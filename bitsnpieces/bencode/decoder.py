@@ -16,13 +16,13 @@ class DecodeError(Exception):
 def is_digit(byte: int) -> bool:
     return byte >= ord('0') and byte <= ord('9')
 
-def decode_int(bs: bytes, retlen: bool=False) -> int:
-    """decodes a B-encoded integer"""
+def decode_int(bs: bytes, retlen: bool=False, start: int=0) -> int:
+    """decodes a B-encoded integer starting at index start of the byte string"""
     
-    if bs[0] != TOK_INT:
-        raise DecodeError(f"invalid literal '{chr(bs[0])}', int must start with 'i'")
+    if bs[start] != TOK_INT:
+        raise DecodeError(f"invalid literal '{chr(bs[start])}', int must start with 'i'")
 
-    end = 1
+    end = start + 1
     try:
         while (bs[end] == ord('-') or is_digit(bs[end])):
             end += 1
@@ -33,70 +33,73 @@ def decode_int(bs: bytes, retlen: bool=False) -> int:
         raise DecodeError(f"invalid literal '{chr(bs[end])}', int must end with 'e'")
     
     # validity checking
-    if end == 1:
+    if end == start + 1:
         # empty int invalid
         raise DecodeError(f"int cannot be an empty byte string")
-    elif end > 2:
-        if bs[1] == ord('0'):
+    elif end > start + 2:
+        if bs[start + 1] == ord('0'):
             # leading zeros invalid
             raise DecodeError(f"int cannot have leading zeros")
-        elif bs[1:3] == b'-0':
+        elif bs[start + 1:start + 3] == b'-0':
             # negative zero invalid
             raise DecodeError(f"int cannot start with '-0'")
     
     # uncaught validity errors
     try:
-        decoded = int(bs[1:end])
+        decoded = int(bs[start + 1:end])
     except ValueError:
-        raise DecodeError(f"invalid int {bs.decode('ascii')}")
+        raise DecodeError(f"invalid int {bs[start:end + 1].decode('ascii')}")
 
     if retlen:
         # length of original B-encoded byte string
-        bencode_len = end + 1
+        bencode_len = end + 1 - start
         return decoded, bencode_len
     
     return decoded
 
-def decode_str(bs: bytes, retlen: bool=False) -> bytes:
-    """decodes a B-encoded string"""
+def decode_str(bs: bytes, retlen: bool=False, start: int=0) -> bytes:
+    """decodes a B-encoded string starting at index start of the byte string"""
 
-    if not is_digit(bs[0]):
-        raise DecodeError(f"invalid literal '{chr(bs[0])}', string must start with an int length")
-    len_end = 1
-    while is_digit(bs[len_end]):
-        len_end += 1
+    if not is_digit(bs[start]):
+        raise DecodeError(f"invalid literal '{chr(bs[start])}', string must start with an int length")
+    len_end = start + 1
+    try:
+        while is_digit(bs[len_end]):
+            len_end += 1
+    except IndexError:
+        raise DecodeError("byte string too short to decode")
     if bs[len_end] != TOK_STR_SEP:
         raise DecodeError(f"invalid literal '{chr(bs[len_end])}', string length must end with ':'")
     
-    length = int(bs[0:len_end])
+    length = int(bs[start:len_end])
 
-    start = len_end + 1
-    end = start + length
+    str_start = len_end + 1
+    end = str_start + length
 
     if end > len(bs):
         # string length discrepancy
         raise DecodeError(f"string ends before specified length")
 
-    decoded = bs[start:end]
+    decoded = bs[str_start:end]
 
     if retlen:
         # length of original B-encoded byte string
-        bencode_len = end
+        bencode_len = end - start
         return decoded, bencode_len
 
     return decoded
 
-def decode_list(bs: bytes, retlen: bool=False) -> list:
-    """decodes a B-encoded list"""
+def decode_list(bs: bytes, retlen: bool=False, start: int=0) -> list:
+    """decodes a B-encoded list starting at index start of the byte string"""
 
-    if bs[0] != TOK_LIST:
-        raise DecodeError(f"invalid literal '{chr(bs[0])}', list must start with 'l'")
-    end = 1
+    if bs[start] != TOK_LIST:
+        raise DecodeError(f"invalid literal '{chr(bs[start])}', list must start with 'l'")
+    end = start + 1
     decoded = []
     
     try:
         while bs[end] != TOK_END:
-            decoded_val, bencode_len = decode(bs[end:], retlen=True)
+            decoded_val, bencode_len = decode(bs, retlen=True, start=end)
             decoded.append(decoded_val)
             end += bencode_len
             if end >= len(bs):
@@ -106,31 +109,31 @@ def decode_list(bs: bytes, retlen: bool=False) -> list:
 
     if retlen:
         # length of original B-encoded byte string
-        bencode_len = end + 1
+        bencode_len = end + 1 - start
         return decoded, bencode_len
 
     return decoded
 
-def decode_dict(bs: bytes, retlen: bool=False) -> OrderedDict:
-    """decodes a B-encoded dictionary to and OrderedDict"""
+def decode_dict(bs: bytes, retlen: bool=False, start: int=0) -> OrderedDict:
+    """decodes a B-encoded dictionary starting at index start of the byte string to an OrderedDict"""
     
-    if bs[0] != TOK_DICT:
-        raise DecodeError(f"invalid literal '{chr(bs[0])}', dictionary must start with 'd'")
-    end = 1
+    if bs[start] != TOK_DICT:
+        raise DecodeError(f"invalid literal '{chr(bs[start])}', dictionary must start with 'd'")
+    end = start + 1
     decoded = OrderedDict()
     
     try:
         while bs[end] != TOK_END:
             try:
-                key, bencode_key_len = decode_str(bs[end:], retlen=True)
+                key, bencode_key_len = decode_str(bs, retlen=True, start=end)
             except DecodeError:
                 raise DecodeError(f"dictionary key must be a valid B-encoded string")
             if key in decoded:
-                raise DecodeError(f"duplicate key '{key.decode('ascii')}' in dictionary")
+                raise DecodeError(f"duplicate key '{key.decode('ascii', 'replace')}' in dictionary")
             end += bencode_key_len
             if bs[end] == TOK_END:
                 raise DecodeError(f"missing dictionary value, dictionary ends after key '{key}'")
-            value, bencode_val_len = decode(bs[end:], retlen=True)
+            value, bencode_val_len = decode(bs, retlen=True, start=end)
             decoded[key] = value
             end += bencode_val_len
             if end >= len(bs):
@@ -140,21 +143,24 @@ def decode_dict(bs: bytes, retlen: bool=False) -> OrderedDict:
 
     if retlen:
         # length of original B-encoded byte string
-        bencode_len = end + 1
+        bencode_len = end + 1 - start
         return decoded, bencode_len
 
     return decoded
 
-def decode(bs: bytes, retlen: bool=False):
-    """decodes a B-encoded byte string to a python object"""
-
-    if bs[0] == TOK_INT:
-        return decode_int(bs, retlen)
-    elif is_digit(bs[0]):
-        return decode_str(bs, retlen)
-    elif bs[0] == TOK_LIST:
-        return decode_list(bs, retlen)
-    elif bs[0] == TOK_DICT:
-        return decode_dict(bs, retlen)
+def decode(bs: bytes, retlen: bool=False, start: int=0):
+    """
+    decodes a B-encoded byte string to a python object. Nested values are decoded in place by
+    their index in the byte string, so decoding takes time linear in its length.
+    """
+
+    if bs[start] == TOK_INT:
+        return decode_int(bs, retlen, start)
+    elif is_digit(bs[start]):
+        return decode_str(bs, retlen, start)
+    elif bs[start] == TOK_LIST:
+        return decode_list(bs, retlen, start)
+    elif bs[start] == TOK_DICT:
+        return decode_dict(bs, retlen, start)
     else:
-        raise DecodeError(f"invalid literal '{chr(bs[0])}'")
\ No newline at end of file
+        raise DecodeError(f"invalid literal '{chr(bs[start])}'")
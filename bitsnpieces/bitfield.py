@@ -0,0 +1,152 @@
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    # python < 3.10
+    def _popcount(integer: int) -> int:
+        return bin(integer).count('1')
+
+
+class Bitfield(object):
+    """
+    Fixed length bit array backed by a bytearray in BitTorrent wire order: bit 0 is the high bit
+    of the first byte and the spare bits at the end of the last byte are always zero.
+    Set and test are O(1), whole-bitfield operations run on Python ints so they stay in C.
+    """
+
+    __slots__ = ('length', 'data')
+
+    def __init__(self, length: int, data: bytearray=None):
+        self.length = length
+        if data is None:
+            data = bytearray((length + 7) // 8)
+        self.data = data
+
+    @classmethod
+    def from_bytes(cls, data, length: int=None):
+        """
+        Creates a bitfield from wire format bytes. A bytearray is used in place, anything else
+        (bytes, memoryview) is copied once. Missing bytes are zero filled and extra bits are cleared.
+        """
+
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        if length is None:
+            length = len(data) * 8
+        bitfield = cls(length, data)
+        bitfield.resize(length)
+        return bitfield
+
+    def to_bytes(self) -> bytes:
+        """
+        Returns the bitfield in wire format
+        """
+
+        return bytes(self.data)
+
+    def resize(self, length: int):
+        """
+        Changes the length in place, clearing any bits past the new length
+        """
+
+        num_bytes = (length + 7) // 8
+        if len(self.data) > num_bytes:
+            del self.data[num_bytes:]
+        elif len(self.data) < num_bytes:
+            self.data.extend(bytes(num_bytes - len(self.data)))
+        self.length = length
+
+        spare_bits = num_bytes * 8 - length
+        if spare_bits:
+            self.data[-1] &= (0xff << spare_bits) & 0xff
+
+    def copy(self):
+        return Bitfield(self.length, bytearray(self.data))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> bool:
+        if index < 0 or index >= self.length:
+            raise IndexError("bitfield index out of range")
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index: int, value: bool):
+        if index < 0 or index >= self.length:
+            raise IndexError("bitfield index out of range")
+        if value:
+            self.data[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self.data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitfield) and self.length == other.length and self.data == other.data
+
+    def __str__(self) -> str:
+        return ''.join('1' if bit else '0' for bit in self)
+
+    def __repr__(self) -> str:
+        return f"Bitfield({self.length}, {self.count()} set)"
+
+    def iter_set(self):
+        """
+        Yields the indices of the set bits in order, skipping zero bytes
+        """
+
+        data = self.data
+        for byte_index, byte in enumerate(data):
+            if byte:
+                base = byte_index << 3
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield base + bit
+
+    def set_all(self):
+        """
+        Sets every bit
+        """
+
+        self.data[:] = b'\xff' * len(self.data)
+        self.resize(self.length)
+
+    def to_int(self) -> int:
+        return int.from_bytes(self.data, 'big')
+
+    def count(self) -> int:
+        """
+        Returns the number of set bits
+        """
+
+        return _popcount(self.to_int())
+
+    def all(self) -> bool:
+        return self.count() == self.length
+
+    def any(self) -> bool:
+        return any(self.data)
+
+    def _from_int(self, integer: int):
+        return Bitfield(self.length, bytearray(integer.to_bytes(len(self.data), 'big')))
+
+    def __and__(self, other):
+        return self._from_int(self.to_int() & other.to_int())
+
+    def __or__(self, other):
+        return self._from_int(self.to_int() | other.to_int())
+
+    def and_not(self, other):
+        """
+        Returns the bits set in this bitfield but not in other
+        """
+
+        return self._from_int(self.to_int() & ~other.to_int())
+
+    def count_and_not(self, other) -> int:
+        """
+        Returns the number of bits set in this bitfield but not in other, without building the result
+        """
+
+        return _popcount(self.to_int() & ~other.to_int())
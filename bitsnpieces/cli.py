@@ -9,18 +9,45 @@ import argparse
 from . import __version__
 from .bencode.decoder import decode
 from . import torrent
-from .tracker import Tracker
+from .tracker import Tracker, HTTPTrackerSession
 from .client import TorrentClient
+from .server import PeerServer
+from .dht import DHTNode
+from .metadata import MetadataCache, MetadataFetcher
 from .utils import generate_peer_id
 
 async def start_download(filepath, path):
-    # load the torrent file
-    torfile = torrent.load(filepath)
+    # listen for inbound peers
+    server = PeerServer(port=6889)
+    await server.start()
+
+    # HTTP tracker connections are pooled over all torrents
+    http_session = HTTPTrackerSession()
+
+    # find peers without trackers too, the routing table is kept for the next start
+    dht = DHTNode(port=server.port, state_path=os.path.join(path, '.dht_state'))
+    await dht.start()
+
+    # load the torrent file, or fetch the metadata of a magnet link from peers
+    peer_id = generate_peer_id()
+    if filepath.startswith('magnet:'):
+        magnet = torrent.parse_magnet(filepath)
+        fetcher = MetadataFetcher(magnet, peer_id, port=server.port, dht=dht, http_session=http_session,
+            cache=MetadataCache(os.path.join(path, '.metadata')))
+        torfile = magnet.to_torrent(await fetcher.fetch())
+    else:
+        torfile = torrent.load(filepath)
 
     # start the client
-    client = TorrentClient(torfile, download_directory=path, port=6889)
+    client = TorrentClient(torfile, download_directory=path, peer_id=peer_id, port=server.port,
+        http_session=http_session, dht=dht)
+    server.add_torrent(client)
     await client.start()
+    server.remove_torrent(client)
     await client.disconnect()
+    await dht.close()
+    await http_session.close()
+    await server.close()
 
 def main():
     """
@@ -30,7 +57,7 @@ def main():
     default_path = os.path.join(os.getcwd(), 'downloads')
 
     parser = argparse.ArgumentParser(description=f"Bits 'n' Pieces v{__version__}\n")
-    parser.add_argument('torrent', help="The metainfo file path (.torrent)")
+    parser.add_argument('torrent', help="The metainfo file path (.torrent) or a magnet link")
     parser.add_argument('--path', help="The download directory path, defaults to './downloads'",
                         default=default_path)
 
@@ -1,23 +1,36 @@
 import math
 import time
-import random
+from bisect import bisect_right
+from collections import deque
+from itertools import chain
 import asyncio
 import os.path
 
 from .utils import generate_peer_id, sha1
-from .tracker import Tracker
+from .tracker import TrackerList
+from .announcer import Announcer
+from .pex import PeerExchange
+from .metadata import MetadataExchange
 from .peer import Peer, Request
+from .connection import ConnectionManager
+from .peerdb import PeerDatabase
+from .timer import TimerWheel
+from .picker import PiecePicker
+from .bitfield import Bitfield
 
 
 class TorrentClient(object):
     """
     Abstracts the client for a single torrent
     """
+
+    MAX_PEERS = 50
     
     def __init__(self, torrent, download_directory: str=".",
-            peer_id: bytes=None, ip=None, port=None):
+            peer_id: bytes=None, ip=None, port=None, http_session=None, dht=None):
         # set parameters
         self.torrent = torrent
+        self.info_hash = torrent.info.get_sha1()
         self.download_directory = download_directory
         
         if peer_id is None:
@@ -31,105 +44,197 @@ class TorrentClient(object):
         # create piece manager
         self.piece_manager = PieceManager(self.torrent, self.download_directory)
         
-        # create a tracker
-        self.tracker = Tracker(self.torrent)
+        # create the trackers of the announce-list, HTTP trackers use the shared session if given
+        self.tracker = TrackerList(self.torrent, http_session=http_session)
+
+        # a DHT node shared by all torrents, if peers are to be found without trackers as well
+        self.dht = dht
+        self.announcer = Announcer(self)
+
+        # connected peers keyed by (ip, port) and every peer we know of
+        self.peers = {}
+        self.peer_db = PeerDatabase()
+
+        # dials the peers we learn about
+        self.connection_manager = ConnectionManager(self)
 
-        # client connected peers list
-        self.peers = []
+        # shares connected peers with the peers that support it
+        self.peer_exchange = PeerExchange(self)
+
+        # serves our metadata to peers that start from a magnet link
+        self.metadata_exchange = MetadataExchange(self)
+
+        # keep-alives and timeouts of all peer connections
+        self.timer_wheel = TimerWheel()
     
     async def start(self):
         """
         Starts downloading the torrent by making announce calls to the tracker and maintaining peer connections
         """
         
-        # make periodic tracker announcements and update peer list
-        await self.start_tracker_announces()
+        self.timer_wheel.start()
+        self.peer_exchange.start()
+
+        # make periodic tracker announcements until the trackers know the download is complete
+        await self.announcer.run()
     
-    async def start_tracker_announces(self):
+    async def add_peers(self, peers, source: str="tracker"):
+        """
+        Merges (ip, port) peers into the peer database and fills free connection slots with the best
+        candidates, replacing a connected peer only if a clearly better candidate is known
+        """
+
+        for ip, port in peers:
+            self.peer_db.add(ip, port, source)
+        await self.connection_manager.replace_peers()
+        self.connection_manager.dial_candidates()
+
+    def add_peer(self, peer):
+        """
+        Adds a peer whose connection was just established
+        """
+
+        self.peers[peer.address] = peer
+
+    def remove_peer(self, peer):
+        """
+        Removes a disconnected peer, keeping its measured speed in the peer database, and
+        fills the freed slot
         """
-        Start sending announces to tracker and updating the peer list
+
+        if self.peers.get(peer.address) is not peer:
+            return
+        del self.peers[peer.address]
+
+        record = self.peer_db.get(peer.address)
+        if record is not None:
+            record.download_speed = peer.download_speed
+            record.hash_failures = peer.num_hash_failures
+            record.last_seen = time.monotonic()
+        self.connection_manager.dial_candidates()
+
+        # ask the trackers for more peers if we are running short
+        if self.announcer.is_short_of_peers():
+            self.announcer.wake()
+
+    async def piece_completed(self, index):
+        """
+        Called when a piece is verified, peers that only had pieces we now have lose our interest
         """
 
-        tracker_response = None
-        event = 'started'
+        # the trackers are told as soon as the download is complete
+        if self.piece_manager.is_complete:
+            self.announcer.wake()
 
-        while not self.piece_manager.is_complete:
-            # make tracker announce request and get response
+        for peer in list(self.peers.values()):
+            if peer.pieces_bitfield[index]:
+                peer.num_wanted_pieces -= 1
             try:
-                tracker_response = await self.tracker.announce(self.peer_id, self.port,
-                    self.piece_manager.uploaded, self.piece_manager.downloaded, event)
-            except ConnectionError:
-                print("Tracker announce failed")
-                continue
-            
-            print(f"Announce to tracker {self.torrent.announce}, next request in {tracker_response.interval} seconds")
+                await peer.update_interest()
+            except (ConnectionError, OSError):
+                await peer.disconnect()
 
-            # update the peer list
-            asyncio.create_task(self.update_peer_list(tracker_response))
+    async def set_file_priority(self, file_index, priority: int):
+        """
+        Changes the priority of a file, see PieceManager.set_file_priority. Our interest in
+        each peer follows the pieces we now want. Wanting a file of a complete download again
+        resumes the announces, which start() stopped waiting for, in the background.
+        """
 
-            # wait until you can send another request
-            await asyncio.sleep(tracker_response.interval)
+        was_complete = self.piece_manager.is_complete
+        self.piece_manager.set_file_priority(file_index, priority)
+        if was_complete and not self.piece_manager.is_complete:
+            self.announcer.resume()
+        for peer in list(self.peers.values()):
+            peer.num_wanted_pieces = self.piece_manager.count_wanted_pieces(peer.pieces_bitfield)
+            try:
+                await peer.update_interest()
+            except (ConnectionError, OSError):
+                await peer.disconnect()
 
-            if event == 'started':
-                event = ""
-    
-    async def update_peer_list(self, tracker_response):
-        # disconnect any peer not in the response
-        disconnected_peers = []
-        for my_peer in self.peers:
-            still_connected = False
-            for new_peer in tracker_response.peers:
-                if my_peer.ip == new_peer['ip'] and my_peer.port == new_peer['port']:
-                    still_connected = True
-                    break
-            if not still_connected:
-                disconnected_peers.append(my_peer)
-        
-        for peer in disconnected_peers:
-            await peer.disconnect()
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Returns torrent data as soon as it is verified, prioritizing the pieces just ahead of it
+        """
 
-        # connect to any new peers and update the peer list
-        connected_peers = []
-        for new_peer in tracker_response.peers:
-            connected = False
-            for my_peer in self.peers:
-                if my_peer.ip == new_peer['ip'] and my_peer.port == new_peer['port']:
-                    connected = True
-            if connected:
-                connected_peers.append(my_peer)
-            else:
-                # connect to the new peer
-                peer_obj = Peer(self, self.torrent, **new_peer)
-                try:
-                    asyncio.create_task(peer_obj.connect())
-                    connected_peers.append(peer_obj)
-                except ConnectionError:
-                    pass
-        self.peers = connected_peers
+        return await self.piece_manager.read(offset, length)
+
+    async def accept_peer(self, reader, writer, handshake, buffer, ip, port) -> bool:
+        """
+        Takes over an inbound peer connection whose handshake was already received.
+        Returns False if the peer was refused because the client is at its connection limit, or if
+        our handshake could not be sent.
+        """
+
+        if (len(self.peers) >= TorrentClient.MAX_PEERS or (ip, port) in self.peers
+                or self.peer_db.is_banned(ip)):
+            return False
+
+        peer = Peer(self, self.torrent, ip, port, peer_id=handshake.peer_id, inbound=True)
+        if not await peer.accept(reader, writer, handshake, buffer):
+            return False
+        self.add_peer(peer)
+        return True
 
     async def disconnect(self):
         """
         Close connections to the tracker and any peers
         """
 
-        for peer in self.peers.copy():
+        await self.connection_manager.close()
+        self.peer_exchange.stop()
+        for peer in list(self.peers.values()):
             await peer.disconnect()
-        self.peers = []
+        self.peers = {}
+        await self.timer_wheel.stop()
+        await self.announcer.stop()
         await self.tracker.close()
         self.is_connected = False
 
 
 class PieceManager(object):
     """
-    Manages pieces for a single client
+    Manages pieces for a single client.
+    The state of every piece is kept in a compact array, Piece and Block objects only exist for
+    pieces that are being downloaded.
     """
 
     NUM_LATEST_DATA_POINTS = 100
+    NEAR_END_PIECES = 20    # peers with nothing we need are dropped once this few pieces are missing
 
-    def __init__(self, torrent, download_directory):
+    # endgame: once every missing block is requested, blocks are also requested from other peers
+    MAX_ENDGAME_REQUESTS = 3                # peers a single block is requested from at once
+    MAX_ENDGAME_DUPLICATE_BYTES = 2 ** 24   # duplicate requests stop after this many bytes
+
+    # piece states
+    PIECE_MISSING = 0
+    PIECE_DOWNLOADING = 1
+    PIECE_COMPLETE = 2
+
+    # peer speed classes, peers of a class share pieces and fast peers get whole pieces
+    SPEED_SLOW = 0
+    SPEED_MEDIUM = 1
+    SPEED_FAST = 2
+    MEDIUM_PEER_SPEED = 2 ** 14     # in bytes per second, about a block per second
+    FAST_PEER_SPEED = 2 ** 18       # in bytes per second
+
+    MAX_OPEN_PIECES = 64    # no new piece is started while this many are being downloaded
+
+    # peers that sent blocks of this many failed pieces are banned, a peer that sent a failed piece
+    # on its own is banned right away
+    MAX_HASH_FAILURES = 3
+    SINGLE_PEER_RETRY = True    # download a failed piece from one peer to find who sent corrupt data
+
+    # streaming: the pieces just ahead of the read cursor are requested first, each with a deadline
+    STREAM_WINDOW = 16              # in pieces
+    STREAM_PIECE_TIME = 2           # seconds between the deadlines of consecutive pieces in the window
+    STREAM_DEADLINE_MARGIN = 1      # pieces this close to their deadline are also requested from other peers
+
+    def __init__(self, torrent, download_directory, max_open_pieces: int=None):
         # set parameters
         self.torrent = torrent
         self.download_directory = download_directory
+        self.max_open_pieces = max_open_pieces or PieceManager.MAX_OPEN_PIECES
         self.uploaded = 0
         self.downloaded = 0
         self.is_complete = False
@@ -139,58 +244,569 @@ class PieceManager(object):
         self.latest_download_times = []
         self.num_complete_pieces = 0
 
+        # endgame metrics
+        self.is_endgame = False
+        self.endgame_start_time = None
+        self.duplicate_bytes = 0        # bytes requested from more than one peer
+        self.wasted_bytes = 0           # blocks that arrived after they were complete
+        self.endgame_time_saved = 0     # estimated seconds won by blocks the duplicate arrived first
+
+        # hash failure metrics
+        self.num_hash_failures = 0
+        self.hash_failed_bytes = 0
+        self.num_banned_peers = 0
+
+        # streaming: first piece the reader needs (None if not streaming), deadlines of the pieces
+        # in the window and the readers waiting for pieces
+        self.read_cursor = None
+        self.stream_window = PieceManager.STREAM_WINDOW
+        self.deadlines = {}
+        self.missed_deadlines = 0
+        self.piece_events = {}
+
         # initialize
         self.initialize_pieces()
+        self.picker = PiecePicker(self.torrent.info.num_pieces)
         self.data_writer = DataWriter(self.torrent, self.download_directory)
         
     def initialize_pieces(self):
         """
-        Initialize piece list
+        Initialize piece states
         """
         
-        num_pieces = self.torrent.info.num_pieces
-        piece_length = self.torrent.info.piece_length
-        last_piece_length = self.torrent.info.total_length - (num_pieces - 1) * piece_length
-        
-        self.pieces = [Piece(self, index, piece_length) for index in range(num_pieces - 1)]
-        self.pieces.append(Piece(self, num_pieces - 1, last_piece_length))
+        self.num_pieces = self.torrent.info.num_pieces
+        self.piece_length = self.torrent.info.piece_length
+        self.total_length = self.torrent.info.total_length
+        self.last_piece_length = self.total_length - (self.num_pieces - 1) * self.piece_length
+
+        # one byte per piece, the pieces we have and the pieces that are being downloaded
+        self.piece_states = bytearray(self.num_pieces)
+        self.have = Bitfield(self.num_pieces)
+        self.pieces = {}
+
+        # the pieces of files that are not skipped, and how many of them we do not have yet
+        self.wanted = Bitfield(self.num_pieces)
+        self.wanted.set_all()
+        self.num_wanted_pieces = self.num_pieces
+
+        # where each file starts in the torrent's data and its priority
+        self.file_offsets = []
+        offset = 0
+        for file_info in self.torrent.info.files:
+            self.file_offsets.append(offset)
+            offset += file_info.length
+        self.file_priorities = [PiecePicker.PRIORITY_NORMAL] * len(self.file_offsets)
+
+    def get_piece_length(self, index) -> int:
+        if index == self.num_pieces - 1:
+            return self.last_piece_length
+        return self.piece_length
+
+    def is_piece_complete(self, index) -> bool:
+        return self.piece_states[index] == PieceManager.PIECE_COMPLETE
+
+    def is_piece_wanted(self, index) -> bool:
+        return self.wanted[index] and not self.have[index]
+
+    def count_wanted_pieces(self, bitfield) -> int:
+        """
+        Returns the number of pieces in the bitfield we want but do not have
+        """
+
+        return (bitfield & self.wanted).count_and_not(self.have)
+
+    @property
+    def left(self) -> int:
+        """
+        The bytes of the wanted pieces we do not have, what the trackers are told is left to download
+        """
+
+        return sum(self.get_piece_length(index) for index in range(self.num_pieces) if self.is_piece_wanted(index))
+
+    @property
+    def is_near_end(self) -> bool:
+        return self.num_wanted_pieces <= PieceManager.NEAR_END_PIECES
+
+    def get_file_pieces(self, file_index) -> range:
+        """
+        Returns the indices of the pieces holding data of a file
+        """
+
+        begin = self.file_offsets[file_index]
+        end = begin + self.torrent.info.files[file_index].length
+        if begin == end:
+            return range(0)
+        return range(begin // self.piece_length, (end - 1) // self.piece_length + 1)
+
+    def get_piece_priority(self, index) -> int:
+        """
+        Returns the highest priority of the files a piece holds data of
+        """
+
+        piece_begin = index * self.piece_length
+        piece_end = piece_begin + self.get_piece_length(index)
+
+        priority = PiecePicker.PRIORITY_SKIP
+        file_index = max(0, bisect_right(self.file_offsets, piece_begin) - 1)
+        while file_index < len(self.file_offsets) and self.file_offsets[file_index] < piece_end:
+            file_end = self.file_offsets[file_index] + self.torrent.info.files[file_index].length
+            if file_end > piece_begin:
+                priority = max(priority, self.file_priorities[file_index])
+            file_index += 1
+        return priority
+
+    def set_file_priority(self, file_index, priority: int):
+        """
+        Changes the priority of a file, PiecePicker.PRIORITY_SKIP stops downloading it. Pieces on
+        the boundary with other files take the highest priority of their files, data of skipped
+        files in them is kept out of the download files.
+        """
+
+        num_wanted_pieces = self.num_wanted_pieces
+        self.file_priorities[file_index] = priority
+        if priority == PiecePicker.PRIORITY_SKIP:
+            self.data_writer.skipped_files.add(file_index)
+        else:
+            self.data_writer.skipped_files.discard(file_index)
+
+        for index in self.get_file_pieces(file_index):
+            piece_priority = self.get_piece_priority(index)
+            self.picker.set_priority(index, piece_priority)
+
+            wanted = piece_priority != PiecePicker.PRIORITY_SKIP
+            if wanted == self.wanted[index]:
+                continue
+            self.wanted[index] = wanted
+            if not self.have[index]:
+                self.num_wanted_pieces += 1 if wanted else -1
+            if not wanted:
+                self.abandon_piece(index)
+
+        # pieces already moved to the download files without this file's data are downloaded again
+        if priority != PiecePicker.PRIORITY_SKIP and file_index in self.data_writer.dropped_files:
+            self.data_writer.dropped_files.discard(file_index)
+            for index in self.get_file_pieces(file_index):
+                if self.have[index] and not self.is_piece_intact(index):
+                    self.forget_piece(index)
+
+        if self.num_wanted_pieces > num_wanted_pieces:
+            self.leave_endgame()
+
+        # skipping the last missing files finishes the download
+        if self.num_wanted_pieces == 0 and not self.is_complete:
+            self.is_complete = True
+            self.data_writer.flush()
+        elif self.num_wanted_pieces > 0:
+            self.is_complete = False
+
+    def is_piece_intact(self, index) -> bool:
+        """
+        Returns True if the data of a piece we have can still be read and matches its hash
+        """
+
+        length = self.get_piece_length(index)
+        try:
+            data = self.data_writer.read(index * self.piece_length, length)
+        except (OSError, ValueError):
+            return False
+        return len(data) == length and sha1(data) == self.torrent.info.get_piece_hash(index)
+
+    def forget_piece(self, index):
+        """
+        Marks a piece we have as missing so that it is downloaded again
+        """
+
+        self.have[index] = False
+        self.piece_states[index] = PieceManager.PIECE_MISSING
+        self.num_complete_pieces -= 1
+        if self.wanted[index]:
+            self.num_wanted_pieces += 1
+        self.picker.piece_failed(index)
+        self.leave_endgame()
+
+    def abandon_piece(self, index):
+        """
+        Stops downloading a piece that is no longer wanted, blocks still arriving for it are dropped
+        """
+
+        piece = self.pieces.pop(index, None)
+        if piece is not None:
+            for peer in piece.downloading_from:
+                peer.pieces_downloading.discard(piece)
+            self.piece_states[index] = PieceManager.PIECE_MISSING
+        self.deadlines.pop(index, None)
+
+    def get_piece(self, index):
+        """
+        Returns the in-progress piece at index, starting it if needed
+        """
+
+        piece = self.pieces.get(index)
+        if piece is None:
+            piece = Piece(self, index, self.get_piece_length(index))
+            self.pieces[index] = piece
+            self.piece_states[index] = PieceManager.PIECE_DOWNLOADING
+        return piece
+
+    def get_speed_class(self, peer) -> int:
+        """
+        Returns the speed class of a peer from its measured download speed
+        """
+
+        speed = peer.download_speed
+        if speed >= PieceManager.FAST_PEER_SPEED:
+            return PieceManager.SPEED_FAST
+        if speed >= PieceManager.MEDIUM_PEER_SPEED:
+            return PieceManager.SPEED_MEDIUM
+        return PieceManager.SPEED_SLOW
+
+    def get_open_piece_request(self, peer, speed_class=None):
+        """
+        Returns a request for a free block of a piece that is being downloaded, oldest piece first.
+        Pieces owned by a fast peer are skipped and so are pieces of other speed classes,
+        unless speed_class is None.
+        """
+
+        for piece in self.pieces.values():
+            if (piece.owner is None and piece.has_free_blocks and peer.pieces_bitfield[piece.index]
+                    and (speed_class is None or piece.speed_class == speed_class)):
+                request = piece.get_next_request(peer)
+                if request is not None:
+                    return request
+        return None
+
+    @property
+    def num_open_pieces(self) -> int:
+        return len(self.pieces)
+
+    def get_open_piece_age(self, now: float=None) -> float:
+        """
+        Returns the average time in seconds since the pieces being downloaded were started
+        """
+
+        if not self.pieces:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        return sum(now - piece.start_time for piece in self.pieces.values()) / len(self.pieces)
     
+    def set_read_cursor(self, index: int):
+        """
+        Turns on streaming with the window starting at piece index
+        """
+
+        self.read_cursor = index
+        window = set(self.get_stream_window())
+        self.deadlines = {index: deadline for index, deadline in self.deadlines.items() if index in window}
+
+    def stop_streaming(self):
+        self.read_cursor = None
+        self.deadlines = {}
+
+    def get_stream_window(self, now: float=None) -> list:
+        """
+        Returns the missing pieces of the window ahead of the read cursor, giving a deadline to
+        each piece that enters the window
+        """
+
+        if self.read_cursor is None:
+            return []
+        if now is None:
+            now = time.monotonic()
+
+        # pieces before the first missing one are not needed any more
+        while self.read_cursor < self.num_pieces and not self.is_piece_wanted(self.read_cursor):
+            self.read_cursor += 1
+
+        window = []
+        for offset in range(min(self.stream_window, self.num_pieces - self.read_cursor)):
+            index = self.read_cursor + offset
+            if self.is_piece_wanted(index):
+                window.append(index)
+                if index not in self.deadlines:
+                    self.deadlines[index] = now + (offset + 1) * PieceManager.STREAM_PIECE_TIME
+        return window
+
+    def get_stream_request(self, peer):
+        """
+        Returns a request for the first piece of the streaming window the peer has. Blocks of pieces
+        close to their deadline are also requested from other peers.
+        """
+
+        now = time.monotonic()
+        for index in self.get_stream_window(now):
+            if not peer.pieces_bitfield[index]:
+                continue
+
+            piece = self.get_piece(index)
+            if piece.has_free_blocks:
+                request = piece.get_next_request(peer)
+            elif (self.deadlines[index] - now <= PieceManager.STREAM_DEADLINE_MARGIN
+                    and self.duplicate_bytes < PieceManager.MAX_ENDGAME_DUPLICATE_BYTES):
+                request = piece.get_duplicate_request(peer, PieceManager.MAX_ENDGAME_REQUESTS)
+                if request is not None:
+                    self.duplicate_bytes += request.length
+            else:
+                request = None
+            if request is not None:
+                return request
+        return None
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Returns length bytes of the torrent's data starting at offset, waiting until the pieces
+        holding them are verified. Streaming follows the read, its window moves to offset.
+        """
+
+        if offset < 0 or length < 0 or offset + length > self.total_length:
+            raise ValueError(f"Cannot read {length} bytes at {offset}, the torrent has {self.total_length}")
+        if length == 0:
+            return b""
+
+        file_index = max(0, bisect_right(self.file_offsets, offset) - 1)
+        while file_index < len(self.file_offsets) and self.file_offsets[file_index] < offset + length:
+            if self.file_priorities[file_index] == PiecePicker.PRIORITY_SKIP:
+                raise ValueError(f"Cannot read {length} bytes at {offset}, file {file_index} is skipped")
+            file_index += 1
+
+        first_index = offset // self.piece_length
+        last_index = (offset + length - 1) // self.piece_length
+        self.set_read_cursor(first_index)
+        for index in range(first_index, last_index + 1):
+            if not self.is_piece_complete(index):
+                await self.piece_events.setdefault(index, asyncio.Event()).wait()
+        return self.data_writer.read(offset, length)
+
     def get_next_request(self, peer):
         """
         Returns next request message for this peer.
         Returns None if no requests available (all pieces the peer has have been requested).
+        Peers join pieces started by peers of the same speed class, so slow peers do not each keep
+        a partial piece open, while a fast peer gets each piece it starts to itself.
         """
 
-        if len(peer.pieces_downloading) == 0:
-            # get a random piece request
-            pieces_bitarray = list(enumerate(peer.pieces_bitarray))
-            random.shuffle(pieces_bitarray)
+        # when streaming, the pieces the reader needs next come first
+        if self.read_cursor is not None:
+            request = self.get_stream_request(peer)
+            if request is not None:
+                return request
 
-            for index, peer_has_piece in pieces_bitarray:
-                if peer_has_piece and not self.pieces[index].is_complete:
-                    return self.pieces[index].get_next_request(peer)
-        else:
-            piece = peer.pieces_downloading[0]
+        # continue the pieces the peer is already downloading
+        for piece in peer.pieces_downloading:
             if not piece.is_complete:
-                return piece.get_next_request(peer)
+                request = piece.get_next_request(peer)
+                if request is not None:
+                    return request
+
+        # help peers of the same speed class with their pieces
+        speed_class = self.get_speed_class(peer)
+        request = self.get_open_piece_request(peer, speed_class)
+        if request is not None:
+            return request
+
+        # start a piece the peer suggests, likely read from its cache, then the rarest piece the peer
+        # has, unless too many pieces are open
+        suggested = [index for index in peer.suggested_pieces
+            if peer.pieces_bitfield[index] and self.is_piece_wanted(index)]
+        for index in chain(suggested, self.picker.iter_candidates(peer.pieces_bitfield)):
+            if len(self.pieces) >= self.max_open_pieces:
+                break
+            if index in self.pieces:
+                continue
+            piece = self.get_piece(index)
+            piece.speed_class = speed_class
+            if speed_class == PieceManager.SPEED_FAST:
+                piece.owner = peer
+            request = piece.get_next_request(peer)
+            if request is not None:
+                return request
+
+        # help with any open piece rather than waiting
+        request = self.get_open_piece_request(peer)
+        if request is not None:
+            return request
+
+        # every block is taken, ask for blocks other peers are slow to send
+        if self.is_endgame or self.update_endgame():
+            return self.get_endgame_request(peer)
         return None
+
+    def get_allowed_fast_request(self, peer):
+        """
+        Returns a request for a block of a piece the peer lets us download while it chokes us,
+        None if it has none of them we want
+        """
+
+        for index in sorted(peer.allowed_fast):
+            if not peer.pieces_bitfield[index] or not self.is_piece_wanted(index):
+                continue
+            piece = self.pieces.get(index)
+            if piece is None:
+                if len(self.pieces) >= self.max_open_pieces:
+                    continue
+                piece = self.get_piece(index)
+            request = piece.get_next_request(peer)
+            if request is not None:
+                return request
+        return None
+
+    def update_endgame(self) -> bool:
+        """
+        Enters endgame mode if every missing piece is being downloaded and all of their
+        blocks are requested
+        """
+
+        if (self.is_complete or not self.pieces
+                or len(self.pieces) < self.num_wanted_pieces
+                or not all(piece.is_fully_requested for piece in self.pieces.values())):
+            return False
+
+        self.is_endgame = True
+        self.endgame_start_time = time.monotonic()
+        print(f"Entering endgame with {len(self.pieces)} pieces left")
+        return True
+
+    def leave_endgame(self):
+        """
+        Leaves endgame mode when pieces go missing again, endgame is entered anew with a fresh
+        duplicate bytes budget once they are all requested
+        """
+
+        if not self.is_endgame:
+            return
+        self.is_endgame = False
+        self.endgame_start_time = None
+        self.duplicate_bytes = 0
+        print("Leaving endgame, pieces are missing again")
+
+    def get_endgame_request(self, peer):
+        """
+        Returns a request for a block that is already requested from other peers, or None if the peer
+        has none of the remaining pieces or the duplicate bytes cap is reached
+        """
+
+        if self.duplicate_bytes >= PieceManager.MAX_ENDGAME_DUPLICATE_BYTES:
+            return None
+
+        for piece in self.pieces.values():
+            if peer.pieces_bitfield[piece.index]:
+                request = piece.get_duplicate_request(peer, PieceManager.MAX_ENDGAME_REQUESTS)
+                if request is not None:
+                    self.duplicate_bytes += request.length
+                    return request
+        return None
+
+    async def cancel_duplicates(self, peer, request, requests):
+        """
+        Cancels a block that just arrived from peer at the other peers it was requested from.
+        requests maps each of those peers to the time it was asked for the block.
+        """
+
+        now = time.monotonic()
+        first_peer, first_time = min(requests.items(), key=lambda item: item[1])
+        if self.is_endgame and first_peer is not peer:
+            # the first peer would have sent it at its average speed, or not before the deadline
+            speed = first_peer.download_speed
+            expected = first_time + (request.length / speed if speed > 0 else Peer.REQUEST_TIMEOUT)
+            self.endgame_time_saved += max(0, expected - now)
+
+        for other_peer in requests:
+            if other_peer is not peer:
+                await other_peer.cancel_request(request)
+
+    def add_peer_pieces(self, bitfield):
+        """
+        Counts the pieces of a peer's bitfield towards piece availability
+        """
+
+        self.picker.add_peer(bitfield)
+
+    def add_peer_piece(self, index):
+        """
+        Counts a piece a peer announced towards piece availability
+        """
+
+        self.picker.add_piece_holder(index)
+
+    def remove_peer_pieces(self, bitfield):
+        """
+        Uncounts the pieces of a disconnected peer
+        """
+
+        self.picker.remove_peer(bitfield)
+
+    def release_request(self, peer, request, timed_out: bool=False):
+        """
+        Gives a block requested from the peer back to the pool so that any peer can request it.
+        A piece reserved for a peer whose request timed out is opened to other peers.
+        """
+
+        piece = self.pieces.get(request.index)
+        if piece is not None:
+            piece.release_block(peer, request.begin // Piece.BLOCK_LENGTH, timed_out)
+            if timed_out and piece.owner is peer:
+                piece.owner = None
+
+    def peer_choked(self, peer):
+        """
+        Called when a peer chokes us, the pieces reserved for it are opened to other peers
+        """
+
+        for piece in peer.pieces_downloading:
+            if piece.owner is peer:
+                piece.owner = None
     
-    async def download_block(self, peer, message):
+    async def download_block(self, peer, message) -> bool:
         """
         Called when a a "Piece" message is received from a peer. Saves block and will write piece to disk
-        if a piece is complete.
+        if a piece is complete. Returns True if the block completed its piece.
         """
 
-        piece = self.pieces[message.index]
-        if not piece.is_complete:
+        # blocks of pieces nobody requested or that are already complete are dropped
+        piece = self.pieces.get(message.index)
+        if piece is not None and not piece.is_complete:
+            block_index = message.begin // Piece.BLOCK_LENGTH
+            requests = dict(piece.requested_blocks.get(block_index, {}))
             block_size = await piece.download_block(peer, message)
+            if block_size == 0:
+                self.wasted_bytes += len(message.block)
+                return False
+            peer.downloaded += block_size
 
-            # check if piece is complete
+            # in endgame the block may have been requested from other peers too
+            if len(requests) > 1 or (requests and peer not in requests):
+                await self.cancel_duplicates(peer, Request(message.index, message.begin, block_size),
+                    requests)
+
+            if piece.failed_peers is not None:
+                failed_peers, piece.failed_peers = piece.failed_peers, None
+                await self.hash_failed(piece, failed_peers)
+
+            # check if piece is complete, its blocks are no longer needed
             if piece.is_complete:
+                del self.pieces[piece.index]
+                self.piece_states[piece.index] = PieceManager.PIECE_COMPLETE
+                self.have[piece.index] = True
                 self.num_complete_pieces += 1
-            if self.num_complete_pieces == self.torrent.info.num_pieces:
+                if self.wanted[piece.index]:
+                    self.num_wanted_pieces -= 1
+                self.picker.piece_complete(piece.index)
+
+                # wake up readers waiting for the piece
+                deadline = self.deadlines.pop(piece.index, None)
+                if deadline is not None and time.monotonic() > deadline:
+                    self.missed_deadlines += 1
+                event = self.piece_events.pop(piece.index, None)
+                if event is not None:
+                    event.set()
+            if piece.is_complete and self.num_wanted_pieces == 0:
                 self.is_complete = True
+                self.data_writer.flush()
                 print("Torrent download complete")
+                if self.is_endgame:
+                    print(f"Endgame took {time.monotonic() - self.endgame_start_time:0.2f} s, "
+                        f"requested {self.duplicate_bytes} duplicate bytes, wasted {self.wasted_bytes} bytes, "
+                        f"saved about {self.endgame_time_saved:0.2f} s")
             
             # update download metrics
             self.downloaded += block_size
@@ -200,7 +816,7 @@ class PieceManager(object):
                 self.latest_download_sizes.pop(0)
                 self.latest_download_times.pop(0)
             
-            download_percentage = self.downloaded * 100 / self.torrent.info.total_length
+            download_percentage = self.downloaded * 100 / self.total_length
             if len(self.latest_download_sizes) <= 1:
                 download_speed = 0
                 time_left = float('inf')
@@ -208,10 +824,39 @@ class PieceManager(object):
                 total_downloaded = sum(self.latest_download_sizes)
                 total_time = self.latest_download_times[-1] - self.latest_download_times[0]
                 download_speed = total_downloaded / (total_time)
-                time_left = (self.torrent.info.total_length - self.downloaded) / (download_speed)
+                time_left = (self.total_length - self.downloaded) / (download_speed)
             print(f"Downloaded {block_size} bytes, downloaded: {download_percentage:0.2f}%, "
-                f"download speed: {download_speed/1024:0.2f} KB/s, time left: {time_left/60:0.2f} min")
+                f"download speed: {download_speed/1024:0.2f} KB/s, time left: {time_left/60:0.2f} min, "
+                f"open pieces: {self.num_open_pieces} ({self.get_open_piece_age():0.1f} s old on average)")
+            return piece.is_complete
 
+        self.wasted_bytes += len(message.block)
+        return False
+
+    async def hash_failed(self, piece, peers):
+        """
+        Called when a piece failed verification and was reset, with the peers that sent its blocks.
+        A peer that sent the whole piece is banned. Otherwise each peer gets a strike, peers with
+        too many strikes are banned, and the piece is downloaded from a single peer next time
+        so that a second failure points at the peer that sent it.
+        """
+
+        self.num_hash_failures += 1
+        self.hash_failed_bytes += piece.length
+        self.leave_endgame()
+
+        for peer in peers:
+            peer.num_hash_failures += 1
+            if len(peers) == 1 or peer.num_hash_failures >= PieceManager.MAX_HASH_FAILURES:
+                self.num_banned_peers += 1
+                await peer.ban()
+
+        if len(peers) > 1 and PieceManager.SINGLE_PEER_RETRY:
+            piece.is_suspect = True
+            for peer in piece.downloading_from:
+                peer.pieces_downloading.discard(piece)
+            piece.downloading_from = set()
+            piece.owner = None
     
     def write_piece(self, piece, data):
         """
@@ -224,6 +869,8 @@ class PieceManager(object):
 class Piece(object):
     """
     Stores piece status and data until it is complete.
+    Keeps the free blocks in a queue and the requested blocks indexed by block and by peer,
+    so handing out and giving back a block never scans the block list.
     """
 
     # typical block size in bytes
@@ -237,7 +884,17 @@ class Piece(object):
         self.length = length
 
         self.is_complete = False
-        self.downloading_from = []
+        self.downloading_from = set()
+        self.start_time = time.monotonic()
+
+        # speed class of the peers sharing the piece, and the fast peer it is reserved for if any
+        self.speed_class = PieceManager.SPEED_SLOW
+        self.owner = None
+
+        # a suspect piece failed verification with blocks from several peers, it is reserved for
+        # the first peer asked for it. failed_peers holds the senders of a piece that just failed.
+        self.is_suspect = False
+        self.failed_peers = None
 
         # initialize blocks
         self.num_blocks = math.ceil(length / Piece.BLOCK_LENGTH)
@@ -245,6 +902,16 @@ class Piece(object):
 
         self.blocks = [Block(self.index, block_index, Piece.BLOCK_LENGTH) for block_index in range(self.num_blocks - 1)]
         self.blocks.append(Block(self.index, self.num_blocks - 1, last_block_length))
+        self.num_complete_blocks = 0
+
+        # block allocation: blocks nobody was asked for, the peers each requested block was asked
+        # from (with the time they were asked) and the blocks asked from each peer
+        self.free_blocks = deque(range(self.num_blocks))
+        self.requested_blocks = {}
+        self.peer_blocks = {}
+
+        # the peers each block timed out at and when, they are not asked for it again for a while
+        self.timed_out_peers = {}
 
     def get_next_request(self, peer):
         """
@@ -252,14 +919,104 @@ class Piece(object):
         Returns None if no requests available (all blocks of this piece have been requested).
         """
 
-        for block in self.blocks:
-            if not block.is_complete and peer not in block.requested_from:
-                block.requested_from.append(peer)
-                if not self in peer.pieces_downloading:
-                    peer.pieces_downloading.append(self)
-                    self.downloading_from.append(peer)
-                return block.request()
-        return None
+        if self.owner is not None and self.owner is not peer:
+            return None
+        if self.is_suspect and self.owner is None:
+            self.owner = peer
+
+        now = time.monotonic()
+        skipped = []
+        request = None
+        while self.free_blocks:
+            block_index = self.free_blocks.popleft()
+            block = self.blocks[block_index]
+            if block.is_complete or block_index in self.requested_blocks:
+                # stale entry
+                continue
+            if now - self.timed_out_peers.get(block_index, {}).get(peer, -math.inf) < Peer.REQUEST_TIMEOUT:
+                # the peer just missed the block's deadline, leave it to other peers
+                skipped.append(block_index)
+                continue
+
+            self.requested_blocks[block_index] = {peer: now}
+            self.peer_blocks.setdefault(peer, set()).add(block_index)
+            peer.pieces_downloading.add(self)
+            self.downloading_from.add(peer)
+            request = block.request()
+            break
+        self.free_blocks.extendleft(reversed(skipped))
+        return request
+
+    @property
+    def has_free_blocks(self) -> bool:
+        return self.num_complete_blocks + len(self.requested_blocks) < self.num_blocks
+
+    @property
+    def is_fully_requested(self) -> bool:
+        """
+        True if every block is complete or requested from some peer
+        """
+
+        return not self.has_free_blocks
+
+    def get_duplicate_request(self, peer, max_requests: int):
+        """
+        Returns a request for the requested block asked from the fewest peers, if it is asked from fewer
+        than max_requests peers and not from this peer. Returns None if there is no such block.
+        Duplicates ignore the peer a piece is reserved for, so a reserved piece cannot stall the end.
+        """
+
+        best_index = None
+        best_count = max_requests
+        for block_index, peers in self.requested_blocks.items():
+            if len(peers) < best_count and peer not in peers:
+                best_index = block_index
+                best_count = len(peers)
+        if best_index is None:
+            return None
+
+        self.requested_blocks[best_index][peer] = time.monotonic()
+        self.peer_blocks.setdefault(peer, set()).add(best_index)
+        peer.pieces_downloading.add(self)
+        self.downloading_from.add(peer)
+        return self.blocks[best_index].request()
+
+    def release_block(self, peer, block_index, timed_out: bool=False):
+        """
+        Forgets that a block was requested from a peer, the block is free again once
+        no peer is asked for it. A peer the block timed out at is not asked for it again
+        for a while.
+        """
+
+        if timed_out:
+            self.timed_out_peers.setdefault(block_index, {})[peer] = time.monotonic()
+
+        peer_blocks = self.peer_blocks.get(peer)
+        if peer_blocks is not None:
+            peer_blocks.discard(block_index)
+
+        peers = self.requested_blocks.get(block_index)
+        if peers is None or peer not in peers:
+            return
+        del peers[peer]
+        if not peers:
+            del self.requested_blocks[block_index]
+            if not self.blocks[block_index].is_complete:
+                # free blocks are handed out again before untouched ones
+                self.free_blocks.appendleft(block_index)
+
+    def remove_peer(self, peer):
+        """
+        Forgets the blocks requested from a peer so that other peers can request them
+        """
+
+        self.downloading_from.discard(peer)
+        if self.owner is peer:
+            self.owner = None
+        # released blocks are pushed to the front of the queue, so release the last one first
+        for block_index in sorted(self.peer_blocks.get(peer, ()), reverse=True):
+            self.release_block(peer, block_index)
+        self.peer_blocks.pop(peer, None)
     
     async def download_block(self, peer, message):
         """
@@ -270,32 +1027,58 @@ class Piece(object):
         block_index = message.begin // Piece.BLOCK_LENGTH
         if not self.blocks[block_index].is_complete:
             await self.blocks[block_index].download(message.block)
+            self.blocks[block_index].peer = peer
+            self.num_complete_blocks += 1
+
+            # the block is no longer requested from anyone
+            for requested_peer in self.requested_blocks.pop(block_index, ()):
+                self.peer_blocks[requested_peer].discard(block_index)
+            self.timed_out_peers.pop(block_index, None)
             
             print(f"Block {block_index+1}/{self.num_blocks} of Piece {self.index+1} is downloaded")
             
-            if all(block.is_complete for block in self.blocks):
-                data = b""
-                for b in self.blocks:
-                    data += b.data
+            if self.num_complete_blocks == self.num_blocks:
+                data = b"".join(b.data for b in self.blocks)
                 
                 piece_data_hash = sha1(data)
                 piece_hash_in_torrent = self.torrent.info.get_piece_hash(self.index)
                 if piece_data_hash == piece_hash_in_torrent:
                     self.piece_manager.write_piece(self, data)
                     self.is_complete = True
-                    for peer in self.downloading_from:
-                        peer.pieces_downloading.remove(self)
+                    for downloading_peer in self.downloading_from:
+                        downloading_peer.pieces_downloading.discard(self)
                     print(f"Piece {self.index+1}/{self.piece_manager.torrent.info.num_pieces} is verified and written to disk")
+                else:
+                    print(f"Piece {self.index+1}/{self.piece_manager.torrent.info.num_pieces} failed verification")
+                    self.failed_peers = {block.peer for block in self.blocks}
+                    self.reset()
             
             return len(message.block)
         return 0
 
+    def reset(self):
+        """
+        Drops the data of all blocks so the piece is downloaded again
+        """
+
+        for block in self.blocks:
+            block.data = None
+            block.is_complete = False
+            block.peer = None
+        self.num_complete_blocks = 0
+        self.free_blocks = deque(range(self.num_blocks))
+        self.requested_blocks = {}
+        self.peer_blocks = {}
+        self.timed_out_peers = {}
+
 
 class Block(object):
     """
     Stores block status and data.
     """
 
+    __slots__ = ('piece_index', 'block_index', 'length', 'data', 'is_complete', 'peer')
+
     def __init__(self, piece_index, block_index, length):
         # set parameters
         self.piece_index = piece_index
@@ -304,10 +1087,7 @@ class Block(object):
 
         self.data = None
         self.is_complete = False
-
-        # list of peers this block has been requested from
-        self.requested_from = []
-
+        self.peer = None    # the peer that sent the data
     
     def request(self):
         """
@@ -350,6 +1130,10 @@ class DataWriter(object):
         # info on download and temp files
         self.download_filepaths = [os.path.join(download_directory, f_info.path) for f_info in self.torrent.info.files]
         self.temp_files = []
+
+        # indices of the files no data is written to, and of those some data was left out of
+        self.skipped_files = set()
+        self.dropped_files = set()
         
     def write_piece(self, piece, data):
         """
@@ -378,6 +1162,11 @@ class DataWriter(object):
         # write the piece to the file and update its state
         data_position_in_temp_file = global_data_position - temp_file_index * self.temp_file_size
         temp_file = self.temp_files[temp_file_index]
+
+        # the temp file was moved early, e.g. when the download finished with files skipped
+        if temp_file.is_deleted:
+            self.write_data_to_download_files(global_data_position, data)
+            return
         
         # TODO: raise error
         # if data_position_in_temp_file + len(data) > temp_file.size:
@@ -389,6 +1178,63 @@ class DataWriter(object):
             self.write_to_download_files(temp_file)
             temp_file.delete()
 
+    def flush(self):
+        """
+        Moves the pieces written to temp files that will not fill up, because some of their
+        pieces are skipped, to the download files
+        """
+
+        for temp_file in self.temp_files:
+            if temp_file is not None and not temp_file.is_deleted:
+                self.write_to_download_files(temp_file)
+                temp_file.delete()
+
+    def read(self, position, length) -> bytes:
+        """
+        Reads verified data at a position in the torrent's data, from the temp files or, once a temp
+        file was moved, from the download files
+        """
+
+        parts = []
+        while length > 0:
+            temp_file_index = position // self.temp_file_size
+            position_in_temp_file = position - temp_file_index * self.temp_file_size
+            if temp_file_index == self.num_temp_files - 1:
+                temp_file_size = self.last_temp_file_size
+            else:
+                temp_file_size = self.temp_file_size
+            part_length = min(length, temp_file_size - position_in_temp_file)
+
+            temp_file = None
+            if temp_file_index < len(self.temp_files):
+                temp_file = self.temp_files[temp_file_index]
+            if temp_file is not None and not temp_file.is_deleted:
+                parts.append(temp_file.read_data(position_in_temp_file, part_length))
+            else:
+                parts.append(self.read_from_download_files(position, part_length))
+
+            position += part_length
+            length -= part_length
+        return b"".join(parts)
+
+    def read_from_download_files(self, position, length) -> bytes:
+        """
+        Reads data at a position in the torrent's data from the download files it spans
+        """
+
+        parts = []
+        file_begin = 0
+        for file_index, file_info in enumerate(self.torrent.info.files):
+            file_end = file_begin + file_info.length
+            if file_end > position and file_begin < position + length:
+                part_begin = max(position, file_begin)
+                part_end = min(position + length, file_end)
+                with open(self.download_filepaths[file_index], 'rb') as f:
+                    f.seek(part_begin - file_begin)
+                    parts.append(f.read(part_end - part_begin))
+            file_begin = file_end
+        return b"".join(parts)
+
     def write_to_download_file(self, filepath, position, data):
         """
         Writes the data at the specified position
@@ -419,40 +1265,36 @@ class DataWriter(object):
 
     def write_to_download_files(self, temp_file):
         """
-        Writes a temp file to actual download files
+        Writes the pieces written to a temp file to actual download files
         """
 
         temp_file_content = temp_file.read()
-
-        # figure out which download files contain the data in this temp file
         data_begin = temp_file.index * self.temp_file_size  # start position in all temp data
-        data_end = data_begin + temp_file.size              # end position + 1 in all temp data
 
-        file_length_sum = 0
+        for position, length in temp_file.get_written_runs():
+            self.write_data_to_download_files(data_begin + position, temp_file_content[position:position + length])
+
+    def write_data_to_download_files(self, position, data):
+        """
+        Writes data at a position in the torrent's data to the download files it spans,
+        leaving out the parts of skipped files
+        """
+
+        data_end = position + len(data)
+        file_begin = 0
         # for each download file
         for file_index, file_info in enumerate(self.torrent.info.files):
-            file_begin = file_length_sum
             file_end = file_begin + file_info.length
-
-            if file_begin >= data_begin and file_begin <= data_end:
-                part_begin_in_data = file_begin - data_begin
-                part_begin_in_file = 0
-            else:
-                part_begin_in_data = 0
-                part_begin_in_file = data_begin - file_begin
-
-            if file_end >= data_begin and file_end <= data_end:
-                part_end_in_data = file_end - data_begin
-                # part_end_in_file = file_end - file_begin
-            else:
-                part_end_in_data = data_end - data_begin
-                # part_end_in_file = data_end - file_begin
-
-            # write the data
-            self.write_to_download_file(self.download_filepaths[file_index], part_begin_in_file,
-                temp_file_content[part_begin_in_data:part_end_in_data])
-            
-            file_length_sum += file_info.length
+            if file_end > position and file_begin < data_end:
+                if file_index in self.skipped_files:
+                    self.dropped_files.add(file_index)
+                    file_begin = file_end
+                    continue
+                part_begin = max(position, file_begin)
+                part_end = min(data_end, file_end)
+                self.write_to_download_file(self.download_filepaths[file_index], part_begin - file_begin,
+                    data[part_begin - position:part_end - position])
+            file_begin = file_end
 
 
 class TempFile(object):
@@ -470,8 +1312,10 @@ class TempFile(object):
         with open(self.filepath, 'wb') as f:
             pass
 
-        # length of written bytes
+        # length of written bytes and where they were written
         self.written = 0
+        self.written_ranges = []
+        self.is_deleted = False
 
     def write_data(self, position, data):
         """
@@ -499,6 +1343,20 @@ class TempFile(object):
             f.write(file_content)
         
         self.written += data_length
+        self.written_ranges.append((position, data_length))
+
+    def get_written_runs(self) -> list:
+        """
+        Returns the written ranges as (position, length), merging adjacent ones
+        """
+
+        runs = []
+        for position, length in sorted(self.written_ranges):
+            if runs and runs[-1][0] + runs[-1][1] == position:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length)
+            else:
+                runs.append((position, length))
+        return runs
 
     def read(self):
         # read the current content to memory
@@ -506,6 +1364,12 @@ class TempFile(object):
             file_content = f.read()
         return file_content
 
+    def read_data(self, position, length):
+        with open(self.filepath, 'rb') as f:
+            f.seek(position)
+            return f.read(length)
+
     def delete(self):
         if os.path.isfile(self.filepath):
-            os.remove(self.filepath)
\ No newline at end of file
+            os.remove(self.filepath)
+        self.is_deleted = True
\ No newline at end of file
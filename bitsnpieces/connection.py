@@ -0,0 +1,174 @@
+import time
+import random
+import asyncio
+
+from .peer import Peer
+
+
+class ConnectionManager(object):
+    """
+    Dials peers from a torrent client's peer database, bounding the number of concurrent
+    dial attempts and backing off exponentially from addresses that fail
+    """
+
+    MAX_CONCURRENT_DIALS = 8
+    BACKOFF_BASE = 5            # in seconds
+    BACKOFF_MAX = 600           # in seconds
+    MAX_FAILURES = 6            # consecutive failures before an address is forgotten
+    MIN_CONNECTED_TIME = 60     # seconds a peer is given before it may be replaced
+    REPLACE_MARGIN = 20         # score a candidate must beat a connected peer by to replace it
+
+    def __init__(self, client, max_concurrent_dials: int=None):
+        # parameters
+        self.client = client
+        self.peer_db = client.peer_db
+        self.max_concurrent_dials = max_concurrent_dials or ConnectionManager.MAX_CONCURRENT_DIALS
+
+        self.dial_semaphore = asyncio.Semaphore(self.max_concurrent_dials)
+
+        # running dial tasks, keyed by (ip, port)
+        self.dial_tasks = {}
+        self.is_closed = False
+
+        # timer that dials again once the earliest backoff expires
+        self.retry_handle = None
+        self.retry_time = None
+
+    def get_backoff(self, failures: int) -> float:
+        """
+        Returns the time to wait before redialling an address after a number of consecutive failures,
+        jittered so that addresses that failed together are not redialled together
+        """
+
+        backoff = min(ConnectionManager.BACKOFF_MAX, ConnectionManager.BACKOFF_BASE * 2 ** (failures - 1))
+        return backoff * random.uniform(0.5, 1.5)
+
+    def get_busy_addresses(self) -> set:
+        """
+        Returns the addresses that are connected or being dialled
+        """
+
+        busy = set(self.client.peers)
+        busy.update(self.dial_tasks)
+        return busy
+
+    def dial_candidates(self):
+        """
+        Starts dialling the best scored peers until the client's peer slots are taken
+        """
+
+        if self.is_closed:
+            return
+
+        busy = self.get_busy_addresses()
+        free_slots = self.client.MAX_PEERS - len(busy)
+        if free_slots > 0:
+            for record in self.peer_db.get_candidates(exclude=busy)[:free_slots]:
+                self.dial(record)
+
+        next_retry = self.peer_db.get_next_attempt(exclude=busy)
+        if next_retry is not None:
+            self.schedule_retry(next_retry)
+
+    def get_peer_score(self, peer, now: float) -> float:
+        """
+        Returns the score of a connected peer using its live download speed
+        """
+
+        record = self.peer_db.get(peer.address)
+        if record is None:
+            return 0
+        return record.score(now, download_speed=peer.download_speed)
+
+    async def replace_peers(self):
+        """
+        Disconnects the worst connected peer if the client has no free slots and the best
+        candidate scores clearly better, freeing the slot for the candidate
+        """
+
+        busy = self.get_busy_addresses()
+        if self.is_closed or len(busy) < self.client.MAX_PEERS:
+            return
+
+        candidates = self.peer_db.get_candidates(exclude=busy)
+        if not candidates:
+            return
+
+        now = time.monotonic()
+        replaceable = [peer for peer in self.client.peers.values()
+            if not peer.inbound and now - peer.connected_time >= ConnectionManager.MIN_CONNECTED_TIME]
+        if not replaceable:
+            return
+
+        worst_peer = min(replaceable, key=lambda peer: self.get_peer_score(peer, now))
+        if candidates[0].score(now) > self.get_peer_score(worst_peer, now) + ConnectionManager.REPLACE_MARGIN:
+            print(f"Replacing peer {worst_peer} with {candidates[0]}")
+            await worst_peer.disconnect()
+
+    def schedule_retry(self, retry_time: float):
+        """
+        Makes sure dial_candidates is called again no later than retry_time
+        """
+
+        if self.retry_handle is not None:
+            if self.retry_time <= retry_time:
+                return
+            self.retry_handle.cancel()
+
+        def retry():
+            self.retry_handle = None
+            self.dial_candidates()
+
+        loop = asyncio.get_running_loop()
+        self.retry_time = retry_time
+        self.retry_handle = loop.call_later(max(0, retry_time - time.monotonic()), retry)
+
+    def dial(self, record):
+        """
+        Starts a task dialling the peer, keeping a handle to it until it is done
+        """
+
+        task = asyncio.create_task(self._dial(record))
+        self.dial_tasks[record.address] = task
+        task.add_done_callback(lambda _: self.dial_tasks.pop(record.address, None))
+        return task
+
+    async def _dial(self, record):
+        async with self.dial_semaphore:
+            peer = Peer(self.client, self.client.torrent, record.ip, record.port)
+            peer.num_hash_failures = record.hash_failures
+            try:
+                success = await peer.connect()
+            except asyncio.CancelledError:
+                await peer.disconnect()
+                raise
+
+        if success:
+            record.failures = 0
+            record.has_succeeded = True
+            self.client.add_peer(peer)
+        else:
+            record.failures += 1
+            if record.failures >= ConnectionManager.MAX_FAILURES:
+                self.peer_db.remove(record.address)
+            else:
+                record.next_attempt = time.monotonic() + self.get_backoff(record.failures)
+            # the slot is free again
+            self.dial_tasks.pop(record.address, None)
+            self.dial_candidates()
+
+    async def close(self):
+        """
+        Cancels all running dial attempts and waits for them to finish
+        """
+
+        self.is_closed = True
+        if self.retry_handle is not None:
+            self.retry_handle.cancel()
+            self.retry_handle = None
+
+        tasks = list(self.dial_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.dial_tasks = {}
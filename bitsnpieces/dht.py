@@ -0,0 +1,636 @@
+import os
+import time
+import heapq
+import random
+import socket
+import struct
+import asyncio
+from collections import OrderedDict
+
+from .bencode import encoder, decoder
+from .utils import sha1
+
+
+class DHTError(Exception):
+    """
+    A KRPC error, received from a node or sent back to one
+    """
+
+    GENERIC = 201
+    SERVER = 202
+    PROTOCOL = 203
+    METHOD_UNKNOWN = 204
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.message = message
+
+
+def distance(a: bytes, b: bytes) -> int:
+    """XOR distance between two node IDs or info hashes"""
+
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+def encode_nodes(nodes) -> bytes:
+    """encodes nodes into the 26 bytes per node compact format, IPv6 nodes are left out"""
+
+    compact = []
+    for node in nodes:
+        try:
+            compact.append(node.node_id + socket.inet_aton(node.ip) + struct.pack('>H', node.port))
+        except OSError:
+            continue
+    return b''.join(compact)
+
+def decode_nodes(data: bytes) -> list:
+    """decodes compact node info into a list of (node_id, ip, port) tuples, a truncated last node is ignored"""
+
+    end = len(data) - len(data) % 26
+    return [(node_id, socket.inet_ntoa(ip), port) for node_id, ip, port in struct.iter_unpack('>20s4sH', data[:end])]
+
+def encode_peer(ip: str, port: int) -> bytes:
+    return socket.inet_aton(ip) + struct.pack('>H', port)
+
+def decode_peers(values: list) -> list:
+    """decodes a list of compact peer infos into (ip, port) tuples, skipping malformed ones"""
+
+    return [(socket.inet_ntoa(value[:4]), struct.unpack('>H', value[4:6])[0])
+        for value in values if isinstance(value, bytes) and len(value) == 6]
+
+
+class Node(object):
+    """
+    A DHT node in the routing table
+    """
+
+    def __init__(self, node_id: bytes, ip: str, port: int):
+        self.node_id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = time.monotonic()
+        self.failures = 0   # consecutive queries it did not answer
+
+    def __repr__(self) -> str:
+        return f"Node({self.node_id.hex()}, {self.ip}:{self.port})"
+
+    @property
+    def address(self) -> tuple:
+        return (self.ip, self.port)
+
+    @property
+    def is_bad(self) -> bool:
+        return self.failures >= RoutingTable.MAX_FAILURES
+
+
+class Bucket(object):
+    """
+    The nodes of the routing table whose IDs fall in [start, end), least recently seen first
+    """
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.nodes = OrderedDict()
+        self.last_changed = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def covers(self, node_id: bytes) -> bool:
+        return self.start <= int.from_bytes(node_id, 'big') < self.end
+
+    def get_random_id(self) -> bytes:
+        return random.randrange(self.start, self.end).to_bytes(20, 'big')
+
+
+class RoutingTable(object):
+    """
+    Kademlia routing table: buckets of at most K nodes each covering a range of the ID space.
+    Only the bucket covering our own ID is split when full, so the table knows many nodes
+    close to us and few far away. A full bucket takes a new node only in place of a bad one.
+    """
+
+    K = 8
+    MAX_FAILURES = 2    # unanswered queries that make a node bad
+    ID_SPACE = 2 ** 160
+
+    def __init__(self, node_id: bytes):
+        self.node_id = node_id
+        self.buckets = [Bucket(0, RoutingTable.ID_SPACE)]
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket.nodes.values()
+
+    def get_bucket(self, node_id: bytes) -> Bucket:
+        for bucket in self.buckets:
+            if bucket.covers(node_id):
+                return bucket
+
+    def get(self, node_id: bytes) -> Node:
+        return self.get_bucket(node_id).nodes.get(node_id)
+
+    def add(self, node_id: bytes, ip: str, port: int) -> Node:
+        """
+        Adds a node that was just seen or marks a known one as seen.
+        Returns None if there was no room for the node.
+        """
+
+        if node_id == self.node_id or len(node_id) != 20:
+            return None
+
+        bucket = self.get_bucket(node_id)
+        node = bucket.nodes.get(node_id)
+        if node is not None:
+            node.ip, node.port = ip, port
+            node.last_seen = time.monotonic()
+            node.failures = 0
+            bucket.nodes.move_to_end(node_id)
+            bucket.last_changed = node.last_seen
+            return node
+
+        while len(bucket) >= RoutingTable.K:
+            if bucket.covers(self.node_id):
+                self.split(bucket)
+                bucket = self.get_bucket(node_id)
+                continue
+
+            # replace the least recently seen bad node
+            bad = next((node for node in bucket.nodes.values() if node.is_bad), None)
+            if bad is None:
+                return None
+            del bucket.nodes[bad.node_id]
+
+        node = Node(node_id, ip, port)
+        bucket.nodes[node_id] = node
+        bucket.last_changed = node.last_seen
+        return node
+
+    def split(self, bucket: Bucket):
+        middle = (bucket.start + bucket.end) // 2
+        lower, upper = Bucket(bucket.start, middle), Bucket(middle, bucket.end)
+        for node_id, node in bucket.nodes.items():
+            (lower if lower.covers(node_id) else upper).nodes[node_id] = node
+        index = self.buckets.index(bucket)
+        self.buckets[index:index + 1] = [lower, upper]
+
+    def remove(self, node_id: bytes):
+        self.get_bucket(node_id).nodes.pop(node_id, None)
+
+    def failed(self, node_id: bytes):
+        """
+        Called when a node did not answer a query
+        """
+
+        node = self.get(node_id)
+        if node is not None:
+            node.failures += 1
+
+    def closest(self, target: bytes, count: int=None) -> list:
+        """
+        Returns the good nodes closest to the target, closest first
+        """
+
+        return heapq.nsmallest(count or RoutingTable.K, (node for node in self if not node.is_bad),
+            key=lambda node: distance(node.node_id, target))
+
+    def get_stale_buckets(self, max_age: float, now: float=None) -> list:
+        if now is None:
+            now = time.monotonic()
+        return [bucket for bucket in self.buckets if now - bucket.last_changed > max_age]
+
+
+class DHTProtocol(asyncio.DatagramProtocol):
+    """
+    Passes queries received by a DHT node to it, and matches responses to the queries waiting
+    for them by transaction ID
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.transport = None
+        self.transactions = {}  # futures keyed by transaction ID
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            message = decoder.decode(data)
+        except (decoder.DecodeError, IndexError, ValueError):
+            return
+        if not isinstance(message, dict):
+            return
+
+        kind = message.get(b'y')
+        if kind == b'q':
+            self.node.handle_query(message, addr[:2])
+        elif kind in (b'r', b'e'):
+            future = self.transactions.pop(message.get(b't'), None)
+            if future is not None and not future.done():
+                future.set_result(message)
+
+    def error_received(self, exc):
+        # an ICMP error for one of many destinations, the query it belongs to times out
+        pass
+
+    def connection_lost(self, exc):
+        for future in self.transactions.values():
+            if not future.done():
+                future.set_exception(ConnectionError("DHT socket closed"))
+        self.transactions = {}
+
+    def expect(self, transaction_id: bytes) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.transactions[transaction_id] = future
+        return future
+
+    def send(self, message: dict, addr):
+        if self.transport is not None:
+            self.transport.sendto(encoder.encode(message), addr)
+
+
+class DHTNode(object):
+    """
+    A Mainline DHT node (BEP 5), IPv4 only. Finds the peers of torrents without a tracker with
+    iterative lookups that query at most ALPHA nodes at a time, and stores the peers other nodes
+    announce to it. The routing table can be saved to a file to bootstrap quickly next time.
+    """
+
+    ALPHA = 3
+    QUERY_TIMEOUT = 2           # in seconds
+    TOKEN_LIFETIME = 300        # in seconds, tokens of the previous secret are accepted too
+    PEER_LIFETIME = 1800        # in seconds, announced peers are forgotten after this
+    MAX_VALUES = 50             # peers in a single get_peers response, to fit a datagram
+    MAX_TORRENTS = 2000         # torrents we store announced peers for
+    REFRESH_INTERVAL = 900      # in seconds, buckets that did not change for this long are refreshed
+    BOOTSTRAP_NODES = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881),
+        ('router.utorrent.com', 6881)]
+
+    def __init__(self, node_id: bytes=None, host: str='0.0.0.0', port: int=6881,
+            bootstrap_nodes: list=None, state_path: str=None):
+        # parameters
+        self.host = host
+        self.port = port
+        self.bootstrap_nodes = DHTNode.BOOTSTRAP_NODES if bootstrap_nodes is None else bootstrap_nodes
+        self.state_path = state_path
+
+        # a saved state brings back our ID along with the routing table
+        saved_nodes = []
+        if state_path is not None and os.path.exists(state_path):
+            node_id, saved_nodes = self.load_state(node_id)
+        self.node_id = node_id or os.urandom(20)
+
+        self.routing_table = RoutingTable(self.node_id)
+        for saved_node in saved_nodes:
+            self.routing_table.add(*saved_node)
+
+        # announced peers keyed by info hash, then by (ip, port) with the time they were announced
+        self.peers = {}
+
+        # the current and the previous secret tokens are made with
+        self.token_secrets = [os.urandom(8), os.urandom(8)]
+        self.token_secret_time = time.monotonic()
+
+        self.next_transaction_id = random.randrange(2 ** 16)
+        self.transport = None
+        self.protocol = None
+        self.task = None
+
+        # set once the first bootstrap is done
+        self.bootstrapped = None
+
+    def load_state(self, node_id: bytes=None):
+        """
+        Returns the node ID (the given one if any) and the routing table nodes of the state file
+        """
+
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = decoder.decode(f.read())
+            saved_id = state[b'id']
+            nodes = decode_nodes(state[b'nodes'])
+        except (OSError, decoder.DecodeError, IndexError, KeyError, TypeError) as e:
+            print(f"Could not load the DHT state: {e!r}")
+            return node_id, []
+
+        if node_id is None and isinstance(saved_id, bytes) and len(saved_id) == 20:
+            node_id = saved_id
+        return node_id, nodes
+
+    def save_state(self):
+        """
+        Saves our ID and the good nodes of the routing table to the state file
+        """
+
+        if self.state_path is None:
+            return
+        state = {b'id': self.node_id, b'nodes': encode_nodes(node for node in self.routing_table if not node.is_bad)}
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(encoder.encode(state))
+        os.replace(temp_path, self.state_path)
+
+    async def start(self):
+        """
+        Starts listening for DHT messages and bootstraps in the background
+        """
+
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await loop.create_datagram_endpoint(lambda: DHTProtocol(self),
+            local_addr=(self.host, self.port))
+
+        # the actual port if port 0 was requested
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self.bootstrapped = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """
+        Stops the node and saves its state
+        """
+
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        try:
+            self.save_state()
+        except OSError as e:
+            print(f"Could not save the DHT state: {e!r}")
+
+    async def run(self):
+        """
+        Bootstraps, then refreshes stale buckets, expires announced peers and saves the state periodically
+        """
+
+        await self.bootstrap()
+        self.bootstrapped.set()
+        while True:
+            await asyncio.sleep(DHTNode.REFRESH_INTERVAL / 3)
+            for bucket in self.routing_table.get_stale_buckets(DHTNode.REFRESH_INTERVAL):
+                await self.find_node(bucket.get_random_id())
+            self.expire_peers()
+            try:
+                self.save_state()
+            except OSError as e:
+                print(f"Could not save the DHT state: {e!r}")
+
+    async def bootstrap(self):
+        """
+        Fills the routing table by looking up our own ID, through the bootstrap nodes if the
+        saved nodes (if any) do not answer
+        """
+
+        if len(self.routing_table) > 0:
+            await self.find_node(self.node_id)
+            if any(not node.is_bad for node in self.routing_table):
+                return
+
+        loop = asyncio.get_running_loop()
+        addresses = []
+        for host, port in self.bootstrap_nodes:
+            try:
+                infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            except OSError as e:
+                print(f"Could not resolve DHT bootstrap node {host}: {e!r}")
+                continue
+            addresses.extend(info[4][:2] for info in infos[:1])
+        await self.lookup(self.node_id, b'find_node', initial=[(None, address) for address in addresses])
+
+    def get_transaction_id(self) -> bytes:
+        while True:
+            self.next_transaction_id = (self.next_transaction_id + 1) % 2 ** 16
+            transaction_id = struct.pack('>H', self.next_transaction_id)
+            if transaction_id not in self.protocol.transactions:
+                return transaction_id
+
+    async def query(self, address: tuple, method: bytes, args: dict, node_id: bytes=None) -> dict:
+        """
+        Sends a query and returns the response arguments. Raises DHTError for an error response and
+        asyncio.TimeoutError if there was no answer, in which case the node (if known) gets a strike.
+        """
+
+        if self.protocol is None:
+            raise ConnectionError("DHT node is not started")
+
+        transaction_id = self.get_transaction_id()
+        future = self.protocol.expect(transaction_id)
+        self.protocol.send({b't': transaction_id, b'y': b'q', b'q': method,
+            b'a': {**args, b'id': self.node_id}}, address)
+        try:
+            message = await asyncio.wait_for(future, DHTNode.QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.protocol.transactions.pop(transaction_id, None)
+            if node_id is not None:
+                self.routing_table.failed(node_id)
+            raise
+
+        if message.get(b'y') == b'e':
+            error = message.get(b'e')
+            if isinstance(error, list) and len(error) == 2 and isinstance(error[1], bytes):
+                raise DHTError(error[0], error[1].decode('utf-8', 'replace'))
+            raise DHTError(DHTError.GENERIC, "malformed error")
+
+        response = message.get(b'r')
+        if not isinstance(response, dict) or not isinstance(response.get(b'id'), bytes):
+            raise DHTError(DHTError.PROTOCOL, "malformed response")
+
+        # nodes that answer are good nodes
+        self.routing_table.add(response[b'id'], *address)
+        return response
+
+    async def lookup(self, target: bytes, method: bytes, initial: list=None):
+        """
+        Iteratively queries the nodes closest to the target with find_node or get_peers, keeping at most
+        ALPHA queries in flight, until the K closest nodes heard of have answered or failed. Returns the
+        closest nodes that answered as (node_id, address, token) tuples, closest first, and the peers found.
+        """
+
+        arg_name = b'target' if method == b'find_node' else b'info_hash'
+        candidates = {}     # addresses keyed by node ID
+        if initial is None:
+            initial = [(node.node_id, node.address) for node in self.routing_table.closest(target)]
+        anonymous = [address for node_id, address in initial if node_id is None]
+        for node_id, address in initial:
+            if node_id is not None:
+                candidates[node_id] = address
+
+        queried, failed = set(), set()
+        answered = {}       # tokens keyed by node ID
+        peers = {}          # peers in the order they were found
+        in_flight = {}
+        try:
+            while True:
+                # nodes without a known ID (bootstrap nodes) are queried first
+                while anonymous and len(in_flight) < DHTNode.ALPHA:
+                    address = anonymous.pop()
+                    in_flight[asyncio.ensure_future(self.query(address, method, {arg_name: target}))] = (None, address)
+
+                closest = heapq.nsmallest(RoutingTable.K, (node_id for node_id in candidates if node_id not in failed),
+                    key=lambda node_id: distance(node_id, target))
+                for node_id in closest:
+                    if len(in_flight) >= DHTNode.ALPHA:
+                        break
+                    if node_id not in queried:
+                        queried.add(node_id)
+                        query = self.query(candidates[node_id], method, {arg_name: target}, node_id=node_id)
+                        in_flight[asyncio.ensure_future(query)] = (node_id, candidates[node_id])
+                if not in_flight:
+                    break
+
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node_id, address = in_flight.pop(task)
+                    try:
+                        response = task.result()
+                    except (DHTError, asyncio.TimeoutError, ConnectionError, OSError):
+                        if node_id is not None:
+                            failed.add(node_id)
+                        continue
+
+                    if node_id is None:
+                        node_id = response[b'id']
+                        candidates[node_id] = address
+                        queried.add(node_id)
+                    answered[node_id] = response.get(b'token')
+
+                    nodes = response.get(b'nodes')
+                    if isinstance(nodes, bytes):
+                        for new_id, ip, port in decode_nodes(nodes):
+                            if new_id != self.node_id and new_id not in candidates and port != 0:
+                                candidates[new_id] = (ip, port)
+                    values = response.get(b'values')
+                    if isinstance(values, list):
+                        for peer in decode_peers(values):
+                            peers[peer] = None
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        closest = heapq.nsmallest(RoutingTable.K, answered, key=lambda node_id: distance(node_id, target))
+        return [(node_id, candidates[node_id], answered[node_id]) for node_id in closest], list(peers)
+
+    async def find_node(self, target: bytes) -> list:
+        """
+        Returns the closest nodes to the target that answered, as (node_id, address, token) tuples
+        """
+
+        nodes, _ = await self.lookup(target, b'find_node')
+        return nodes
+
+    async def get_peers(self, info_hash: bytes) -> list:
+        """
+        Returns the peers of a torrent as (ip, port) tuples
+        """
+
+        _, peers = await self.lookup(info_hash, b'get_peers')
+        return peers
+
+    async def announce_peer(self, info_hash: bytes, port: int) -> list:
+        """
+        Announces that we have peer port open for a torrent to the nodes closest to its info hash.
+        Returns the peers of the torrent found on the way, as (ip, port) tuples.
+        """
+
+        nodes, peers = await self.lookup(info_hash, b'get_peers')
+        announces = [self.query(address, b'announce_peer', {b'info_hash': info_hash, b'port': port, b'token': token},
+            node_id=node_id) for node_id, address, token in nodes if isinstance(token, bytes)]
+        await asyncio.gather(*announces, return_exceptions=True)
+        return peers
+
+    def get_token(self, ip: str, secret: bytes=None) -> bytes:
+        """
+        Returns the token a node at this IP must send back to announce, the secret is rotated
+        every TOKEN_LIFETIME
+        """
+
+        now = time.monotonic()
+        if now - self.token_secret_time > DHTNode.TOKEN_LIFETIME:
+            self.token_secrets = [os.urandom(8), self.token_secrets[0]]
+            self.token_secret_time = now
+        return sha1((secret or self.token_secrets[0]) + ip.encode())[:8]
+
+    def is_valid_token(self, token: bytes, ip: str) -> bool:
+        return any(token == self.get_token(ip, secret) for secret in self.token_secrets)
+
+    def add_peer(self, info_hash: bytes, ip: str, port: int):
+        if info_hash not in self.peers and len(self.peers) >= DHTNode.MAX_TORRENTS:
+            return
+        self.peers.setdefault(info_hash, {})[(ip, port)] = time.monotonic()
+
+    def expire_peers(self, now: float=None):
+        if now is None:
+            now = time.monotonic()
+        for info_hash in list(self.peers):
+            peers = self.peers[info_hash]
+            for address in [address for address, announce_time in peers.items()
+                    if now - announce_time > DHTNode.PEER_LIFETIME]:
+                del peers[address]
+            if not peers:
+                del self.peers[info_hash]
+
+    def handle_query(self, message: dict, address: tuple):
+        """
+        Answers a query received from another node
+        """
+
+        transaction_id = message.get(b't')
+        if not isinstance(transaction_id, bytes):
+            return
+        try:
+            response = self.answer_query(message.get(b'q'), message.get(b'a'), address)
+        except DHTError as e:
+            self.protocol.send({b't': transaction_id, b'y': b'e', b'e': [e.code, e.message.encode()]}, address)
+            return
+        response[b'id'] = self.node_id
+        self.protocol.send({b't': transaction_id, b'y': b'r', b'r': response}, address)
+
+    def answer_query(self, method: bytes, args: dict, address: tuple) -> dict:
+        if not isinstance(args, dict):
+            raise DHTError(DHTError.PROTOCOL, "missing arguments")
+        node_id = args.get(b'id')
+        if not isinstance(node_id, bytes) or len(node_id) != 20:
+            raise DHTError(DHTError.PROTOCOL, "invalid id")
+        if method not in (b'ping', b'find_node', b'get_peers', b'announce_peer'):
+            raise DHTError(DHTError.METHOD_UNKNOWN, "method unknown")
+        ip, port = address
+        self.routing_table.add(node_id, ip, port)
+
+        if method == b'ping':
+            return {}
+
+        if method == b'find_node':
+            target = args.get(b'target')
+            if not isinstance(target, bytes) or len(target) != 20:
+                raise DHTError(DHTError.PROTOCOL, "invalid target")
+            return {b'nodes': encode_nodes(self.routing_table.closest(target))}
+
+        info_hash = args.get(b'info_hash')
+        if not isinstance(info_hash, bytes) or len(info_hash) != 20:
+            raise DHTError(DHTError.PROTOCOL, "invalid info_hash")
+
+        if method == b'get_peers':
+            response = {b'token': self.get_token(ip), b'nodes': encode_nodes(self.routing_table.closest(info_hash))}
+            peers = list(self.peers.get(info_hash, ()))
+            if peers:
+                peers = random.sample(peers, min(len(peers), DHTNode.MAX_VALUES))
+                response[b'values'] = [encode_peer(*peer) for peer in peers]
+            return response
+
+        # announce_peer
+        token = args.get(b'token')
+        if not isinstance(token, bytes) or not self.is_valid_token(token, ip):
+            raise DHTError(DHTError.PROTOCOL, "bad token")
+        peer_port = port if args.get(b'implied_port') else args.get(b'port')
+        if not isinstance(peer_port, int) or not 0 < peer_port < 2 ** 16:
+            raise DHTError(DHTError.PROTOCOL, "invalid port")
+        self.add_peer(info_hash, ip, peer_port)
+        return {}
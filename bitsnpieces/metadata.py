@@ -0,0 +1,473 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+
+from .bencode import encoder, decoder
+from .peer import Peer, PeerError, Handshake, Extended, PeerStreamIterator, read_handshake
+from .tracker import TrackerList
+from .utils import sha1
+
+
+# the metadata is exchanged in pieces of this length, only the last one may be shorter (BEP 9)
+PIECE_LENGTH = 16384
+
+MSG_REQUEST = 0
+MSG_DATA = 1
+MSG_REJECT = 2
+
+def get_num_pieces(metadata_size: int) -> int:
+    """returns the number of ut_metadata pieces of metadata of the size"""
+
+    return -(-metadata_size // PIECE_LENGTH)
+
+def encode_message(msg_type: int, piece: int, data: bytes=b'', total_size: int=None) -> bytes:
+    """encodes a ut_metadata message, the data of a piece follows its dictionary"""
+
+    message = {b'msg_type': msg_type, b'piece': piece}
+    if total_size is not None:
+        message[b'total_size'] = total_size
+    return encoder.encode(message) + data
+
+def decode_message(payload: bytes) -> tuple:
+    """decodes a ut_metadata message into its dictionary and the data after it, None if it is invalid"""
+
+    try:
+        message, length = decoder.decode(payload, retlen=True)
+    except (decoder.DecodeError, IndexError, ValueError):
+        return None
+    if (not isinstance(message, dict) or not isinstance(message.get(b'msg_type'), int)
+            or not isinstance(message.get(b'piece'), int)):
+        return None
+    return message, payload[length:]
+
+
+class MetadataCache(object):
+    """
+    Verified metadata keyed by info hash. It is kept in memory and, if a directory is given, on disk
+    too, so starting from a magnet link again needs no peers.
+    """
+
+    def __init__(self, directory: str=None):
+        self.directory = directory
+        self.metadata = {}
+
+    def get_path(self, info_hash: bytes) -> str:
+        return os.path.join(self.directory, info_hash.hex())
+
+    def get(self, info_hash: bytes) -> bytes:
+        """
+        Returns the metadata of the info hash, None if it is not cached or no longer matches its hash
+        """
+
+        metadata = self.metadata.get(info_hash)
+        if metadata is None and self.directory is not None:
+            try:
+                with open(self.get_path(info_hash), 'rb') as f:
+                    metadata = f.read()
+            except OSError:
+                return None
+            if sha1(metadata) != info_hash:
+                return None
+            self.metadata[info_hash] = metadata
+        return metadata
+
+    def put(self, info_hash: bytes, metadata: bytes):
+        self.metadata[info_hash] = metadata
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(info_hash)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(metadata)
+        os.replace(temp_path, path)
+
+
+class MetadataExchange(object):
+    """
+    Metadata exchange (BEP 9) for a single torrent client: answers the ut_metadata requests of peers
+    that started from a magnet link with the pieces of our info dictionary.
+    """
+
+    def __init__(self, client):
+        # parameters
+        self.client = client
+
+        self.metadata = client.torrent.info.encode()
+
+        # statistics
+        self.num_pieces_sent = 0
+
+    @property
+    def metadata_size(self) -> int:
+        return len(self.metadata)
+
+    async def handle_message(self, peer, payload: bytes):
+        """
+        Sends the piece a peer requested, or rejects the request if there is no such piece
+        """
+
+        extended_id = peer.extension_ids.get(b'ut_metadata')
+        decoded = decode_message(payload)
+        if not extended_id or decoded is None:
+            return
+        message, _ = decoded
+        if message[b'msg_type'] != MSG_REQUEST:
+            return
+
+        piece = message[b'piece']
+        if 0 <= piece < get_num_pieces(self.metadata_size):
+            data = self.metadata[piece * PIECE_LENGTH:(piece + 1) * PIECE_LENGTH]
+            response = encode_message(MSG_DATA, piece, data, self.metadata_size)
+            self.num_pieces_sent += 1
+        else:
+            response = encode_message(MSG_REJECT, piece)
+        try:
+            await peer.send(Extended(extended_id, response))
+        except (ConnectionError, OSError):
+            await peer.disconnect()
+
+
+class MetadataFetcher(object):
+    """
+    Fetches the metadata of a magnet link with ut_metadata (BEP 9). Peers come from the magnet link,
+    its trackers and the DHT. Several peers are asked at once, each for pieces the others have not
+    been asked for, and the pieces are verified together against the info hash.
+    """
+
+    MAX_PEERS = 8                       # peers fetched from at once
+    MAX_REQUESTS = 2                    # outstanding piece requests per peer
+    MAX_METADATA_SIZE = 8 * 1024 * 1024
+    CONNECT_TIMEOUT = 10
+    HANDSHAKE_TIMEOUT = 10
+    READ_TIMEOUT = 15                   # give up on a peer that sends nothing for this long
+    SEARCH_INTERVAL = 30                # look for more peers this often until the metadata arrives
+    BACKOFF_BASE = 5                    # in seconds
+    BACKOFF_MAX = 300                   # in seconds
+
+    def __init__(self, magnet, peer_id: bytes, port: int=None, dht=None, http_session=None, cache=None):
+        # parameters
+        self.magnet = magnet
+        self.info_hash = magnet.info_hash
+        self.peer_id = peer_id
+        self.port = port
+        self.dht = dht
+        self.http_session = http_session
+        self.cache = cache
+
+        # peers to fetch from and the ones queued or being fetched from, the ones that failed and when
+        # they may be tried again, and the ones that sent bad pieces or a wrong size
+        self.addresses = deque()
+        self.busy = set()
+        self.failures = {}
+        self.next_attempt = {}
+        self.bad = set()
+        self.wakeup = None
+
+        # the pieces received so far and who sent them, and the peers each missing piece was asked for
+        self.metadata_size = None
+        self.metadata_size_sender = None
+        self.pieces = {}
+        self.piece_senders = {}
+        self.requested = {}
+
+        self.metadata = None
+
+    def get_backoff(self, failures: int) -> float:
+        """
+        Returns the time to wait before trying a peer again after a number of consecutive failures,
+        jittered so that peers that failed together are not tried again together
+        """
+
+        backoff = min(MetadataFetcher.BACKOFF_MAX, MetadataFetcher.BACKOFF_BASE * 2 ** (failures - 1))
+        return backoff * random.uniform(0.5, 1.5)
+
+    def add_peers(self, peers):
+        """
+        Queues peers to fetch from, except the ones already queued, backing off or known to be bad
+        """
+
+        now = time.monotonic()
+        for address in peers:
+            address = tuple(address)
+            if address in self.busy or address in self.bad or self.next_attempt.get(address, now) > now:
+                continue
+            self.next_attempt.pop(address, None)
+            self.busy.add(address)
+            self.addresses.append(address)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def peer_failed(self, address):
+        """
+        Backs off from a peer that did not get us the metadata, it may not have it yet
+        """
+
+        self.busy.discard(address)
+        if address in self.bad or self.metadata is not None:
+            return
+        self.failures[address] = self.failures.get(address, 0) + 1
+        self.next_attempt[address] = time.monotonic() + self.get_backoff(self.failures[address])
+
+    def add_bad_peers(self, addresses):
+        """
+        Never asks the peers again, they sent bad pieces or a wrong metadata size
+        """
+
+        for address in addresses:
+            self.bad.add(address)
+            self.failures.pop(address, None)
+            self.next_attempt.pop(address, None)
+
+    def get_next_attempt(self) -> float:
+        """
+        Returns the earliest time a peer that failed may be tried again, None if no peer waits for it
+        """
+
+        return min((attempt for address, attempt in self.next_attempt.items() if address not in self.bad),
+            default=None)
+
+    def set_metadata_size(self, size, address) -> bool:
+        """
+        Takes the metadata size a peer told us, returns False if it is invalid or does not match the
+        size other peers told us
+        """
+
+        if not isinstance(size, int) or not 0 < size <= MetadataFetcher.MAX_METADATA_SIZE:
+            return False
+        if self.metadata_size is None:
+            self.metadata_size = size
+            self.metadata_size_sender = address
+        return size == self.metadata_size
+
+    def get_piece_length(self, piece: int) -> int:
+        return min(PIECE_LENGTH, self.metadata_size - piece * PIECE_LENGTH)
+
+    def get_next_piece(self, address):
+        """
+        Returns the first piece that is neither received nor requested and marks it requested from
+        the peer. Once every missing piece is requested, a piece the peer was not asked for is
+        requested again, so a slow peer does not hold up the others. Returns None if there is no
+        such piece.
+        """
+
+        if self.metadata_size is None:
+            return None
+        missing = [piece for piece in range(get_num_pieces(self.metadata_size)) if piece not in self.pieces]
+        free = [piece for piece in missing if not self.requested.get(piece)]
+        for piece in free or missing:
+            requested_from = self.requested.setdefault(piece, set())
+            if address not in requested_from:
+                requested_from.add(address)
+                return piece
+        return None
+
+    def release_pieces(self, address):
+        """
+        Gives the pieces requested from a peer back to the others
+        """
+
+        for requested_from in self.requested.values():
+            requested_from.discard(address)
+
+    def add_piece(self, piece: int, data: bytes, address) -> bool:
+        """
+        Stores a piece a peer sent, and verifies the metadata once every piece is there. If it does
+        not match the info hash, the peers that sent pieces or the metadata size are not asked again
+        and the metadata is fetched from scratch, size included. Returns False if the piece is invalid.
+        """
+
+        if self.metadata_size is None:
+            return False
+        if (not 0 <= piece < get_num_pieces(self.metadata_size) or len(data) != self.get_piece_length(piece)
+                or address not in self.requested.get(piece, ())):
+            return False
+        self.requested[piece].discard(address)
+        if piece in self.pieces:
+            # a piece that was requested from several peers
+            return True
+        self.pieces[piece] = data
+        self.piece_senders[piece] = address
+
+        if len(self.pieces) == get_num_pieces(self.metadata_size):
+            metadata = b''.join(self.pieces[piece] for piece in range(len(self.pieces)))
+            if sha1(metadata) == self.info_hash:
+                self.metadata = metadata
+            else:
+                print(f"Metadata of {self.info_hash.hex()} failed verification")
+                self.add_bad_peers([*self.piece_senders.values(), self.metadata_size_sender])
+                self.metadata_size = None
+                self.metadata_size_sender = None
+                self.pieces = {}
+                self.piece_senders = {}
+                self.requested = {}
+            if self.wakeup is not None:
+                self.wakeup.set()
+        return True
+
+    async def find_peers(self):
+        """
+        Asks the trackers of the magnet link and the DHT for peers of the torrent, again every
+        SEARCH_INTERVAL seconds
+        """
+
+        tracker = TrackerList(self.magnet.to_torrent(), http_session=self.http_session) if self.magnet.trackers else None
+        try:
+            while True:
+                searches = []
+                if tracker is not None:
+                    searches.append(tracker.announce(self.peer_id, self.port or 6881, 0, 0,
+                        on_response=self.on_tracker_response))
+                if self.dht is not None:
+                    searches.append(self.dht.get_peers(self.info_hash))
+                for search in asyncio.as_completed(searches):
+                    try:
+                        peers = await search
+                    except ConnectionError:
+                        continue
+                    if isinstance(peers, list):
+                        self.add_peers(peers)
+                await asyncio.sleep(MetadataFetcher.SEARCH_INTERVAL)
+        finally:
+            if tracker is not None:
+                await tracker.close()
+
+    async def on_tracker_response(self, response):
+        self.add_peers(response.peers or [])
+
+    async def next_message(self, messages):
+        async for message in messages:
+            return message
+        raise ConnectionError("connection closed by peer")
+
+    async def exchange(self, reader, writer, address):
+        """
+        Handshakes with a peer that supports the extension protocol and requests metadata pieces from
+        it until the metadata is complete, the peer has no pieces left to send or it goes quiet
+        """
+
+        writer.write(Handshake(self.info_hash, self.peer_id,
+            Handshake.make_reserved_bytes(Handshake.EXTENSION_PROTOCOL_BIT)).encode())
+        handshake, buffer = await asyncio.wait_for(read_handshake(reader), MetadataFetcher.HANDSHAKE_TIMEOUT)
+        if handshake.info_hash != self.info_hash or not handshake.has_reserved_bit(Handshake.EXTENSION_PROTOCOL_BIT):
+            return
+        our_id = Peer.EXTENSIONS[b'ut_metadata']
+        writer.write(Extended(Extended.HANDSHAKE_ID, encoder.encode({b'm': {b'ut_metadata': our_id}})).encode())
+        await writer.drain()
+
+        messages = PeerStreamIterator(reader, buffer)
+        metadata_id = None
+        metadata_size = None
+        requested = set()
+        while self.metadata is None:
+            message = await asyncio.wait_for(self.next_message(messages), MetadataFetcher.READ_TIMEOUT)
+            if not isinstance(message, Extended):
+                continue
+
+            if message.extended_id == Extended.HANDSHAKE_ID:
+                try:
+                    extension_handshake = decoder.decode(message.payload)
+                except (decoder.DecodeError, IndexError, ValueError):
+                    return
+                if not isinstance(extension_handshake, dict) or not isinstance(extension_handshake.get(b'm'), dict):
+                    return
+                metadata_id = extension_handshake[b'm'].get(b'ut_metadata')
+                metadata_size = extension_handshake.get(b'metadata_size')
+                if (not isinstance(metadata_id, int) or metadata_id <= 0
+                        or not self.set_metadata_size(metadata_size, address)):
+                    return
+            elif message.extended_id == our_id and metadata_id is not None:
+                decoded = decode_message(message.payload)
+                if decoded is None:
+                    return
+                response, data = decoded
+                if response[b'msg_type'] != MSG_DATA or response[b'piece'] not in requested:
+                    # a peer that rejects a request does not have the metadata (yet)
+                    return
+                requested.discard(response[b'piece'])
+                if self.metadata_size is None:
+                    # the metadata failed verification while the piece was on its way, start over
+                    if not self.set_metadata_size(metadata_size, address):
+                        return
+                elif not self.add_piece(response[b'piece'], data, address):
+                    return
+                if address in self.bad:
+                    return
+            else:
+                continue
+
+            # keep a few requests outstanding
+            while self.metadata is None and len(requested) < MetadataFetcher.MAX_REQUESTS:
+                piece = self.get_next_piece(address)
+                if piece is None:
+                    break
+                requested.add(piece)
+                writer.write(Extended(metadata_id, encode_message(MSG_REQUEST, piece)).encode())
+            if not requested:
+                return
+            await writer.drain()
+
+    async def fetch_from(self, address):
+        """
+        Fetches metadata pieces from a single peer
+        """
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*address),
+                MetadataFetcher.CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            self.peer_failed(address)
+            self.wakeup.set()
+            return
+
+        try:
+            await self.exchange(reader, writer, address)
+        except (ConnectionError, OSError, asyncio.TimeoutError, PeerError):
+            pass
+        finally:
+            self.release_pieces(address)
+            self.peer_failed(address)
+            writer.close()
+            self.wakeup.set()
+
+    async def fetch(self) -> bytes:
+        """
+        Returns the verified metadata, the cached one if there is one. Runs until the metadata arrives,
+        a caller that wants to give up cancels it.
+        """
+
+        if self.cache is not None:
+            metadata = self.cache.get(self.info_hash)
+            if metadata is not None:
+                return metadata
+
+        self.wakeup = asyncio.Event()
+        self.add_peers(self.magnet.peers)
+        search = asyncio.create_task(self.find_peers())
+        workers = set()
+        try:
+            while self.metadata is None:
+                # peers whose backoff is over are tried again, whether or not the search finds them again
+                now = time.monotonic()
+                self.add_peers([address for address, attempt in self.next_attempt.items() if attempt <= now])
+                workers = {worker for worker in workers if not worker.done()}
+                while self.addresses and len(workers) < MetadataFetcher.MAX_PEERS:
+                    workers.add(asyncio.create_task(self.fetch_from(self.addresses.popleft())))
+                self.wakeup.clear()
+                next_attempt = self.get_next_attempt()
+                timeout = None if next_attempt is None else max(0, next_attempt - time.monotonic())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            tasks = [search, *workers]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.cache is not None:
+            self.cache.put(self.info_hash, self.metadata)
+        return self.metadata
@@ -1,11 +1,37 @@
+import time
 import struct
 import asyncio
-from bitstring import BitArray
+from collections import deque
+
+from . import __version__
+from .bitfield import Bitfield
+from .bencode import encoder, decoder
 
 
 class PeerError(Exception):
     pass
 
+
+async def read_handshake(reader, buffer: bytes=b""):
+    """
+    Reads a handshake message from the stream reader. Returns the decoded handshake and any bytes
+    received after it. Raises PeerError if the stream ends before a full handshake arrives.
+    """
+
+    while True:
+        if buffer:
+            handshake_length = 49 + buffer[0]
+            if len(buffer) >= handshake_length:
+                handshake = Handshake.decode(buffer[:handshake_length])
+                if handshake is None:
+                    raise PeerError("received an invalid handshake")
+                return handshake, buffer[handshake_length:]
+        data = await reader.read(Peer.CHUNK_SIZE)
+        if not data:
+            raise PeerError("connection closed before handshake was received")
+        buffer += data
+
+
 class Peer(object):
     """
     Represents a TCP connection to a peer and its last updated state,
@@ -14,17 +40,29 @@ class Peer(object):
     
     CHUNK_SIZE = 10240
     CONNECT_TIMEOUT = 60
+    HANDSHAKE_TIMEOUT = 10
     READ_TIMEOUT = 3
     REQUEST_DELAY_AFTER_BLOCK = 0.1
     REQUEST_DELAY_NO_BLOCK = 3
-
-    def __init__(self, client, torrent, ip, port, peer_id=None):
+    KEEP_ALIVE_INTERVAL = 120       # send a keep-alive if nothing was sent for this long
+    IDLE_TIMEOUT = 180              # drop the connection if nothing was received for this long
+    SNUB_TIMEOUT = 60               # drop the peer if it sends no block for this long while unchoking us
+    REQUEST_TIMEOUT = 30            # give a requested block to other peers if it does not arrive in time
+    TIMEOUT_CHECK_INTERVAL = 10
+    MAX_ALLOWED_FAST = 32           # pieces a peer may let us download while it chokes us
+    MAX_SUGGESTED_PIECES = 16       # latest pieces a peer suggested that are remembered
+
+    # our extended message IDs, keyed by extension name (BEP 10)
+    EXTENSIONS = {b'ut_pex': 1, b'ut_metadata': 2}
+
+    def __init__(self, client, torrent, ip, port, peer_id=None, inbound=False):
         # parameters
         self.client = client
         self.torrent = torrent
         self.ip = ip
         self.port = port
         self.peer_id = peer_id
+        self.inbound = inbound
         
         # peer state
         self.is_connected = False
@@ -32,8 +70,45 @@ class Peer(object):
         self.am_interested = False
         self.peer_choking = True
         self.peer_interested = False
-        self.pieces_bitarray = BitArray(self.torrent.info.num_pieces)
-        self.pieces_downloading = []
+        self.pieces_bitfield = Bitfield(self.torrent.info.num_pieces)
+        self.pieces_downloading = set()
+
+        # number of pieces the peer has that we want but do not have yet
+        self.num_wanted_pieces = 0
+
+        # download metrics
+        self.connected_time = None
+        self.downloaded = 0
+
+        # activity times used for keep-alives and timeouts
+        self.last_received = None
+        self.last_sent = None
+        self.last_block_time = None
+        self.timeout_timer = None
+
+        # deadline timers of outstanding block requests keyed by (index, begin)
+        self.outstanding_requests = {}
+        self.num_request_timeouts = 0
+
+        # failed pieces the peer sent blocks of
+        self.num_hash_failures = 0
+
+        # Fast Extension (BEP 6): the pieces the peer lets us request while it chokes us and the
+        # pieces it suggests, most likely the ones it has cached
+        self.supports_fast = False
+        self.allowed_fast = set()
+        self.suggested_pieces = deque(maxlen=Peer.MAX_SUGGESTED_PIECES)
+        self.num_rejected_requests = 0
+
+        # extension protocol (BEP 10): the peer's extended message IDs keyed by extension name,
+        # and the port it listens on, which an inbound peer only tells us in its extension handshake
+        self.supports_extensions = False
+        self.extension_ids = {}
+        self.listen_port = None if inbound else port
+
+        # peer exchange: the addresses we told the peer about
+        self.pex_sent = set()
+        self.last_pex_received = None
 
         # connection streams
         self.reader = None
@@ -42,19 +117,19 @@ class Peer(object):
 
         self.communication_task = None
     
-    async def connect(self):
+    async def connect(self) -> bool:
         """
-        Opens a TCP connection to this peer and performs a handshake
+        Opens a TCP connection to this peer and performs a handshake.
+        Makes a single attempt and returns whether it succeeded, retrying is left to the caller.
         """
 
         # connect
-        while not self.is_connected:
-            try:
-                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port),
-                    Peer.CONNECT_TIMEOUT)
-                self.is_connected = True
-            except:
-                continue
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port),
+                Peer.CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        self.is_connected = True
 
         # initialize buffer
         self.buffer = b""
@@ -63,7 +138,57 @@ class Peer(object):
         handshake_success = await self.handshake()
         if handshake_success:
             print(f"Connected to and handshaked peer {self}")
+            self.connected_time = time.monotonic()
             self.communication_task = asyncio.create_task(self.start_communication())
+        return handshake_success
+
+    async def accept(self, reader, writer, handshake, buffer: bytes=b"") -> bool:
+        """
+        Takes over an inbound connection whose handshake has already been received, replies with
+        our own handshake and starts communicating. Returns False if our handshake could not be sent.
+        """
+
+        self.reader = reader
+        self.writer = writer
+        self.is_connected = True
+        self.peer_id = handshake.peer_id
+        self.supports_extensions = handshake.has_reserved_bit(Handshake.EXTENSION_PROTOCOL_BIT)
+        self.supports_fast = handshake.has_reserved_bit(Handshake.FAST_EXTENSION_BIT)
+        self.buffer = buffer
+        self.connected_time = time.monotonic()
+
+        try:
+            await self.send(self.make_handshake())
+        except (ConnectionError, OSError):
+            await self.disconnect()
+            return False
+        print(f"Accepted and handshaked peer {self}")
+        self.communication_task = asyncio.create_task(self.start_communication())
+        return True
+
+    @property
+    def address(self) -> tuple:
+        return (self.ip, self.port)
+
+    @property
+    def listen_address(self) -> tuple:
+        """
+        The address other peers can connect to the peer at, None if unknown
+        """
+
+        if self.listen_port is None:
+            return None
+        return (self.ip, self.listen_port)
+
+    @property
+    def download_speed(self) -> float:
+        """
+        Average download speed since the connection was made in bytes per second
+        """
+
+        if self.connected_time is None:
+            return 0
+        return self.downloaded / max(1, time.monotonic() - self.connected_time)
 
     async def write(self, data) -> bytes:
         """
@@ -71,6 +196,7 @@ class Peer(object):
         """
 
         self.writer.write(data)
+        self.last_sent = time.monotonic()
         await self.writer.drain()
     
     async def read(self) -> bytes:
@@ -100,6 +226,14 @@ class Peer(object):
         data = message.encode()
         await self.write(data)
     
+    def make_handshake(self):
+        """
+        Returns our handshake, with the reserved bits of the extensions we support set
+        """
+
+        return Handshake(self.torrent.info.get_sha1(), self.client.peer_id,
+            Handshake.make_reserved_bytes(Handshake.EXTENSION_PROTOCOL_BIT, Handshake.FAST_EXTENSION_BIT))
+
     async def handshake(self):
         """
         Send a handshake then receive and decode the response and return the message length
@@ -110,19 +244,12 @@ class Peer(object):
 
         # send handshake
         try:
-            handshake = Handshake(info_hash, self.client.peer_id)
+            handshake = self.make_handshake()
             await self.send(handshake)
             
             # receive and decode handshake
-            response_handshake = None
-            while response_handshake is None:
-                # TODO: timeout or stop when buffer exceeds certain length
-                data = await self.read()
-                if data:
-                    self.buffer += data
-                    pstrlen = struct.unpack('>b', data[0:1])[0]
-                    if len(data) >= 49+pstrlen:
-                        response_handshake = Handshake.decode(data[:49+pstrlen])
+            response_handshake, self.buffer = await asyncio.wait_for(
+                read_handshake(self.reader, self.buffer), Peer.HANDSHAKE_TIMEOUT)
 
             # store peer ID
             self.peer_id = response_handshake.peer_id
@@ -131,11 +258,11 @@ class Peer(object):
             # validate handshake
             if response_handshake.info_hash != info_hash:
                 raise PeerError("torrent hash and handshake response hash are not the same")
+            self.supports_extensions = response_handshake.has_reserved_bit(Handshake.EXTENSION_PROTOCOL_BIT)
+            self.supports_fast = response_handshake.has_reserved_bit(Handshake.FAST_EXTENSION_BIT)
 
-            msg_len = len(response_handshake)
-            self.buffer = self.buffer[msg_len:]
             return True
-        except (ConnectionRefusedError, ConnectionResetError):
+        except (ConnectionError, OSError, asyncio.TimeoutError, PeerError):
             await self.disconnect()
         
         return False
@@ -145,62 +272,329 @@ class Peer(object):
         Start sending and receiving messages to and from peer (after handshake)
         """
 
+        now = time.monotonic()
+        self.last_received = now
+        self.last_block_time = now
+        self.schedule_timeout_check()
+
         try:
-            # send an interested message
-            await self.send(Interested())
-            self.am_interested = True
+            await self.send_pieces()
+            await self.send_extension_handshake()
 
+            # interest is sent once the peer tells us which pieces it has
             await asyncio.gather(self.start_receiving(), self.start_sending())
-        except ConnectionResetError:
+        except (ConnectionError, OSError):
             # TODO: send a cancel for the currently requested block
+            pass
+        if self.is_connected:
             await self.disconnect()
 
+    def schedule_timeout_check(self):
+        """
+        Schedules the next keep-alive and timeout check on the client's timer wheel
+        """
+
+        self.timeout_timer = self.client.timer_wheel.schedule(Peer.TIMEOUT_CHECK_INTERVAL,
+            self.check_timeouts)
+
+    def is_snubbed(self, now: float) -> bool:
+        """
+        Returns True if the peer unchoked us and has outstanding requests but sent no block recently
+        """
+
+        return (not self.peer_choking and len(self.outstanding_requests) > 0
+            and now - self.last_block_time > Peer.SNUB_TIMEOUT)
+
+    async def check_timeouts(self):
+        """
+        Drops idle and snubbing connections and sends a keep-alive when we have been quiet for too long
+        """
+
+        if not self.is_connected:
+            return
+
+        now = time.monotonic()
+        if now - self.last_received > Peer.IDLE_TIMEOUT:
+            print(f"Peer {self} timed out")
+            await self.disconnect()
+            return
+        if self.is_snubbed(now):
+            print(f"Peer {self} is snubbing us")
+            await self.disconnect()
+            return
+
+        if now - self.last_sent > Peer.KEEP_ALIVE_INTERVAL:
+            try:
+                await self.send(KeepAlive())
+            except (ConnectionError, OSError):
+                await self.disconnect()
+                return
+        self.schedule_timeout_check()
+
+    async def update_interest(self):
+        """
+        Sends Interested or NotInterested when our interest in the peer changes. Near the end of
+        the download, a peer that has nothing we want and wants nothing from us is dropped.
+        """
+
+        interested = self.num_wanted_pieces > 0
+        if interested != self.am_interested:
+            self.am_interested = interested
+            await self.send(Interested() if interested else NotInterested())
+
+        if not interested and not self.peer_interested and self.client.piece_manager.is_near_end:
+            print(f"Dropping peer {self}, it has no pieces we need")
+            await self.disconnect()
+
+    async def send_request(self, request):
+        """
+        Sends a block request with a deadline, the block is given back to other peers if it
+        does not arrive in time
+        """
+
+        key = (request.index, request.begin)
+        self.outstanding_requests[key] = self.client.timer_wheel.schedule(Peer.REQUEST_TIMEOUT,
+            lambda: self.expire_request(request))
+        await self.send(request)
+
+    def complete_request(self, index, begin):
+        """
+        Called when a requested block arrives, stops its deadline timer
+        """
+
+        timer = self.outstanding_requests.pop((index, begin), None)
+        if timer is not None:
+            self.client.timer_wheel.cancel(timer)
+
+    async def expire_request(self, request):
+        """
+        Called when a request misses its deadline, gives the block back and cancels the request
+        """
+
+        if self.outstanding_requests.pop((request.index, request.begin), None) is None:
+            return
+        self.num_request_timeouts += 1
+        self.client.piece_manager.release_request(self, request, timed_out=True)
+
+        if self.is_connected:
+            try:
+                await self.send(Cancel(request.index, request.begin, request.length))
+            except (ConnectionError, OSError):
+                await self.disconnect()
+
+    async def cancel_request(self, request):
+        """
+        Cancels an outstanding request whose block arrived from another peer
+        """
+
+        timer = self.outstanding_requests.pop((request.index, request.begin), None)
+        if timer is None:
+            return
+        self.client.timer_wheel.cancel(timer)
+
+        if self.is_connected:
+            try:
+                await self.send(Cancel(request.index, request.begin, request.length))
+            except (ConnectionError, OSError):
+                await self.disconnect()
+
+    def reject_request(self, request):
+        """
+        Called when the peer will not send a block we requested, gives the block back to other peers
+        at once instead of waiting for its deadline
+        """
+
+        timer = self.outstanding_requests.pop((request.index, request.begin), None)
+        if timer is None:
+            return
+        self.client.timer_wheel.cancel(timer)
+        self.num_rejected_requests += 1
+        self.client.piece_manager.release_request(self, request)
+
+    async def request_block(self):
+        """
+        Requests the next block from the peer if it lets us: any piece once it unchokes us, only
+        the pieces it allows fast while it chokes us
+        """
+
+        if not self.am_interested:
+            return
+        if not self.peer_choking:
+            request = self.client.piece_manager.get_next_request(self)
+        elif self.allowed_fast:
+            request = self.client.piece_manager.get_allowed_fast_request(self)
+        else:
+            return
+        if request is not None:
+            await self.send_request(request)
+
+    async def ban(self):
+        """
+        Disconnects from the peer for good, e.g. after it sent corrupt data
+        """
+
+        print(f"Banning peer {self}")
+        await self.disconnect()
+        self.client.peer_db.ban(self.ip)
+
+    async def send_pieces(self):
+        """
+        Tells the peer which pieces we have. A peer that supports the Fast Extension is told we have
+        all or none of them in a single byte instead of a bitfield.
+        """
+
+        have = self.client.piece_manager.have
+        if self.supports_fast and have.all():
+            await self.send(HaveAll())
+        elif self.supports_fast and not have.any():
+            await self.send(HaveNone())
+        elif have.any():
+            await self.send(BitField(have))
+
+    async def set_pieces(self, bitfield):
+        """
+        Replaces the pieces the peer has, e.g. with the bitfield it sent after the handshake
+        """
+
+        piece_manager = self.client.piece_manager
+        piece_manager.remove_peer_pieces(self.pieces_bitfield)
+        self.pieces_bitfield = bitfield
+        piece_manager.add_peer_pieces(self.pieces_bitfield)
+        self.num_wanted_pieces = piece_manager.count_wanted_pieces(self.pieces_bitfield)
+        await self.update_interest()
+
+    async def send_extension_handshake(self):
+        """
+        Tells a peer that supports the extension protocol which extensions we support and their message IDs
+        """
+
+        if not self.supports_extensions:
+            return
+        handshake = {b'm': Peer.EXTENSIONS, b'v': f"Bits 'n' Pieces {__version__}".encode()}
+        if self.client.port is not None:
+            handshake[b'p'] = self.client.port
+        handshake[b'metadata_size'] = self.client.metadata_exchange.metadata_size
+        await self.send(Extended(Extended.HANDSHAKE_ID, encoder.encode(handshake)))
+
+    async def handle_extended(self, message):
+        """
+        Consumes an extended message: the peer's extension handshake, or a message of one of our extensions
+        """
+
+        if message.extended_id == Extended.HANDSHAKE_ID:
+            try:
+                handshake = decoder.decode(message.payload)
+            except (decoder.DecodeError, IndexError, ValueError):
+                return
+            if not isinstance(handshake, dict):
+                return
+
+            # extensions are added, changed or disabled (with ID 0) by later handshakes too
+            extension_ids = handshake.get(b'm')
+            if isinstance(extension_ids, dict):
+                for name, extended_id in extension_ids.items():
+                    if not isinstance(extended_id, int):
+                        continue
+                    if extended_id > 0:
+                        self.extension_ids[name] = extended_id
+                    else:
+                        self.extension_ids.pop(name, None)
+            listen_port = handshake.get(b'p')
+            if isinstance(listen_port, int) and 0 < listen_port < 2 ** 16:
+                self.listen_port = listen_port
+        elif message.extended_id == Peer.EXTENSIONS[b'ut_pex']:
+            await self.client.peer_exchange.handle_message(self, message.payload)
+        elif message.extended_id == Peer.EXTENSIONS[b'ut_metadata']:
+            await self.client.metadata_exchange.handle_message(self, message.payload)
+
     async def start_receiving(self):
         """
         Start receiving messages from peer (after handshake and interested)
         """
 
-        while self.is_connected:
-            # print("Receiving?")
-            stream_iterator = PeerStreamIterator(self.reader, self.buffer)
-
-            async for message in stream_iterator:
-                # TODO: use logging instead
-                # print(f"Received {message} from {self}")
-
-                # consume message and change client and peer status
-                if isinstance(message, KeepAlive):
-                    # TODO: make a timeout for inactive connections and break the timeout here
-                    pass
-                elif isinstance(message, Choke):
-                    self.peer_choking = True
-                elif isinstance(message, Unchoke):
-                    self.peer_choking = False
-                elif isinstance(message, Interested):
-                    self.peer_interested = True
-                elif isinstance(message, NotInterested):
-                    self.peer_interested = False
-                elif isinstance(message, BitField):
-                    self.pieces_bitarray = message.bitfield[:len(self.pieces_bitarray)]
-                elif isinstance(message, Have):
-                    self.pieces_bitarray[message.piece_index] = True
-                elif isinstance(message, Request):
-                    # TODO
-                    pass
-                elif isinstance(message, Piece):
-                    # save the block in the piece manager
-                    await self.client.piece_manager.download_block(self, message)
-
-                    # make the next block request
-                    await asyncio.sleep(Peer.REQUEST_DELAY_AFTER_BLOCK)
-                    request_message = self.client.piece_manager.get_next_request(self)
-                    if request_message is not None:
-                        await self.send(request_message)
-                elif isinstance(message, Cancel):
-                    # TODO
-                    pass
-            self.buffer = stream_iterator.buffer
-        
+        stream_iterator = PeerStreamIterator(self.reader, self.buffer)
+
+        async for message in stream_iterator:
+            # messages still buffered when the peer was disconnected, e.g. banned, are dropped
+            if not self.is_connected:
+                break
+
+            # TODO: use logging instead
+            # print(f"Received {message} from {self}")
+            self.last_received = time.monotonic()
+
+            # consume message and change client and peer status
+            if isinstance(message, KeepAlive):
+                # receiving it already kept the connection alive
+                pass
+            elif isinstance(message, FAST_MESSAGES) and not self.supports_fast:
+                # only a peer that negotiated the Fast Extension may send its messages
+                print(f"Peer {self} sent {message} without the Fast Extension")
+                break
+            elif isinstance(message, Choke):
+                self.peer_choking = True
+                self.client.piece_manager.peer_choked(self)
+            elif isinstance(message, Unchoke):
+                self.peer_choking = False
+                self.last_block_time = self.last_received
+            elif isinstance(message, Interested):
+                self.peer_interested = True
+            elif isinstance(message, NotInterested):
+                self.peer_interested = False
+            elif isinstance(message, BitField):
+                message.bitfield.resize(len(self.pieces_bitfield))
+                await self.set_pieces(message.bitfield)
+            elif isinstance(message, HaveAll):
+                bitfield = Bitfield(len(self.pieces_bitfield))
+                bitfield.set_all()
+                await self.set_pieces(bitfield)
+            elif isinstance(message, HaveNone):
+                await self.set_pieces(Bitfield(len(self.pieces_bitfield)))
+            elif isinstance(message, Have):
+                if not self.pieces_bitfield[message.piece_index]:
+                    self.pieces_bitfield[message.piece_index] = True
+                    piece_manager = self.client.piece_manager
+                    piece_manager.add_peer_piece(message.piece_index)
+                    if piece_manager.is_piece_wanted(message.piece_index):
+                        self.num_wanted_pieces += 1
+                        await self.update_interest()
+            elif isinstance(message, Request):
+                # TODO: upload; until then a peer with the Fast Extension is told right away
+                if self.supports_fast:
+                    await self.send(RejectRequest(message.index, message.begin, message.length))
+            elif isinstance(message, Piece):
+                self.last_block_time = self.last_received
+                self.complete_request(message.index, message.begin)
+
+                # save the block in the piece manager
+                if await self.client.piece_manager.download_block(self, message):
+                    await self.client.piece_completed(message.index)
+                if not self.is_connected:
+                    break
+
+                # make the next block request
+                await asyncio.sleep(Peer.REQUEST_DELAY_AFTER_BLOCK)
+                await self.request_block()
+            elif isinstance(message, Cancel):
+                # TODO
+                pass
+            elif isinstance(message, RejectRequest):
+                self.reject_request(message)
+            elif isinstance(message, AllowedFast):
+                if (message.piece_index < len(self.pieces_bitfield)
+                        and len(self.allowed_fast) < Peer.MAX_ALLOWED_FAST):
+                    self.allowed_fast.add(message.piece_index)
+                    # a choked transfer can start without waiting for the next request round
+                    if self.peer_choking and not self.outstanding_requests:
+                        await self.request_block()
+            elif isinstance(message, SuggestPiece):
+                if (message.piece_index < len(self.pieces_bitfield)
+                        and message.piece_index not in self.suggested_pieces):
+                    self.suggested_pieces.append(message.piece_index)
+            elif isinstance(message, Extended):
+                await self.handle_extended(message)
+        self.buffer = stream_iterator.buffer
+
     async def start_sending(self):
         """
         Start sending messages to and from peer (after handshake and interested)
@@ -209,23 +603,39 @@ class Peer(object):
         while self.is_connected:
             await asyncio.sleep(Peer.REQUEST_DELAY_NO_BLOCK)
             # print("Sending?")
-            if not self.peer_choking:
-                # make block requests
-                request_message = self.client.piece_manager.get_next_request(self)
-                if request_message is not None:
-                    await self.send(request_message)
+            # make block requests
+            await self.request_block()
 
     async def disconnect(self):
         """
         Closes the connection to this peer.
         """
 
-        self.writer.close()
-        await self.writer.wait_closed()
         self.is_connected = False
+        if self.timeout_timer is not None:
+            self.client.timer_wheel.cancel(self.timeout_timer)
+            self.timeout_timer = None
+
+        # give the blocks requested from this peer back to other peers
+        for timer in self.outstanding_requests.values():
+            self.client.timer_wheel.cancel(timer)
+        self.outstanding_requests = {}
+        for piece in self.pieces_downloading:
+            piece.remove_peer(self)
+        self.pieces_downloading = set()
+
+        # the peer's pieces no longer count towards availability
+        self.client.piece_manager.remove_peer_pieces(self.pieces_bitfield)
+        self.pieces_bitfield = Bitfield(len(self.pieces_bitfield))
+
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
         
-        if self in self.client.peers:
-            self.client.peers.remove(self)
+        self.client.remove_peer(self)
         
         print(f"Disconnected from {self}")
     
@@ -258,8 +668,11 @@ class PeerStreamIterator(object):
             return message
 
         while True:
-            # TODO: use try and except, read() may fail with connection errors
-            data = await asyncio.wait_for(self.reader.read(Peer.CHUNK_SIZE), Peer.READ_TIMEOUT)
+            # idle connections are timed out by the peer's timer, read errors end the stream
+            try:
+                data = await self.reader.read(Peer.CHUNK_SIZE)
+            except (ConnectionError, OSError):
+                break
             if data:
                 self.buffer += data
                 message = self.decode()
@@ -308,6 +721,18 @@ class PeerStreamIterator(object):
                 decoded = Piece.decode(data)
             elif msg_id == Cancel.ID:
                 decoded = Cancel.decode(data)
+            elif msg_id == SuggestPiece.ID:
+                decoded = SuggestPiece.decode(data)
+            elif msg_id == HaveAll.ID:
+                decoded = HaveAll()
+            elif msg_id == HaveNone.ID:
+                decoded = HaveNone()
+            elif msg_id == RejectRequest.ID:
+                decoded = RejectRequest.decode(data)
+            elif msg_id == AllowedFast.ID:
+                decoded = AllowedFast.decode(data)
+            elif msg_id == Extended.ID:
+                decoded = Extended.decode(data)
         
         self.buffer = self.buffer[4+msg_len:]
         return decoded
@@ -338,6 +763,10 @@ class PeerMessage(object):
 
 
 class Handshake(PeerMessage):
+    # reserved bits of the protocol extensions, as (byte index, bit mask)
+    EXTENSION_PROTOCOL_BIT = (5, 0x10)     # BEP 10
+    FAST_EXTENSION_BIT = (7, 0x04)         # BEP 6
+
     def __init__(self, info_hash: bytes, peer_id: bytes, reserved_bytes: bytes=b'\0'*8,
             protocol_id: bytes=b'BitTorrent protocol'):
 
@@ -353,6 +782,21 @@ class Handshake(PeerMessage):
         """
 
         return bytes([self.pstrlen]) + self.protocol_id + self.reserved_bytes + self.info_hash + self.peer_id
+
+    @staticmethod
+    def make_reserved_bytes(*bits) -> bytes:
+        """
+        Returns reserved bytes with the given extension bits set
+        """
+
+        reserved = bytearray(8)
+        for index, mask in bits:
+            reserved[index] |= mask
+        return bytes(reserved)
+
+    def has_reserved_bit(self, bit) -> bool:
+        index, mask = bit
+        return len(self.reserved_bytes) == 8 and bool(self.reserved_bytes[index] & mask)
     
     @classmethod
     def decode(cls, data: bytes):
@@ -564,15 +1008,15 @@ class Have(PeerMessage):
 class BitField(PeerMessage):
     ID = 5
 
-    def __init__(self, bitfield: BitArray):
-        self.bitfield = BitArray(bitfield.tobytes())
+    def __init__(self, bitfield: Bitfield):
+        self.bitfield = bitfield
     
     def encode(self) -> bytes:
         """
         Encodes this message to bytes.
         """
 
-        return struct.pack('>Ib', 1 + len(self.bitfield) // 8, BitField.ID) + self.bitfield.tobytes()
+        return struct.pack('>Ib', 1 + len(self.bitfield.data), BitField.ID) + self.bitfield.data
 
     @classmethod
     def decode(cls, data: bytes):
@@ -583,9 +1027,7 @@ class BitField(PeerMessage):
         try:
             msg_id = struct.unpack('>b', data[4:5])[0]
             if msg_id == cls.ID:
-                bitfield = data[5:]
-                bitfield = BitArray(bitfield)
-                return cls(bitfield)
+                return cls(Bitfield.from_bytes(memoryview(data)[5:]))
         except:
             pass
         return None
@@ -709,4 +1151,216 @@ class Cancel(PeerMessage):
         return f"Cancel(index: {self.index}, begin: {self.begin}, length: {self.length})"
 
     def __repr__(self) -> str:
-        return str(self)
\ No newline at end of file
+        return str(self)
+
+
+class SuggestPiece(PeerMessage):
+    # the Fast Extension messages follow (BEP 6)
+    ID = 13
+
+    def __init__(self, piece_index):
+        self.piece_index = piece_index
+
+    def encode(self) -> bytes:
+        """
+        Encodes this message to bytes.
+        """
+
+        return struct.pack('>IbI', 5, SuggestPiece.ID, self.piece_index)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """
+        Decodes the data into an instance of a suggest piece message. If not a valid message, None is returned.
+        """
+
+        try:
+            msg_id = struct.unpack('>b', data[4:5])[0]
+            if msg_id == cls.ID:
+                piece_index = struct.unpack('>I', data[5:])[0]
+                return cls(piece_index)
+        except:
+            pass
+        return None
+
+    def __str__(self) -> str:
+        return f"SuggestPiece(piece index: {self.piece_index})"
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class HaveAll(PeerMessage):
+    ID = 14
+
+    def encode(self) -> bytes:
+        """
+        Encodes this message to bytes.
+        """
+
+        return struct.pack('>Ib', 1, HaveAll.ID)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """
+        Decodes the data into an instance of a have all message. If not a valid message, None is returned.
+        """
+
+        try:
+            msg_id = struct.unpack('>b', data[4:5])[0]
+            if msg_id == cls.ID:
+                return cls()
+        except:
+            pass
+        return None
+
+    def __str__(self) -> str:
+        return f"HaveAll"
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class HaveNone(PeerMessage):
+    ID = 15
+
+    def encode(self) -> bytes:
+        """
+        Encodes this message to bytes.
+        """
+
+        return struct.pack('>Ib', 1, HaveNone.ID)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """
+        Decodes the data into an instance of a have none message. If not a valid message, None is returned.
+        """
+
+        try:
+            msg_id = struct.unpack('>b', data[4:5])[0]
+            if msg_id == cls.ID:
+                return cls()
+        except:
+            pass
+        return None
+
+    def __str__(self) -> str:
+        return f"HaveNone"
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class RejectRequest(PeerMessage):
+    ID = 16
+
+    def __init__(self, index, begin, length):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def encode(self) -> bytes:
+        """
+        Encodes this message to bytes.
+        """
+
+        return struct.pack('>IbIII', 13, RejectRequest.ID, self.index, self.begin, self.length)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """
+        Decodes the data into an instance of a reject request message. If not a valid message, None is returned.
+        """
+
+        try:
+            msg_id = struct.unpack('>b', data[4:5])[0]
+            if msg_id == cls.ID:
+                index, begin, length = struct.unpack('>III', data[5:])
+                return cls(index, begin, length)
+        except:
+            pass
+        return None
+
+    def __str__(self) -> str:
+        return f"RejectRequest(index: {self.index}, begin: {self.begin}, length: {self.length})"
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class AllowedFast(PeerMessage):
+    ID = 17
+
+    def __init__(self, piece_index):
+        self.piece_index = piece_index
+
+    def encode(self) -> bytes:
+        """
+        Encodes this message to bytes.
+        """
+
+        return struct.pack('>IbI', 5, AllowedFast.ID, self.piece_index)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """
+        Decodes the data into an instance of an allowed fast message. If not a valid message, None is returned.
+        """
+
+        try:
+            msg_id = struct.unpack('>b', data[4:5])[0]
+            if msg_id == cls.ID:
+                piece_index = struct.unpack('>I', data[5:])[0]
+                return cls(piece_index)
+        except:
+            pass
+        return None
+
+    def __str__(self) -> str:
+        return f"AllowedFast(piece index: {self.piece_index})"
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+# messages only peers that negotiated the Fast Extension may send
+FAST_MESSAGES = (SuggestPiece, HaveAll, HaveNone, RejectRequest, AllowedFast)
+
+
+class Extended(PeerMessage):
+    # a message of the extension protocol (BEP 10)
+    ID = 20
+    HANDSHAKE_ID = 0
+
+    def __init__(self, extended_id, payload):
+        self.extended_id = extended_id
+        self.payload = payload
+
+    def encode(self) -> bytes:
+        """
+        Encodes this message to bytes.
+        """
+
+        return struct.pack('>IbB', 2 + len(self.payload), Extended.ID, self.extended_id) + self.payload
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """
+        Decodes the data into an instance of an extended message. If not a valid message, None is returned.
+        """
+
+        try:
+            msg_id = struct.unpack('>b', data[4:5])[0]
+            if msg_id == cls.ID:
+                extended_id = struct.unpack('>B', data[5:6])[0]
+                return cls(extended_id, data[6:])
+        except:
+            pass
+        return None
+
+    def __str__(self) -> str:
+        return f"Extended(extended id: {self.extended_id})"
+
+    def __repr__(self) -> str:
+        return str(self)
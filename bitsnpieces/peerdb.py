@@ -0,0 +1,136 @@
+import time
+
+
+class PeerRecord(object):
+    """
+    History of a single peer address, kept whether or not we are connected to it
+    """
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+
+        # where we learned about this peer from (tracker, incoming, ...)
+        self.sources = set()
+        self.last_seen = 0
+
+        # connection history
+        self.failures = 0
+        self.next_attempt = 0
+        self.has_succeeded = False
+        self.download_speed = 0     # bytes per second measured over the last connection
+        self.hash_failures = 0      # failed pieces the peer sent blocks of
+
+    @property
+    def address(self) -> tuple:
+        return (self.ip, self.port)
+
+    def score(self, now: float=None, download_speed: float=None) -> float:
+        """
+        Returns how good a candidate this peer is for a connection slot, higher is better.
+        The download speed of a live connection can be passed in place of the recorded one.
+        """
+
+        if now is None:
+            now = time.monotonic()
+        if download_speed is None:
+            download_speed = self.download_speed
+
+        score = download_speed / 1024
+        if self.has_succeeded:
+            score += PeerDatabase.SUCCESS_BONUS
+        score -= PeerDatabase.FAILURE_PENALTY * self.failures
+        score -= PeerDatabase.HASH_FAILURE_PENALTY * self.hash_failures
+        score -= (now - self.last_seen) / PeerDatabase.STALE_TIME
+        return score
+
+    def __str__(self) -> str:
+        return f"[{self.ip}:{self.port}]"
+
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class PeerDatabase(object):
+    """
+    Every peer address known to a single torrent client, keyed by (ip, port)
+    """
+
+    SUCCESS_BONUS = 10
+    FAILURE_PENALTY = 5
+    HASH_FAILURE_PENALTY = 20
+    STALE_TIME = 600    # seconds of not being seen that cost a single score point
+
+    def __init__(self):
+        self.records = {}
+
+        # IPs that sent corrupt data, they are never added again
+        self.banned = set()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, address) -> bool:
+        return address in self.records
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def get(self, address) -> PeerRecord:
+        return self.records.get(address)
+
+    def add(self, ip, port, source: str="tracker") -> PeerRecord:
+        """
+        Adds a peer or merges it with the existing record of the same address.
+        Returns None if the peer's IP is banned.
+        """
+
+        if ip in self.banned:
+            return None
+
+        record = self.records.get((ip, port))
+        if record is None:
+            record = PeerRecord(ip, port)
+            self.records[(ip, port)] = record
+        record.sources.add(source)
+        record.last_seen = time.monotonic()
+        return record
+
+    def remove(self, address):
+        self.records.pop(address, None)
+
+    def ban(self, ip):
+        """
+        Forgets every address of an IP and refuses it from now on
+        """
+
+        self.banned.add(ip)
+        for address in [address for address in self.records if address[0] == ip]:
+            del self.records[address]
+
+    def is_banned(self, ip) -> bool:
+        return ip in self.banned
+
+    def get_candidates(self, exclude=(), now: float=None) -> list:
+        """
+        Returns records that may be dialled now, best scored first. Addresses in exclude
+        (already connected or being dialled) are skipped.
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        candidates = [record for address, record in self.records.items()
+            if record.next_attempt <= now and address not in exclude]
+        candidates.sort(key=lambda record: record.score(now), reverse=True)
+        return candidates
+
+    def get_next_attempt(self, exclude=()) -> float:
+        """
+        Returns the earliest time a record that is backing off may be dialled, or None
+        """
+
+        now = time.monotonic()
+        times = [record.next_attempt for address, record in self.records.items()
+            if record.next_attempt > now and address not in exclude]
+        return min(times, default=None)
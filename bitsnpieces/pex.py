@@ -0,0 +1,165 @@
+import time
+import socket
+import struct
+
+from .bencode import encoder, decoder
+from .peer import Extended
+
+
+def encode_peers(addresses, family=socket.AF_INET) -> bytes:
+    """encodes (ip, port) addresses into the compact format of the address family"""
+
+    return b''.join(socket.inet_pton(family, ip) + struct.pack('>H', port) for ip, port in addresses)
+
+def get_address_family(ip: str):
+    """returns the address family of an IP address, None if it is a host name"""
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, ip)
+            return family
+        except OSError:
+            pass
+    return None
+
+def decode_peers(data: bytes, family=socket.AF_INET) -> list:
+    """decodes compact peers of the address family into (ip, port) tuples, a truncated last peer is ignored"""
+
+    ip_length = 4 if family == socket.AF_INET else 16
+    end = len(data) - len(data) % (ip_length + 2)
+    return [(socket.inet_ntop(family, ip), port) for ip, port in struct.iter_unpack(f'>{ip_length}sH', data[:end])]
+
+
+class PeerExchange(object):
+    """
+    Peer Exchange (BEP 11) for a single torrent client: every INTERVAL, each connected peer that
+    supports ut_pex is told which peers we connected to and which we dropped since its last message.
+    The peers they tell us about are added to the peer database like the tracker's.
+    """
+
+    INTERVAL = 60           # in seconds, at most one message per peer in this time
+    MAX_ADDED = 50          # peers added in a single message
+    MAX_DROPPED = 50        # peers dropped in a single message
+
+    FLAG_SEED = 0x02
+    FLAG_REACHABLE = 0x10   # we connected to the peer, so others can too
+
+    def __init__(self, client):
+        # parameters
+        self.client = client
+
+        self.timer = None
+
+        # statistics
+        self.num_messages_sent = 0
+        self.num_peers_received = 0
+
+    def start(self):
+        """
+        Schedules the next round of messages on the client's timer wheel
+        """
+
+        self.stop()
+        self.timer = self.client.timer_wheel.schedule(PeerExchange.INTERVAL, self.send_updates)
+
+    def stop(self):
+        if self.timer is not None:
+            self.client.timer_wheel.cancel(self.timer)
+            self.timer = None
+
+    def get_swarm(self) -> dict:
+        """
+        Returns the flags of the connected peers keyed by the address they can be connected to at.
+        Peers known by host name are left out, ut_pex only carries IP addresses.
+        """
+
+        swarm = {}
+        for peer in self.client.peers.values():
+            address = peer.listen_address
+            if address is None or not peer.is_connected or get_address_family(address[0]) is None:
+                continue
+            flags = 0 if peer.inbound else PeerExchange.FLAG_REACHABLE
+            if peer.pieces_bitfield.all():
+                flags |= PeerExchange.FLAG_SEED
+            swarm[address] = flags
+        return swarm
+
+    def get_changes(self, peer, swarm: dict) -> tuple:
+        """
+        Returns the peers of the swarm that were added and the ones that were dropped since the
+        peer's last message
+        """
+
+        added = [address for address in swarm
+            if address not in peer.pex_sent and address != peer.listen_address][:PeerExchange.MAX_ADDED]
+        dropped = [address for address in peer.pex_sent if address not in swarm][:PeerExchange.MAX_DROPPED]
+        return added, dropped
+
+    def get_update(self, added: list, dropped: list, swarm: dict) -> dict:
+        """
+        Returns the ut_pex message of the added and dropped peers
+        """
+
+        message = {}
+        for suffix, family in ((b'', socket.AF_INET), (b'6', socket.AF_INET6)):
+            family_added = [address for address in added if get_address_family(address[0]) == family]
+            family_dropped = [address for address in dropped if get_address_family(address[0]) == family]
+            if family_added:
+                message[b'added' + suffix] = encode_peers(family_added, family)
+                message[b'added' + suffix + b'.f'] = bytes(swarm[address] for address in family_added)
+            if family_dropped:
+                message[b'dropped' + suffix] = encode_peers(family_dropped, family)
+        return message
+
+    async def send_updates(self):
+        """
+        Sends each peer that supports ut_pex the changes of the swarm since its last message. The
+        peer is known to have been told about them once the message is sent.
+        """
+
+        self.start()
+        swarm = self.get_swarm()
+        for peer in list(self.client.peers.values()):
+            extended_id = peer.extension_ids.get(b'ut_pex')
+            if not extended_id or not peer.is_connected:
+                continue
+            added, dropped = self.get_changes(peer, swarm)
+            if not added and not dropped:
+                continue
+            update = encoder.encode(self.get_update(added, dropped, swarm))
+            try:
+                await peer.send(Extended(extended_id, update))
+            except (ConnectionError, OSError):
+                await peer.disconnect()
+                continue
+            peer.pex_sent.difference_update(dropped)
+            peer.pex_sent.update(added)
+            self.num_messages_sent += 1
+
+    async def handle_message(self, peer, payload: bytes):
+        """
+        Adds the peers a ut_pex message tells us about to the peer database. Messages that come
+        faster than a peer is allowed to send them are ignored.
+        """
+
+        now = time.monotonic()
+        if peer.last_pex_received is not None and now - peer.last_pex_received < PeerExchange.INTERVAL / 2:
+            return
+        peer.last_pex_received = now
+
+        try:
+            message = decoder.decode(payload)
+        except (decoder.DecodeError, IndexError, ValueError):
+            return
+        if not isinstance(message, dict):
+            return
+
+        peers = []
+        for key, family in ((b'added', socket.AF_INET), (b'added6', socket.AF_INET6)):
+            added = message.get(key)
+            if isinstance(added, bytes):
+                peers.extend(decode_peers(added, family))
+        peers = [address for address in peers if address[1] != 0][:PeerExchange.MAX_ADDED]
+        if peers:
+            self.num_peers_received += len(peers)
+            await self.client.add_peers(peers, source="pex")
@@ -0,0 +1,135 @@
+import random
+from array import array
+
+
+class PiecePicker(object):
+    """
+    Chooses which piece to download next. Keeps how many connected peers have each piece and
+    buckets the pieces we still need by priority and by that count, so the rarest pieces of the
+    highest priority are found without scanning every piece on each pick.
+    """
+
+    # piece priorities, pieces with priority PRIORITY_SKIP are never picked
+    PRIORITY_SKIP = 0
+    PRIORITY_LOW = 1
+    PRIORITY_NORMAL = 4
+    PRIORITY_HIGH = 7
+
+    # pick this many random pieces before switching to rarest first, so a complete piece
+    # we can verify and share arrives early
+    RANDOM_FIRST_PIECES = 4
+    RANDOM_FIRST_TRIES = 32
+
+    def __init__(self, num_pieces: int, random_first_pieces: int=None):
+        # parameters
+        self.num_pieces = num_pieces
+        if random_first_pieces is None:
+            random_first_pieces = PiecePicker.RANDOM_FIRST_PIECES
+        self.random_first_pieces = random_first_pieces
+
+        # number of peers having each piece, whether we still want it and its priority
+        self.availability = array('H', [0]) * num_pieces
+        self.wanted = bytearray(b'\x01') * num_pieces
+        self.priorities = bytearray([PiecePicker.PRIORITY_NORMAL]) * num_pieces
+        self.num_complete = 0
+
+        # wanted pieces bucketed by priority and availability, buckets[p][n] holds the pieces of
+        # priority p that n peers have. Pieces nobody has or that are skipped cannot be picked
+        # and are not kept in any bucket.
+        self.buckets = [[set()] for _ in range(PiecePicker.PRIORITY_HIGH + 1)]
+
+    def _move(self, index: int, old: int, new: int):
+        priority = self.priorities[index]
+        if self.wanted[index] and priority:
+            buckets = self.buckets[priority]
+            if old > 0:
+                buckets[old].discard(index)
+            if new > 0:
+                while len(buckets) <= new:
+                    buckets.append(set())
+                buckets[new].add(index)
+
+    def add_piece_holder(self, index: int):
+        """
+        Called when a peer announces it has a piece
+        """
+
+        availability = self.availability[index]
+        self.availability[index] = availability + 1
+        self._move(index, availability, availability + 1)
+
+    def remove_piece_holder(self, index: int):
+        """
+        Called when a peer having a piece disconnects
+        """
+
+        availability = self.availability[index]
+        if availability > 0:
+            self.availability[index] = availability - 1
+            self._move(index, availability, availability - 1)
+
+    def add_peer(self, bitfield):
+        """
+        Counts all pieces of a peer's bitfield
+        """
+
+        for index in bitfield.iter_set():
+            if index < self.num_pieces:
+                self.add_piece_holder(index)
+
+    def remove_peer(self, bitfield):
+        """
+        Uncounts all pieces of a disconnected peer's bitfield
+        """
+
+        for index in bitfield.iter_set():
+            if index < self.num_pieces:
+                self.remove_piece_holder(index)
+
+    def piece_complete(self, index: int):
+        """
+        Stops picking a piece once it is downloaded and verified
+        """
+
+        if self.wanted[index]:
+            self._move(index, self.availability[index], 0)
+            self.wanted[index] = 0
+            self.num_complete += 1
+
+    def piece_failed(self, index: int):
+        """
+        Picks a piece again, e.g. after it was downloaded but failed verification
+        """
+
+        if not self.wanted[index]:
+            self.wanted[index] = 1
+            self._move(index, 0, self.availability[index])
+            self.num_complete -= 1
+
+    def set_priority(self, index: int, priority: int):
+        """
+        Changes the priority of a piece, PRIORITY_SKIP stops picking it
+        """
+
+        availability = self.availability[index]
+        self._move(index, availability, 0)
+        self.priorities[index] = priority
+        self._move(index, 0, availability)
+
+    def iter_candidates(self, bitfield):
+        """
+        Yields the wanted pieces the peer has, highest priority first and rarest first within
+        a priority. Until a few pieces are complete, some random pieces are yielded first.
+        """
+
+        if self.num_complete < self.random_first_pieces and self.num_complete < self.num_pieces:
+            for _ in range(PiecePicker.RANDOM_FIRST_TRIES):
+                index = random.randrange(self.num_pieces)
+                if self.wanted[index] and self.priorities[index] and bitfield[index]:
+                    yield index
+
+        for priority in range(PiecePicker.PRIORITY_HIGH, PiecePicker.PRIORITY_SKIP, -1):
+            for bucket in self.buckets[priority][1:]:
+                for index in bucket:
+                    if bitfield[index]:
+                        yield index
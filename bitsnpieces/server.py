@@ -0,0 +1,102 @@
+import asyncio
+
+from .peer import Peer, PeerError, read_handshake
+
+
+class PeerServer(object):
+    """
+    Listens for inbound peer connections and hands each one to the torrent client
+    whose info hash matches the handshake
+    """
+
+    MAX_CONNECTIONS = 200
+    MAX_HALF_OPEN = 20
+
+    def __init__(self, host: str=None, port: int=6889, max_connections: int=None,
+            max_half_open: int=None):
+        # parameters
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections or PeerServer.MAX_CONNECTIONS
+        self.max_half_open = max_half_open or PeerServer.MAX_HALF_OPEN
+
+        # torrent clients keyed by info hash
+        self.torrents = {}
+
+        # connections that are still waiting for a handshake
+        self.num_half_open = 0
+
+        self.server = None
+
+    @property
+    def num_connections(self) -> int:
+        """
+        Number of peer connections (inbound and outbound) over all torrents
+        """
+
+        return sum(len(client.peers) for client in self.torrents.values())
+
+    def add_torrent(self, client):
+        """
+        Routes inbound connections for the client's torrent to the client
+        """
+
+        self.torrents[client.info_hash] = client
+
+    def remove_torrent(self, client):
+        """
+        Stops routing inbound connections to the client
+        """
+
+        self.torrents.pop(client.info_hash, None)
+
+    async def start(self):
+        """
+        Starts listening for inbound connections
+        """
+
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+
+        # the actual port if port 0 was requested
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f"Listening for peers on port {self.port}")
+
+    async def close(self):
+        """
+        Stops listening for inbound connections, established peer connections are left to their clients
+        """
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle_connection(self, reader, writer):
+        """
+        Reads the handshake of an inbound connection and routes it to the matching torrent client,
+        closing the connection if any of the connection limits is reached
+        """
+
+        if self.num_half_open >= self.max_half_open or self.num_connections >= self.max_connections:
+            writer.close()
+            return
+
+        # read the handshake
+        self.num_half_open += 1
+        try:
+            handshake, buffer = await asyncio.wait_for(read_handshake(reader), Peer.HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, PeerError, ConnectionError):
+            writer.close()
+            return
+        finally:
+            self.num_half_open -= 1
+
+        # find the torrent and let its client accept the peer
+        client = self.torrents.get(handshake.info_hash)
+        if client is None or self.num_connections >= self.max_connections:
+            writer.close()
+            return
+
+        ip, port = writer.get_extra_info('peername')[:2]
+        if not await client.accept_peer(reader, writer, handshake, buffer, ip, port):
+            writer.close()
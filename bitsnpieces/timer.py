@@ -0,0 +1,121 @@
+import asyncio
+import inspect
+
+
+class Timer(object):
+    """
+    A callback scheduled on a TimerWheel
+    """
+
+    def __init__(self, callback, rounds, slot):
+        self.callback = callback
+        self.rounds = rounds    # full turns of the wheel left before the timer is due
+        self.slot = slot
+        self.is_cancelled = False
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel: timers are kept in slots by due time, so each tick only touches the timers
+    in a single slot regardless of how many are scheduled. Scheduling and cancelling are O(1).
+    Callbacks may be plain functions or coroutine functions, coroutines are run as tasks that are
+    cancelled when the wheel stops.
+    """
+
+    TICK = 1.0          # in seconds
+    NUM_SLOTS = 512
+
+    def __init__(self, tick: float=None, num_slots: int=None):
+        # parameters
+        self.tick = tick or TimerWheel.TICK
+        self.num_slots = num_slots or TimerWheel.NUM_SLOTS
+
+        self.slots = [set() for _ in range(self.num_slots)]
+        self.current_slot = 0
+
+        self.task = None
+        self.callback_tasks = set()
+
+    def __len__(self) -> int:
+        return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, delay: float, callback) -> Timer:
+        """
+        Schedules the callback to be called after delay seconds, rounded up to the next tick
+        """
+
+        ticks = max(1, int(-(-delay // self.tick)))
+        slot = (self.current_slot + ticks) % self.num_slots
+        timer = Timer(callback, (ticks - 1) // self.num_slots, slot)
+        self.slots[slot].add(timer)
+        return timer
+
+    def cancel(self, timer: Timer):
+        """
+        Cancels a scheduled timer
+        """
+
+        if timer is not None and not timer.is_cancelled:
+            timer.is_cancelled = True
+            self.slots[timer.slot].discard(timer)
+
+    def advance(self):
+        """
+        Moves the wheel one tick forward and calls the timers that are due
+        """
+
+        self.current_slot = (self.current_slot + 1) % self.num_slots
+        slot = self.slots[self.current_slot]
+
+        due = []
+        for timer in slot:
+            if timer.rounds == 0:
+                due.append(timer)
+            else:
+                timer.rounds -= 1
+        for timer in due:
+            slot.discard(timer)
+            timer.is_cancelled = True
+            self.fire(timer)
+
+    def fire(self, timer: Timer):
+        try:
+            result = timer.callback()
+        except Exception as e:
+            print(f"Timer callback failed: {e!r}")
+            return
+
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self.callback_tasks.add(task)
+            task.add_done_callback(self.callback_tasks.discard)
+
+    async def run(self):
+        """
+        Advances the wheel every tick
+        """
+
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+    def start(self):
+        """
+        Starts advancing the wheel in a background task
+        """
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stops the wheel and cancels any callbacks that are still running
+        """
+
+        tasks = list(self.callback_tasks)
+        if self.task is not None:
+            tasks.append(self.task)
+            self.task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
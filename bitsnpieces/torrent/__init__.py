@@ -1,4 +1,5 @@
 class TorrentError(Exception):
     pass
 
-from .torrent import Torrent, load
\ No newline at end of file
+from .torrent import Torrent, load
+from .magnet import Magnet, parse_magnet
\ No newline at end of file
@@ -15,7 +15,9 @@ class DataInfo(object):
     """
     Abstracts torrent data files info
     """
-    def __init__(self, info: OrderedDict=None):
+    def __init__(self, info: OrderedDict=None, info_hash: bytes=None):
+        # the info hash is computed on first use, unless known beforehand like a magnet link's
+        self._info_hash = info_hash
         if info is None:
             self._info = OrderedDict()
             self._files = []
@@ -98,13 +100,19 @@ class DataInfo(object):
     def files(self) -> str:
         return self._files
     
+    def encode(self) -> bytes:
+        """B-encodes the info dictionary, as it is sent to peers fetching the metadata"""
+        return encoder.encode_dict(self._info)
+
     def get_sha1(self) -> bytes:
         """Calculate the SHA1 hash of the info dictionary. Used in Tracker requests"""
-        encoded_info_dict = encoder.encode_dict(self._info)
-        return utils.sha1(encoded_info_dict)
+        if self._info_hash is None:
+            self._info_hash = utils.sha1(self.encode())
+        return self._info_hash
 
     def clear(self):
         self._info = OrderedDict()
+        self._info_hash = None
 
 
 class DataFileInfo(object):
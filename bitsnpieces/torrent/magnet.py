@@ -0,0 +1,98 @@
+import base64
+import binascii
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+from bitsnpieces.bencode import decoder
+from . import TorrentError
+from .torrent import Torrent
+
+
+class Magnet(object):
+    """
+    Abstracts magnet links (BEP 9): a torrent known only by its info hash, with an optional name and
+    the trackers and peers its metadata can be fetched through
+    """
+
+    def __init__(self, info_hash: bytes, name: str=None, trackers: list=None, peers: list=None):
+        self.info_hash = info_hash
+        self.name = name
+        self.trackers = trackers or []
+        self.peers = peers or []
+
+    def __str__(self) -> str:
+        return f"Magnet({self.info_hash.hex()}, name: {self.name})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    @property
+    def announce(self) -> str:
+        return self.trackers[0] if self.trackers else None
+
+    @property
+    def announce_list(self) -> list:
+        # magnet links do not group trackers, each gets a tier of its own
+        if self.trackers:
+            return [[url] for url in self.trackers]
+        return None
+
+    def to_torrent(self, info: bytes=None) -> Torrent:
+        """
+        Builds the torrent of the magnet link from its B-encoded info dictionary. Without one, the
+        torrent has no files but its info hash and trackers, which is enough to look for peers.
+        """
+
+        meta_info = OrderedDict()
+        if self.trackers:
+            meta_info[b'announce'] = self.announce.encode('utf-8')
+            meta_info[b'announce-list'] = [[url.encode('utf-8') for url in tier] for tier in self.announce_list]
+        if info is not None:
+            meta_info[b'info'] = decoder.decode(info)
+        return Torrent(meta_info, info_hash=self.info_hash)
+
+
+def decode_info_hash(value: str) -> bytes:
+    """decodes the hex or base32 info hash of a magnet link, None if it is neither"""
+
+    try:
+        if len(value) == 40:
+            return bytes.fromhex(value)
+        if len(value) == 32:
+            return base64.b32decode(value.upper())
+    except (ValueError, binascii.Error):
+        pass
+    return None
+
+def decode_peer(value: str) -> tuple:
+    """decodes a 'host:port' or '[ipv6]:port' peer address into an (ip, port) tuple, None if invalid"""
+
+    host, _, port = value.rpartition(':')
+    host = host.strip('[]')
+    if not host or not port.isdigit() or not 0 < int(port) < 2 ** 16:
+        return None
+    return (host, int(port))
+
+def parse_magnet(uri: str) -> Magnet:
+    """
+    Parses a magnet URI. Raises TorrentError if it is not a magnet link of a BitTorrent info hash.
+    """
+
+    parsed = urlparse(uri)
+    if parsed.scheme != 'magnet':
+        raise TorrentError(f"not a magnet link: '{uri}'")
+    params = parse_qs(parsed.query)
+
+    info_hash = None
+    for topic in params.get('xt', []):
+        if topic.startswith('urn:btih:'):
+            info_hash = decode_info_hash(topic[len('urn:btih:'):])
+            if info_hash is not None:
+                break
+    if info_hash is None:
+        raise TorrentError(f"magnet link has no valid BitTorrent info hash: '{uri}'")
+
+    name = params.get('dn', [None])[0]
+    trackers = list(OrderedDict.fromkeys(params.get('tr', [])))
+    peers = [peer for peer in map(decode_peer, params.get('x.pe', [])) if peer is not None]
+    return Magnet(info_hash, name, trackers, peers)
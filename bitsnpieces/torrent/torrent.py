@@ -16,18 +16,18 @@ class Torrent(object):
     Abstracts torrent files
     """
 
-    def __init__(self, meta_info: OrderedDict=None):
+    def __init__(self, meta_info: OrderedDict=None, info_hash: bytes=None):
         # setup torrent meta-info dictionary
         if meta_info is None:
             self._meta_info = OrderedDict()
-            self._info = DataInfo()
+            self._info = DataInfo(info_hash=info_hash)
         else:
             for key in meta_info.keys():
                 if key not in TORRENT_KEYS:
                     # TODO: make this a warning for BitTorrent forward-compatibility
                     raise TorrentError(f"unknown torrent meta-info key '{key.decode('utf-8')}'")
             self._meta_info = meta_info
-            self._info = DataInfo(self._meta_info.get(b'info'))
+            self._info = DataInfo(self._meta_info.get(b'info'), info_hash)
     
     def __str__(self) -> str:
         info_str = '\n  ' + str(self.info).replace('\n', '\n  ')
@@ -1,29 +1,43 @@
 # import requests
+import time
+import random
+import socket
+import struct
+import asyncio
+from collections import OrderedDict
 import aiohttp
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse, quote
 
 from .bencode import decoder
-from .utils import get_str_prop, ip_from_bytes, decode_big_endian
+from .utils import get_str_prop
 
 class TrackerResponse(object):
     """
     Abstarcts a tracker response for a single torrent
     """
     
-    def __init__(self, response_data):
-        self._response = decoder.decode(response_data)
+    def __init__(self, response_data: bytes=None, response: OrderedDict=None):
+        # a bencoded HTTP response, or the equivalent dictionary built from a UDP response
+        if response is None:
+            response = decoder.decode(response_data)
+        self._response = response
         self._failed = b'failure reason' in self._response
         self._peers = None
         
-        # parse the peers list
+        # parse the peers lists into (ip, port) tuples
         if not self._failed:
+            self._peers = []
             peers_list = self._response.get(b'peers')
             if isinstance(peers_list, bytes):
                 # binary (compact) model
-                self._peers = self._parse_binary_peers_list(peers_list)
-            elif isinstance(peers_list, dict):
+                self._peers.extend(self._parse_binary_peers_list(peers_list))
+            elif isinstance(peers_list, list):
                 # list of dictionaries model
-                self._peers = self._parse_dict_peers_list(peers_list)
+                self._peers.extend(self._parse_dict_peers_list(peers_list))
+            peers6_list = self._response.get(b'peers6')
+            if isinstance(peers6_list, bytes):
+                # binary IPv6 model (BEP 7)
+                self._peers.extend(self._parse_binary_peers6_list(peers6_list))
     
     def __str__(self) -> str:
         s = [
@@ -40,25 +54,28 @@ class TrackerResponse(object):
         return self.__str__()
     
     def _parse_binary_peers_list(self, peers_str):
-        """parses a binary string of peers into a list of dictionaries of peers each with parsed IP and port"""
-        
-        peers_list = []
-        for peer_start in range(0, len(peers_str), 6):
-            ip = ip_from_bytes(peers_str[peer_start:peer_start+4])
-            port = decode_big_endian(peers_str[peer_start+4:peer_start+6])
-            peers_list.append({'ip': ip, 'port': port})
-        return peers_list
+        """parses a binary string of 6-byte IPv4 peers into a list of (ip, port) tuples, a truncated last peer is ignored"""
+
+        end = len(peers_str) - len(peers_str) % 6
+        return [(socket.inet_ntoa(ip), port) for ip, port in struct.iter_unpack('>4sH', peers_str[:end])]
+
+    def _parse_binary_peers6_list(self, peers_str):
+        """parses a binary string of 18-byte IPv6 peers into a list of (ip, port) tuples, a truncated last peer is ignored"""
+
+        end = len(peers_str) - len(peers_str) % 18
+        return [(socket.inet_ntop(socket.AF_INET6, ip), port) for ip, port in struct.iter_unpack('>16sH', peers_str[:end])]
     
     def _parse_dict_peers_list(self, peers_list):
-        """parses each peer's ID, IP and port in a list of dictionaries of peers"""
+        """parses each peer's IP and port in a list of dictionaries of peers into (ip, port) tuples, skipping malformed peers"""
 
         parsed_peers_list = []
         for peer in peers_list:
-            peer_id = peer.get(b'peer_id')
-            ip = peer.get(b'ip').decode('utf-8')
-            port = int(peer.get(b'port'))
-            parsed_peer = {'ip': ip, 'port': port, 'peer_id': peer_id}
-            parsed_peers_list.append(parsed_peer)
+            if not isinstance(peer, dict):
+                continue
+            ip, port = peer.get(b'ip'), peer.get(b'port')
+            if not isinstance(ip, bytes) or not isinstance(port, int):
+                continue
+            parsed_peers_list.append((ip.decode('utf-8', 'replace'), port))
         return parsed_peers_list
 
     @property
@@ -67,7 +84,7 @@ class TrackerResponse(object):
     
     @property
     def failure_reason(self) -> str:
-        return get_str_prop(self._response, b'failure_reason')
+        return get_str_prop(self._response, b'failure reason')
     
     @property
     def warning_message(self) -> str:
@@ -76,6 +93,10 @@ class TrackerResponse(object):
     @property
     def interval(self) -> int:
         return self._response.get(b'interval')
+
+    @property
+    def min_interval(self) -> int:
+        return self._response.get(b'min interval')
     
     @property
     def tracker_id(self) -> bytes:
@@ -93,30 +114,135 @@ class TrackerResponse(object):
     def peers(self) -> list:
         return self._peers
 
+    @classmethod
+    def merge(cls, responses: list):
+        """
+        Combines the responses of several trackers: the shortest interval, the largest swarm
+        counts and the peers of all of them without duplicates
+        """
+
+        merged = OrderedDict()
+        intervals = [response.interval for response in responses if response.interval is not None]
+        if intervals:
+            merged[b'interval'] = min(intervals)
+        min_intervals = [response.min_interval for response in responses if response.min_interval is not None]
+        if min_intervals:
+            merged[b'min interval'] = max(min_intervals)
+        for key in (b'complete', b'incomplete'):
+            counts = [response._response.get(key) for response in responses if response._response.get(key) is not None]
+            if counts:
+                merged[key] = max(counts)
+
+        merged_response = cls(response=merged)
+        seen = set()
+        merged_response._peers = []
+        for response in responses:
+            for peer in response.peers or []:
+                if peer not in seen:
+                    seen.add(peer)
+                    merged_response._peers.append(peer)
+        return merged_response
+
+
+class HTTPStatusError(ConnectionError):
+    """
+    Raised when an HTTP tracker answers with a status other than 200
+    """
+
+    def __init__(self, status: int):
+        super().__init__(f"Unable to connect to the tracker, status code: {status}")
+        self.status = status
+
+
+class HTTPTrackerSession(object):
+    """
+    HTTP client shared by the HTTP trackers of any number of torrents: keep-alive connections are
+    pooled per host and DNS lookups are cached, so torrents announcing to the same trackers reuse
+    both. The aiohttp session is created on first use, inside the running event loop.
+    """
+
+    LIMIT = 100                 # connections over all hosts
+    LIMIT_PER_HOST = 4
+    DNS_CACHE_TTL = 300         # in seconds
+    KEEPALIVE_TIMEOUT = 60      # in seconds, idle connections are closed after this
+    TIMEOUT = 30                # in seconds, for a whole request
+    CONNECT_TIMEOUT = 10        # in seconds
+
+    def __init__(self, limit_per_host: int=None, timeout: float=None):
+        # parameters
+        self.limit_per_host = limit_per_host or HTTPTrackerSession.LIMIT_PER_HOST
+        self.timeout = timeout or HTTPTrackerSession.TIMEOUT
+
+        self.session = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=HTTPTrackerSession.LIMIT, limit_per_host=self.limit_per_host,
+                use_dns_cache=True, ttl_dns_cache=HTTPTrackerSession.DNS_CACHE_TTL,
+                keepalive_timeout=HTTPTrackerSession.KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=self.timeout, sock_connect=HTTPTrackerSession.CONNECT_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    async def get(self, url: str) -> bytes:
+        """
+        Returns the body of a GET request, raises HTTPStatusError if the status is not 200
+        """
+
+        async with self.get_session().get(url) as response:
+            if not response.status == 200:
+                raise HTTPStatusError(response.status)
+            return await response.read()
+
+    async def close(self):
+        """
+        Must be awaited and done before HTTPTrackerSession is deleted
+        """
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
 
 class Tracker(object):
     """
     Abstracts the BitTorrent tracker connection for a single torrent
     """
 
-    def __init__(self, torrent, raise_on_failure: bool=True):
+    MAX_SCRAPE_HASHES = 64      # info hashes in a single scrape request, halved if the tracker refuses it
+    SCRAPE_TOO_LARGE = (413, 414)   # statuses of a request too large for the tracker
+
+    def __init__(self, torrent, raise_on_failure: bool=True, url: str=None, http_session: HTTPTrackerSession=None):
         self.torrent = torrent
-        self.http_session = aiohttp.ClientSession()
+        self.url = url or torrent.announce
         self.raise_on_failure = raise_on_failure
+
+        # a shared session is closed by its owner, not by the tracker
+        self.owns_http_session = http_session is None
+        self.http_session = http_session or HTTPTrackerSession()
+
+        # sent back to the tracker if it gave us one
+        self.tracker_id = None
+
+        self.max_scrape_hashes = Tracker.MAX_SCRAPE_HASHES
     
     async def close(self):
         """
         Must be awaited and done before Tracker is deleted
         """
 
-        # TODO: send a shutdown message to tracker
-        await self.http_session.close()
+        if self.owns_http_session:
+            await self.http_session.close()
 
-    async def announce(self, client_id: bytes, port: int, uploaded: int, downloaded: int, event: str="") -> TrackerResponse:
+    async def announce(self, client_id: bytes, port: int, uploaded: int, downloaded: int, event: str="",
+            numwant: int=None, left: int=None) -> TrackerResponse:
         """
         Makes an announce call to the tracker to update client's
         stats on the server as well as get a list of peers to
-        connect to.
+        connect to. numwant is the number of peers asked for,
+        by default the tracker decides. left is the number of
+        bytes still to download, by default the torrent size
+        minus the bytes downloaded.
 
         If request is successful, a TrackerResponse object is
         returned.
@@ -124,6 +250,8 @@ class Tracker(object):
 
         if event is None:
             event = ""
+        if left is None:
+            left = max(0, self.torrent.total_size - downloaded)
 
         params = {
             'info_hash': self.torrent.info.get_sha1(),
@@ -131,22 +259,455 @@ class Tracker(object):
             'port': port,
             'uploaded': uploaded,
             'downloaded': downloaded,
-            'left': self.torrent.total_size - downloaded,
+            'left': left,
             'compact': 1,
             'event': event
         }
+        if numwant is not None:
+            params['numwant'] = numwant
+        if self.tracker_id is not None:
+            params['trackerid'] = self.tracker_id
 
         # generate HTTP GET URL
-        url = self.torrent.announce + '?' + urlencode(params)
+        url = self.url + '?' + urlencode(params)
 
         # make the async GET request and get response
-        async with self.http_session.get(url) as response:
-            if not response.status == 200:
-                raise ConnectionError(f"Unable to connect to the tracker, status code: {response.status}")
-            data = await response.read()
+        data = await self.http_session.get(url)
         tracker_response = TrackerResponse(data)
+        if tracker_response.tracker_id is not None:
+            self.tracker_id = tracker_response.tracker_id
 
         # raise an exception if announce request failed
         if self.raise_on_failure and tracker_response.failed:
             raise ConnectionError(f"Announce request to tracker failed, failure reason: {tracker_response.failure_reason}")
-        return tracker_response
\ No newline at end of file
+        return tracker_response
+
+    @property
+    def scrape_url(self) -> str:
+        """
+        The scrape URL by convention: the announce URL with the 'announce' that starts its last path
+        component replaced by 'scrape', None if the tracker does not support scraping
+        """
+
+        path_start = self.url.find('/', self.url.find('//') + 2)
+        name_start = self.url.rfind('/') + 1
+        if path_start == -1 or name_start <= path_start or not self.url.startswith('announce', name_start):
+            return None
+        return self.url[:name_start] + 'scrape' + self.url[name_start + len('announce'):]
+
+    async def scrape(self, info_hashes: list=None) -> dict:
+        """
+        Returns the swarm stats of the torrents, by default this tracker's torrent, as a dictionary
+        keyed by info hash of dictionaries with 'complete', 'downloaded' and 'incomplete' counts.
+        Info hashes the tracker does not know are left out. Raises ConnectionError if the scrape fails.
+        """
+
+        scrape_url = self.scrape_url
+        if scrape_url is None:
+            raise ConnectionError(f"Tracker {self.url} does not support scraping")
+        if info_hashes is None:
+            info_hashes = [self.torrent.info.get_sha1()]
+
+        stats = {}
+        start = 0
+        while start < len(info_hashes):
+            batch = info_hashes[start:start + self.max_scrape_hashes]
+            separator = '&' if '?' in scrape_url else '?'
+            url = scrape_url + separator + urlencode([('info_hash', info_hash) for info_hash in batch], quote_via=quote)
+            try:
+                data = await self.http_session.get(url)
+                response = decoder.decode(data)
+                if not isinstance(response, dict):
+                    raise decoder.DecodeError("scrape response is not a dictionary")
+            except (HTTPStatusError, aiohttp.ClientPayloadError, decoder.DecodeError, IndexError, ValueError) as e:
+                # the request may have been too large for the tracker, which refused it or cut the
+                # response short, retry in smaller batches
+                too_large = not isinstance(e, HTTPStatusError) or e.status in Tracker.SCRAPE_TOO_LARGE
+                if not too_large or len(batch) == 1:
+                    raise ConnectionError(f"Scrape request to tracker {self.url} failed: {e}") from e
+                self.max_scrape_hashes = len(batch) // 2
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise ConnectionError(f"Scrape request to tracker {self.url} failed: {e!r}") from e
+
+            if b'failure reason' in response:
+                raise ConnectionError(f"Scrape request to tracker failed, failure reason: {get_str_prop(response, b'failure reason')}")
+            files = response.get(b'files')
+            if isinstance(files, dict):
+                for info_hash in batch:
+                    file_stats = files.get(info_hash)
+                    if isinstance(file_stats, dict):
+                        stats[info_hash] = {key: file_stats.get(key.encode(), 0)
+                            for key in ('complete', 'downloaded', 'incomplete')}
+            start += len(batch)
+        return stats
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    Matches the datagrams received from a UDP tracker to the requests waiting for them
+    by transaction ID
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.transactions = {}  # futures keyed by transaction ID
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack_from('>I', data, 4)[0]
+        future = self.transactions.pop(transaction_id, None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        self.fail(ConnectionError(f"UDP tracker error: {exc}"))
+
+    def connection_lost(self, exc):
+        self.fail(ConnectionError("UDP tracker connection closed"))
+
+    def fail(self, exc):
+        for future in self.transactions.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.transactions = {}
+
+    def expect(self, transaction_id: int) -> asyncio.Future:
+        """
+        Returns a future that gets the response with the transaction ID
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self.transactions[transaction_id] = future
+        return future
+
+
+class UDPTracker(object):
+    """
+    Abstracts a UDP tracker (BEP 15) for a single torrent, with the same interface as Tracker.
+    A request that gets no response is sent again after 15 * 2 ^ n seconds, n growing with
+    every try, connecting included. The connection ID is reused until it expires or the
+    tracker answers it with an error.
+    """
+
+    PROTOCOL_ID = 0x41727101980
+    CONNECTION_ID_LIFETIME = 60     # in seconds
+    TIMEOUT = 15                    # in seconds, doubled after every retransmission
+    MAX_RETRANSMISSIONS = 8
+    MAX_SCRAPE_HASHES = 74          # info hashes that fit in a single scrape request
+
+    # actions
+    ACTION_CONNECT = 0
+    ACTION_ANNOUNCE = 1
+    ACTION_SCRAPE = 2
+    ACTION_ERROR = 3
+
+    EVENTS = {"": 0, "completed": 1, "started": 2, "stopped": 3}
+
+    def __init__(self, torrent, raise_on_failure: bool=True, url: str=None, timeout: float=None,
+            max_retransmissions: int=None):
+        self.torrent = torrent
+        self.url = url or torrent.announce
+        self.raise_on_failure = raise_on_failure
+        self.timeout = timeout or UDPTracker.TIMEOUT
+        if max_retransmissions is None:
+            max_retransmissions = UDPTracker.MAX_RETRANSMISSIONS
+        self.max_retransmissions = max_retransmissions
+
+        parsed_url = urlparse(self.url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port
+
+        # identifies our announces to the tracker across IP changes
+        self.key = random.getrandbits(32)
+
+        self.transport = None
+        self.protocol = None
+        self.connection_id = None
+        self.connection_id_time = 0
+
+    async def close(self):
+        """
+        Must be awaited and done before UDPTracker is deleted
+        """
+
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            self.protocol = None
+        self.connection_id = None
+
+    async def get_protocol(self) -> UDPTrackerProtocol:
+        if self.transport is None:
+            loop = asyncio.get_running_loop()
+            self.transport, self.protocol = await loop.create_datagram_endpoint(UDPTrackerProtocol,
+                remote_addr=(self.host, self.port))
+        return self.protocol
+
+    async def transact(self, message: bytes, transaction_id: int, timeout: float) -> bytes:
+        """
+        Sends a single request and returns the response, or None if none arrives in time
+        """
+
+        protocol = await self.get_protocol()
+        future = protocol.expect(transaction_id)
+        self.transport.sendto(message)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            protocol.transactions.pop(transaction_id, None)
+            return None
+
+    async def send_request(self, connection_id: int, action: int, body: bytes, timeout: float) -> bytes:
+        """
+        Sends a request once and returns the response, or None if none arrives in time.
+        Raises ConnectionError if the tracker answers with an error or another action.
+        """
+
+        transaction_id = random.getrandbits(32)
+        message = struct.pack('>QII', connection_id, action, transaction_id) + body
+        response = await self.transact(message, transaction_id, timeout)
+        if response is None:
+            return None
+
+        response_action = struct.unpack_from('>I', response)[0]
+        if response_action == UDPTracker.ACTION_ERROR:
+            raise ConnectionError(f"UDP tracker error: {response[8:].decode('utf-8', 'replace')}")
+        if response_action != action:
+            raise ConnectionError(f"UDP tracker responded with action {response_action} to action {action}")
+        return response
+
+    @property
+    def has_connection_id(self) -> bool:
+        return (self.connection_id is not None
+            and time.monotonic() - self.connection_id_time < UDPTracker.CONNECTION_ID_LIFETIME)
+
+    async def connect(self, timeout: float) -> bool:
+        """
+        Sends a single connect request and stores the connection ID of the response.
+        Returns False if no response arrives in time.
+        """
+
+        response = await self.send_request(UDPTracker.PROTOCOL_ID, UDPTracker.ACTION_CONNECT, b"", timeout)
+        if response is None:
+            return False
+        if len(response) < 16:
+            raise ConnectionError("UDP tracker sent a short connect response")
+        self.connection_id = struct.unpack_from('>Q', response, 8)[0]
+        self.connection_id_time = time.monotonic()
+        return True
+
+    async def request(self, action: int, body: bytes=b"") -> bytes:
+        """
+        Sends a request, connecting first if needed, and retransmits until it is answered.
+        Connecting and the request share the retransmission count, so a request never waits
+        longer than the BEP 15 schedule allows. Returns the response.
+        Raises ConnectionError if the tracker never answers or answers with an error.
+        """
+
+        for retransmission in range(self.max_retransmissions + 1):
+            timeout = self.timeout * 2 ** retransmission
+            if not self.has_connection_id and not await self.connect(timeout):
+                continue
+
+            try:
+                response = await self.send_request(self.connection_id, action, body, timeout)
+            except ConnectionError:
+                # the error may be about our connection ID, a new one is asked for next time
+                self.connection_id = None
+                raise
+            if response is not None:
+                return response
+        raise ConnectionError(f"UDP tracker {self.url} did not respond")
+
+    @property
+    def is_ipv6(self) -> bool:
+        return self.transport is not None and self.transport.get_extra_info('socket').family == socket.AF_INET6
+
+    async def announce(self, client_id: bytes, port: int, uploaded: int, downloaded: int, event: str="",
+            numwant: int=None, left: int=None) -> TrackerResponse:
+        """
+        Makes an announce call to the tracker to update client's
+        stats on the server as well as get a list of peers to
+        connect to. numwant is the number of peers asked for,
+        by default the tracker decides. left is the number of
+        bytes still to download, by default the torrent size
+        minus the bytes downloaded.
+
+        If request is successful, a TrackerResponse object is
+        returned.
+        """
+
+        if event is None:
+            event = ""
+
+        if left is None:
+            left = max(0, self.torrent.total_size - downloaded)
+
+        try:
+            if event not in UDPTracker.EVENTS:
+                raise ConnectionError(f"UDP trackers have no announce event '{event}'")
+            try:
+                body = struct.pack('>20s20sQQQIIIiH', self.torrent.info.get_sha1(), client_id, downloaded,
+                    left, uploaded, UDPTracker.EVENTS[event], 0, self.key, -1 if numwant is None else numwant, port)
+            except struct.error as e:
+                raise ConnectionError(f"Invalid UDP announce: {e}") from e
+            data = await self.request(UDPTracker.ACTION_ANNOUNCE, body)
+            if len(data) < 20:
+                raise ConnectionError("UDP tracker sent a short announce response")
+        except ConnectionError as e:
+            if self.raise_on_failure:
+                raise
+            return TrackerResponse(response=OrderedDict([(b'failure reason', str(e).encode('utf-8'))]))
+
+        interval, leechers, seeders = struct.unpack_from('>III', data, 8)
+
+        # the peers are in compact form, IPv6 trackers send IPv6 peers
+        response = OrderedDict([(b'interval', interval), (b'complete', seeders), (b'incomplete', leechers)])
+        response[b'peers6' if self.is_ipv6 else b'peers'] = bytes(data[20:])
+        return TrackerResponse(response=response)
+
+    async def scrape(self, info_hashes: list=None) -> dict:
+        """
+        Returns the swarm stats of the torrents, by default this tracker's torrent, as a dictionary
+        keyed by info hash of dictionaries with 'complete', 'downloaded' and 'incomplete' counts
+        """
+
+        if info_hashes is None:
+            info_hashes = [self.torrent.info.get_sha1()]
+
+        stats = {}
+        for start in range(0, len(info_hashes), UDPTracker.MAX_SCRAPE_HASHES):
+            batch = info_hashes[start:start + UDPTracker.MAX_SCRAPE_HASHES]
+            data = await self.request(UDPTracker.ACTION_SCRAPE, b"".join(batch))
+            num_answered = min(len(batch), (len(data) - 8) // 12)
+            for info_hash, (seeders, completed, leechers) in zip(batch, struct.iter_unpack('>III', data[8:8 + 12 * num_answered])):
+                stats[info_hash] = {'complete': seeders, 'downloaded': completed, 'incomplete': leechers}
+        return stats
+
+
+def create_tracker(torrent, url: str=None, raise_on_failure: bool=True, http_session: HTTPTrackerSession=None):
+    """
+    Returns a Tracker or UDPTracker depending on the announce URL, by default the torrent's.
+    HTTP trackers make their requests through http_session if given.
+    """
+
+    url = url or torrent.announce
+    if url.startswith('udp://'):
+        return UDPTracker(torrent, raise_on_failure, url)
+    return Tracker(torrent, raise_on_failure, url, http_session=http_session)
+
+
+async def scrape(info_hashes_by_url: dict, http_session: HTTPTrackerSession=None) -> dict:
+    """
+    Scrapes many torrents from many trackers: takes lists of info hashes keyed by tracker URL and
+    returns the swarm stats of each tracker, keyed by URL as well. Trackers are scraped concurrently
+    and each one is sent as few requests as its limit on info hashes per request allows.
+    A tracker that cannot be scraped is left out.
+    """
+
+    owns_http_session = http_session is None
+    http_session = http_session or HTTPTrackerSession()
+    trackers = {url: create_tracker(None, url, http_session=http_session) for url in info_hashes_by_url}
+
+    async def scrape_tracker(url):
+        try:
+            return url, await trackers[url].scrape(info_hashes_by_url[url])
+        except (ConnectionError, OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+            print(f"Scrape of tracker {url} failed: {e!r}")
+            return url, None
+
+    try:
+        results = await asyncio.gather(*(scrape_tracker(url) for url in trackers))
+    finally:
+        for tracker in trackers.values():
+            await tracker.close()
+        if owns_http_session:
+            await http_session.close()
+    return {url: stats for url, stats in results if stats is not None}
+
+
+class TrackerList(object):
+    """
+    Abstracts the trackers of a torrent's announce-list (BEP 12), with the same interface as Tracker.
+    The trackers of a tier are announced to concurrently, the ones that answer are moved to the
+    front of their tier and the next tier is only tried if no tracker of a tier answered.
+    """
+
+    TIMEOUT = 15    # in seconds, for a single tracker to answer an announce
+
+    def __init__(self, torrent, timeout: float=None, http_session: HTTPTrackerSession=None):
+        self.torrent = torrent
+        self.timeout = timeout or TrackerList.TIMEOUT
+
+        # the HTTP trackers of the list share a session, which may be shared with other torrents
+        self.owns_http_session = http_session is None
+        self.http_session = http_session or HTTPTrackerSession()
+
+        # trackers are shuffled within their tier, as BEP 12 asks
+        announce_list = torrent.announce_list or ([[torrent.announce]] if torrent.announce else [])
+        self.tiers = []
+        for urls in announce_list:
+            tier = [create_tracker(torrent, url, http_session=self.http_session) for url in urls]
+            random.shuffle(tier)
+            if tier:
+                self.tiers.append(tier)
+
+        # the tracker that answered first in the last announce
+        self.url = self.tiers[0][0].url if self.tiers else torrent.announce
+
+    async def close(self):
+        """
+        Must be awaited and done before TrackerList is deleted
+        """
+
+        for tier in self.tiers:
+            for tracker in tier:
+                await tracker.close()
+        if self.owns_http_session:
+            await self.http_session.close()
+
+    async def announce_to(self, tracker, *args, **kwargs):
+        """
+        Announces to a single tracker, returning the tracker and its response or None if it failed
+        """
+
+        try:
+            return tracker, await asyncio.wait_for(tracker.announce(*args, **kwargs), self.timeout)
+        except (ConnectionError, OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+            print(f"Announce to tracker {tracker.url} failed: {e!r}")
+            return tracker, None
+
+    async def announce(self, client_id: bytes, port: int, uploaded: int, downloaded: int, event: str="",
+            on_response=None, numwant: int=None, left: int=None) -> TrackerResponse:
+        """
+        Announces to the first tier that has a tracker that answers and returns the responses of
+        that tier merged. If given, on_response is awaited with each response as soon as it
+        arrives, so peers can be dialled before slower trackers answer.
+        Raises ConnectionError if no tracker answered.
+        """
+
+        args = (client_id, port, uploaded, downloaded, event)
+        for tier in self.tiers:
+            answered = []
+            responses = []
+            announces = [self.announce_to(tracker, *args, numwant=numwant, left=left) for tracker in tier]
+            for announce in asyncio.as_completed(announces):
+                tracker, response = await announce
+                if response is None or response.failed:
+                    continue
+                answered.append(tracker)
+                responses.append(response)
+                if on_response is not None:
+                    await on_response(response)
+
+            if responses:
+                # promote the trackers that answered, fastest first
+                tier[:] = answered + [tracker for tracker in tier if tracker not in answered]
+                self.url = answered[0].url
+                return TrackerResponse.merge(responses)
+        raise ConnectionError("No tracker of the announce-list answered")
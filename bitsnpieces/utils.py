@@ -19,7 +19,7 @@ def ip_from_bytes(binary_ip: bytes) -> str:
     return '.'.join(str(int(byte)) for byte in binary_ip)
 
 def decode_big_endian(int_in_bytes: bytes) -> int:
-    """decodes 4 Big-endian bytes to an int"""
+    """decodes 2 Big-endian bytes to an int"""
 
     return struct.unpack('>H', int_in_bytes)[0]
 
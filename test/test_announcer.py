@@ -0,0 +1,286 @@
+import unittest
+from unittest import TestCase
+import asyncio
+
+from bitsnpieces.tracker import TrackerResponse
+from bitsnpieces.peerdb import PeerDatabase
+from bitsnpieces.announcer import Announcer
+
+
+class StubTracker(object):
+    """answers announces with the queued responses, raising ConnectionError once they run out or for None"""
+    def __init__(self, responses=(), url="http://tracker.test/announce"):
+        self.url = url
+        self.responses = list(responses)
+        self.announces = []
+
+    async def announce(self, client_id, port, uploaded, downloaded, event="", numwant=None, on_response=None,
+            left=None):
+        self.announces.append((event, numwant))
+        response = self.responses.pop(0) if self.responses else None
+        if response is None:
+            raise ConnectionError("no tracker answered")
+        if on_response is not None:
+            await on_response(response)
+        return response
+
+
+class StubPieceManager(object):
+    def __init__(self):
+        self.uploaded = 0
+        self.downloaded = 0
+        self.left = 0
+        self.is_complete = False
+
+
+class StubClient(object):
+    MAX_PEERS = 50
+
+    def __init__(self, tracker, dht=None):
+        self.peer_id = b'-BP0001-000000000000'
+        self.info_hash = b'\x01' * 20
+        self.port = 6889
+        self.tracker = tracker
+        self.dht = dht
+        self.piece_manager = StubPieceManager()
+        self.peers = {}
+        self.peer_db = PeerDatabase()
+        self.added = []
+        self.sources = []
+
+    async def add_peers(self, peers, source="tracker"):
+        self.added.extend(peers)
+        self.sources.append(source)
+
+
+class StubDHT(object):
+    def __init__(self, peers):
+        self.peers = peers
+        self.announces = []
+
+    async def announce_peer(self, info_hash, port):
+        self.announces.append((info_hash, port))
+        return self.peers
+
+
+def make_response(interval, min_interval=None, peers=b''):
+    response = {b'interval': interval, b'peers': peers}
+    if min_interval is not None:
+        response[b'min interval'] = min_interval
+    return TrackerResponse(response=response)
+
+
+def fill_peers(client, count):
+    for i in range(count):
+        client.peers[(f"10.0.0.{i}", 6881)] = object()
+        client.peer_db.add(f"10.0.0.{i}", 6881, "tracker")
+
+
+class TestAnnouncer(TestCase):
+    def test_backoff(self):
+        announcer = Announcer(StubClient(StubTracker()))
+        for failures in range(1, 12):
+            backoff = announcer.get_backoff(failures)
+            expected = min(Announcer.BACKOFF_MAX, Announcer.BACKOFF_BASE * 2 ** (failures - 1))
+            self.assertGreaterEqual(backoff, expected * 0.5)
+            self.assertLessEqual(backoff, expected * 1.5)
+
+    def test_retries_failed_announce_with_backoff(self):
+        async def async_test(self):
+            tracker = StubTracker([None, None, make_response(60)])
+            client = StubClient(tracker)
+            announcer = Announcer(client)
+            failures = []
+            def get_backoff(num_failures):
+                failures.append(num_failures)
+                return 0.01
+            announcer.get_backoff = get_backoff
+
+            task = asyncio.create_task(announcer.run())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+            # 'started' is sent again until it gets through
+            self.assertEqual(tracker.announces, [('started', 50)] * 3)
+            self.assertEqual(failures, [1, 2])
+            self.assertEqual(announcer.num_failures, 0)
+        asyncio.run(async_test(self))
+
+    def test_completed_announced_after_min_interval(self):
+        async def async_test(self):
+            tracker = StubTracker([make_response(60, 0.05), make_response(60, 0.05)])
+            client = StubClient(tracker)
+            fill_peers(client, Announcer.LOW_PEERS)
+            announcer = Announcer(client)
+
+            task = asyncio.create_task(announcer.run())
+            await asyncio.sleep(0.01)
+            client.piece_manager.is_complete = True
+            announcer.wake()
+            await asyncio.wait_for(task, 1)
+
+            self.assertEqual([event for event, numwant in tracker.announces], ['started', 'completed'])
+        asyncio.run(async_test(self))
+
+    def test_waits_for_interval_with_enough_peers(self):
+        async def async_test(self):
+            tracker = StubTracker([make_response(60, 0.03)] * 20)
+            client = StubClient(tracker)
+            fill_peers(client, Announcer.LOW_PEERS)
+            announcer = Announcer(client)
+
+            task = asyncio.create_task(announcer.run())
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(tracker.announces), 1)
+
+            # losing peers announces early, but not before the min interval
+            client.peers = {}
+            announcer.wake()
+            await asyncio.sleep(0.1)
+            self.assertGreater(len(tracker.announces), 1)
+            self.assertLess(len(tracker.announces), 6)
+            self.assertEqual(tracker.announces[1][0], "")
+
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        asyncio.run(async_test(self))
+
+    def test_min_interval_defaults(self):
+        async def async_test(self):
+            tracker = StubTracker([make_response(0.05)] * 10)
+            client = StubClient(tracker)
+            announcer = Announcer(client)
+
+            # without a min interval from the tracker, being short of peers does not announce early
+            task = asyncio.create_task(announcer.run())
+            await asyncio.sleep(0.03)
+            self.assertEqual(len(tracker.announces), 1)
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(tracker.announces), 2)
+
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        asyncio.run(async_test(self))
+
+    def test_numwant(self):
+        tracker = StubTracker()
+        client = StubClient(tracker)
+        announcer = Announcer(client)
+        self.assertEqual(announcer.get_numwant(), StubClient.MAX_PEERS)
+
+        fill_peers(client, 20)
+        self.assertEqual(announcer.get_numwant(), StubClient.MAX_PEERS - 20)
+
+        # addresses we already know of but are not connected to need no new ones
+        for i in range(10):
+            client.peer_db.add(f"10.1.0.{i}", 6881, "pex")
+        self.assertEqual(announcer.get_numwant(), StubClient.MAX_PEERS - 30)
+
+        fill_peers(client, StubClient.MAX_PEERS)
+        self.assertEqual(announcer.get_numwant(), 0)
+
+    def test_peers_added(self):
+        async def async_test(self):
+            tracker = StubTracker([make_response(60, peers=bytes([10, 0, 0, 1, 0x1a, 0xe1]))])
+            client = StubClient(tracker)
+            client.piece_manager.is_complete = True
+            await Announcer(client).run()
+            self.assertEqual(client.added, [('10.0.0.1', 6881)])
+        asyncio.run(async_test(self))
+
+    def test_stop(self):
+        async def async_test(self):
+            tracker = StubTracker([make_response(60), make_response(60)])
+            client = StubClient(tracker)
+            fill_peers(client, Announcer.LOW_PEERS)
+            announcer = Announcer(client)
+
+            announcer.start()
+            await asyncio.sleep(0.01)
+            await announcer.stop()
+
+            self.assertIsNone(announcer.task)
+            self.assertEqual(tracker.announces, [('started', 50 - Announcer.LOW_PEERS), ('stopped', 0)])
+        asyncio.run(async_test(self))
+
+    def test_stop_without_started(self):
+        async def async_test(self):
+            tracker = StubTracker()
+            announcer = Announcer(StubClient(tracker))
+            announcer.get_backoff = lambda failures: 60
+
+            announcer.start()
+            await asyncio.sleep(0.01)
+            await announcer.stop()
+
+            # the tracker never knew about us, so it is not told we are leaving
+            self.assertEqual(tracker.announces, [('started', 50)])
+        asyncio.run(async_test(self))
+
+
+    def test_complete_without_tracker(self):
+        async def async_test(self):
+            tracker = StubTracker()
+            client = StubClient(tracker)
+            announcer = Announcer(client)
+            announcer.get_backoff = lambda failures: 60
+
+            # a download completed with peers from elsewhere ends the backoff, and the announces
+            # once the trackers fail again
+            task = asyncio.create_task(announcer.run())
+            await asyncio.sleep(0.01)
+            client.piece_manager.is_complete = True
+            announcer.wake()
+            await asyncio.wait_for(task, 1)
+            self.assertEqual([event for event, numwant in tracker.announces], ['started', 'started'])
+        asyncio.run(async_test(self))
+
+    def test_resumed_when_incomplete_again(self):
+        async def async_test(self):
+            tracker = StubTracker([make_response(60, 0.01)] * 4)
+            client = StubClient(tracker)
+            fill_peers(client, Announcer.LOW_PEERS)
+            client.piece_manager.is_complete = True
+            announcer = Announcer(client)
+            await announcer.run()
+
+            # a file wanted again after the download completed is announced for until it completes
+            client.piece_manager.is_complete = False
+            announcer.resume()
+            await asyncio.sleep(0.01)
+            self.assertTrue(announcer.is_running)
+            announcer.resume()
+            client.piece_manager.is_complete = True
+            announcer.wake()
+            await asyncio.wait_for(announcer.task, 1)
+            self.assertEqual([event for event, numwant in tracker.announces], ['started', '', 'completed'])
+        asyncio.run(async_test(self))
+
+    def test_dht_announce(self):
+        async def async_test(self):
+            dht = StubDHT([('10.0.0.5', 6881)])
+            client = StubClient(StubTracker([make_response(60)] * 2), dht)
+            fill_peers(client, Announcer.LOW_PEERS)
+            announcer = Announcer(client)
+
+            announcer.start()
+            await asyncio.sleep(0.01)
+            self.assertEqual(dht.announces, [(client.info_hash, client.port)])
+            self.assertIn(('10.0.0.5', 6881), client.added)
+            self.assertIn("dht", client.sources)
+
+            await announcer.stop()
+            self.assertIsNone(announcer.dht_task)
+        asyncio.run(async_test(self))
+
+
+class TestTrackerResponseMerge(TestCase):
+    def test_intervals(self):
+        merged = TrackerResponse.merge([make_response(1800, 60), make_response(900, 300), make_response(1200)])
+        self.assertEqual(merged.interval, 900)
+        self.assertEqual(merged.min_interval, 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
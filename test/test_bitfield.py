@@ -0,0 +1,62 @@
+import unittest
+from unittest import TestCase
+
+from bitsnpieces.bitfield import Bitfield
+
+
+class TestBitfield(TestCase):
+    def test_set_and_test(self):
+        bitfield = Bitfield(10)
+        bitfield[0] = True
+        bitfield[9] = True
+        self.assertEqual(bitfield.to_bytes(), b'\x80\x40')
+        self.assertTrue(bitfield[9])
+        self.assertFalse(bitfield[8])
+
+        bitfield[0] = False
+        self.assertEqual(bitfield.to_bytes(), b'\x00\x40')
+
+    def test_index_out_of_range(self):
+        bitfield = Bitfield(10)
+        with self.assertRaises(IndexError):
+            bitfield[10]
+        with self.assertRaises(IndexError):
+            bitfield[10] = True
+
+    def test_from_bytes_clears_spare_bits(self):
+        bitfield = Bitfield.from_bytes(b'\xff\xff', 10)
+        self.assertEqual(bitfield.to_bytes(), b'\xff\xc0')
+        self.assertEqual(bitfield.count(), 10)
+
+    def test_from_bytes_pads_short_data(self):
+        bitfield = Bitfield.from_bytes(b'\xff', 12)
+        self.assertEqual(bitfield.to_bytes(), b'\xff\x00')
+
+    def test_from_bytearray_not_copied(self):
+        data = bytearray(b'\x80')
+        bitfield = Bitfield.from_bytes(data, 8)
+        self.assertIs(bitfield.data, data)
+
+    def test_iter_set(self):
+        bitfield = Bitfield(20)
+        for index in (1, 7, 8, 19):
+            bitfield[index] = True
+        self.assertEqual(list(bitfield.iter_set()), [1, 7, 8, 19])
+        self.assertEqual([index for index, bit in enumerate(bitfield) if bit], [1, 7, 8, 19])
+
+    def test_set_all(self):
+        bitfield = Bitfield(13)
+        bitfield.set_all()
+        self.assertTrue(bitfield.all())
+        self.assertEqual(bitfield.to_bytes(), b'\xff\xf8')
+
+    def test_and_and_not(self):
+        peer = Bitfield.from_bytes(b'\xf0', 8)
+        have = Bitfield.from_bytes(b'\x30', 8)
+        self.assertEqual((peer & have).to_bytes(), b'\x30')
+        self.assertEqual((peer | have).to_bytes(), b'\xf0')
+        self.assertEqual(peer.and_not(have).to_bytes(), b'\xc0')
+        self.assertEqual(peer.count_and_not(have), 2)
+
+if __name__ == '__main__':
+    unittest.main()
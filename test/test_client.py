@@ -0,0 +1,607 @@
+import unittest
+from unittest import TestCase
+import asyncio
+import hashlib
+import os
+import random
+import tempfile
+from collections import OrderedDict
+
+from bitsnpieces import torrent
+from bitsnpieces import peer as messages
+from bitsnpieces.client import PieceManager, Piece
+from bitsnpieces.picker import PiecePicker
+from bitsnpieces.bitfield import Bitfield
+
+
+def make_torrent(data, piece_length):
+    """builds a single file torrent for the data"""
+
+    pieces = b"".join(hashlib.sha1(data[i:i+piece_length]).digest() for i in range(0, len(data), piece_length))
+    info = OrderedDict([(b'length', len(data)), (b'name', b'data.bin'), (b'piece length', piece_length),
+        (b'pieces', pieces)])
+    return torrent.Torrent(OrderedDict([(b'announce', b'http://localhost/announce'), (b'info', info)]))
+
+
+def make_multi_file_torrent(files, piece_length):
+    """builds a torrent for the (name, data) files"""
+
+    data = b"".join(file_data for _, file_data in files)
+    pieces = b"".join(hashlib.sha1(data[i:i+piece_length]).digest() for i in range(0, len(data), piece_length))
+    file_infos = [OrderedDict([(b'length', len(file_data)), (b'path', [name.encode()])]) for name, file_data in files]
+    info = OrderedDict([(b'files', file_infos), (b'name', b'data'), (b'piece length', piece_length),
+        (b'pieces', pieces)])
+    return torrent.Torrent(OrderedDict([(b'announce', b'http://localhost/announce'), (b'info', info)]))
+
+
+class StubPeer(object):
+    def __init__(self, num_pieces, pieces=(), ip='10.0.0.1'):
+        self.ip = ip
+        self.pieces_bitfield = Bitfield(num_pieces)
+        for index in pieces:
+            self.pieces_bitfield[index] = True
+        self.pieces_downloading = set()
+        self.downloaded = 0
+        self.download_speed = 0
+        self.cancelled = []
+        self.num_hash_failures = 0
+        self.is_banned = False
+        self.allowed_fast = set()
+        self.suggested_pieces = []
+
+    async def cancel_request(self, request):
+        self.cancelled.append(request)
+
+    async def ban(self):
+        self.is_banned = True
+        for piece in self.pieces_downloading:
+            piece.remove_peer(self)
+        self.pieces_downloading = set()
+
+
+class TestPieceManager(TestCase):
+    def setUp(self):
+        self.torrent = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+        self.download_directory = tempfile.TemporaryDirectory()
+        self.piece_manager = PieceManager(self.torrent, self.download_directory.name)
+        self.num_pieces = self.torrent.info.num_pieces
+
+    def make_peer(self, pieces):
+        peer = StubPeer(self.num_pieces, pieces)
+        self.piece_manager.add_peer_pieces(peer.pieces_bitfield)
+        return peer
+
+    def tearDown(self):
+        self.download_directory.cleanup()
+
+    def test_requested_block_not_given_to_other_peers(self):
+        first = self.make_peer([3])
+        second = self.make_peer([3])
+        num_blocks = self.piece_manager.get_piece(3).num_blocks
+
+        requests = [self.piece_manager.get_next_request(first) for _ in range(num_blocks)]
+        self.assertEqual({request.index for request in requests}, {3})
+        self.assertEqual(len({request.begin for request in requests}), num_blocks)
+        self.assertIsNone(self.piece_manager.get_next_request(second))
+
+    def test_released_request_given_to_other_peers(self):
+        first = self.make_peer([3])
+        second = self.make_peer([3])
+        num_blocks = self.piece_manager.get_piece(3).num_blocks
+
+        requests = [self.piece_manager.get_next_request(first) for _ in range(num_blocks)]
+        self.piece_manager.release_request(first, requests[5])
+        request = self.piece_manager.get_next_request(second)
+        self.assertEqual((request.index, request.begin), (3, requests[5].begin))
+
+    def test_timed_out_block_given_to_other_peers(self):
+        slow = self.make_peer([3])
+        other = self.make_peer([3])
+
+        # the slow peer gets the next block rather than the one it just missed the deadline of
+        request = self.piece_manager.get_next_request(slow)
+        self.piece_manager.release_request(slow, request, timed_out=True)
+        next_request = self.piece_manager.get_next_request(slow)
+        self.assertNotEqual(next_request.begin, request.begin)
+        self.assertEqual(self.piece_manager.get_next_request(other).begin, request.begin)
+
+    def test_disconnected_peer_blocks_released(self):
+        first = self.make_peer([3])
+        second = self.make_peer([3])
+
+        request = self.piece_manager.get_next_request(first)
+        for piece in first.pieces_downloading:
+            piece.remove_peer(first)
+        self.assertEqual(self.piece_manager.get_next_request(second).begin, request.begin)
+
+    def test_same_speed_class_peers_share_pieces(self):
+        first = self.make_peer(range(self.num_pieces))
+        second = self.make_peer(range(self.num_pieces))
+        first_request = self.piece_manager.get_next_request(first)
+        second_request = self.piece_manager.get_next_request(second)
+
+        self.assertEqual(first_request.index, second_request.index)
+        self.assertEqual(self.piece_manager.num_open_pieces, 1)
+
+    def test_fast_peer_gets_whole_piece(self):
+        fast = self.make_peer(range(self.num_pieces))
+        fast.download_speed = PieceManager.FAST_PEER_SPEED
+        slow = self.make_peer(range(self.num_pieces))
+        fast_request = self.piece_manager.get_next_request(fast)
+        slow_request = self.piece_manager.get_next_request(slow)
+
+        self.assertIs(self.piece_manager.pieces[fast_request.index].owner, fast)
+        self.assertNotEqual(fast_request.index, slow_request.index)
+
+        # the piece is open to others once the fast peer leaves
+        self.piece_manager.pieces[fast_request.index].remove_peer(fast)
+        self.assertIsNone(self.piece_manager.pieces[fast_request.index].owner)
+
+    def test_left(self):
+        total_size = self.torrent.total_size
+        self.assertEqual(self.piece_manager.left, total_size)
+        self.piece_manager.have[0] = True
+        self.piece_manager.wanted[1] = False
+        self.assertEqual(self.piece_manager.left, total_size - 2 * self.piece_manager.piece_length)
+
+    def test_reserved_piece_opened_when_owner_stalls(self):
+        self.piece_manager.max_open_pieces = 1
+        fast = self.make_peer(range(self.num_pieces))
+        fast.download_speed = PieceManager.FAST_PEER_SPEED
+        other = self.make_peer(range(self.num_pieces))
+        first, second = [self.piece_manager.get_next_request(fast) for _ in range(2)]
+        self.assertIsNone(self.piece_manager.get_next_request(other))
+
+        # the fast peer's request times out, the piece is no longer reserved for it
+        self.piece_manager.release_request(fast, first, timed_out=True)
+        request = self.piece_manager.get_next_request(other)
+        self.assertEqual((request.index, request.begin), (first.index, first.begin))
+
+        # choking us opens the pieces a peer owns too
+        piece = self.piece_manager.pieces[first.index]
+        piece.owner = fast
+        self.piece_manager.peer_choked(fast)
+        self.assertIsNone(piece.owner)
+        self.assertEqual(self.piece_manager.get_next_request(other).index, first.index)
+
+    def test_open_pieces_bounded(self):
+        self.piece_manager.max_open_pieces = 2
+        peers = [self.make_peer(range(self.num_pieces)) for _ in range(3)]
+        for peer in peers:
+            peer.download_speed = PieceManager.FAST_PEER_SPEED
+        self.assertIsNotNone(self.piece_manager.get_next_request(peers[0]))
+        self.assertIsNotNone(self.piece_manager.get_next_request(peers[1]))
+
+        # both open pieces belong to fast peers and no third one is started
+        self.assertIsNone(self.piece_manager.get_next_request(peers[2]))
+        self.assertEqual(self.piece_manager.num_open_pieces, 2)
+
+    def test_open_piece_age(self):
+        self.assertEqual(self.piece_manager.get_open_piece_age(), 0)
+        piece = self.piece_manager.get_piece(3)
+        self.assertAlmostEqual(self.piece_manager.get_open_piece_age(piece.start_time + 5), 5)
+
+    def test_rarest_piece_requested_first(self):
+        self.piece_manager.picker.random_first_pieces = 0
+        self.make_peer([1, 2])
+        self.make_peer([2])
+        peer = self.make_peer([1, 2, 7])
+        self.assertEqual(self.piece_manager.get_next_request(peer).index, 7)
+
+    def test_suggested_piece_requested_first(self):
+        self.piece_manager.picker.random_first_pieces = 0
+        self.make_peer([1, 2])
+        peer = self.make_peer([1, 2, 7])
+        peer.suggested_pieces = [9, 2]
+        self.assertEqual(self.piece_manager.get_next_request(peer).index, 2)
+
+    def test_allowed_fast_request(self):
+        peer = self.make_peer([1, 2, 7])
+        self.assertIsNone(self.piece_manager.get_allowed_fast_request(peer))
+
+        # pieces the peer does not have are skipped
+        peer.allowed_fast = {4, 7}
+        request = self.piece_manager.get_allowed_fast_request(peer)
+        self.assertEqual(request.index, 7)
+
+        # once every block of the piece is requested there is nothing else we may ask for
+        for _ in range(self.piece_manager.pieces[7].num_blocks - 1):
+            self.assertEqual(self.piece_manager.get_allowed_fast_request(peer).index, 7)
+        self.assertIsNone(self.piece_manager.get_allowed_fast_request(peer))
+
+
+class TestPieceManagerDownload(TestCase):
+    def setUp(self):
+        self.piece_length = 2 * Piece.BLOCK_LENGTH
+        self.data = bytes(random.getrandbits(8) for _ in range(3 * self.piece_length - 100))
+        self.torrent = make_torrent(self.data, self.piece_length)
+        self.download_directory = tempfile.TemporaryDirectory()
+        self.piece_manager = PieceManager(self.torrent, self.download_directory.name)
+
+    def tearDown(self):
+        self.download_directory.cleanup()
+
+    async def download(self, peer):
+        while True:
+            request = self.piece_manager.get_next_request(peer)
+            if request is None:
+                break
+            block = self.data[request.index * self.piece_length + request.begin:][:request.length]
+            await self.piece_manager.download_block(peer, messages.Piece(request.index, request.begin, block))
+
+    def test_no_piece_objects_until_requested(self):
+        self.assertEqual(self.piece_manager.pieces, {})
+        self.assertEqual(self.piece_manager.piece_states, bytearray(3))
+
+    def test_count_wanted_pieces(self):
+        peer = StubPeer(3, [0, 2])
+        self.assertEqual(self.piece_manager.count_wanted_pieces(peer.pieces_bitfield), 2)
+        self.piece_manager.have[2] = True
+        self.assertEqual(self.piece_manager.count_wanted_pieces(peer.pieces_bitfield), 1)
+        self.assertFalse(self.piece_manager.is_piece_wanted(2))
+
+    def test_complete_pieces_released(self):
+        peer = StubPeer(3, [0, 1, 2])
+        peer.downloaded = 0
+        self.piece_manager.add_peer_pieces(peer.pieces_bitfield)
+        asyncio.run(self.download(peer))
+
+        self.assertTrue(self.piece_manager.is_complete)
+        self.assertEqual(self.piece_manager.pieces, {})
+        self.assertTrue(all(self.piece_manager.is_piece_complete(index) for index in range(3)))
+        with open(os.path.join(self.download_directory.name, 'data.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def get_block(self, request):
+        block = self.data[request.index * self.piece_length + request.begin:][:request.length]
+        return messages.Piece(request.index, request.begin, block)
+
+    async def send_blocks(self, peer, count, corrupt=False):
+        for _ in range(count):
+            request = self.piece_manager.get_next_request(peer)
+            message = self.get_block(request)
+            if corrupt:
+                message.block = bytes(len(message.block))
+            await self.piece_manager.download_block(peer, message)
+
+    def test_corrupt_piece_from_single_peer(self):
+        peer = StubPeer(3, [0])
+        self.piece_manager.add_peer_pieces(peer.pieces_bitfield)
+        asyncio.run(self.send_blocks(peer, 2, corrupt=True))
+
+        # the piece is reset and the peer banned
+        piece = self.piece_manager.pieces[0]
+        self.assertEqual(piece.num_complete_blocks, 0)
+        self.assertTrue(piece.has_free_blocks)
+        self.assertFalse(self.piece_manager.have[0])
+        self.assertTrue(peer.is_banned)
+        self.assertEqual(self.piece_manager.num_hash_failures, 1)
+        self.assertEqual(self.piece_manager.hash_failed_bytes, self.piece_length)
+        self.assertEqual(self.piece_manager.num_banned_peers, 1)
+
+        # the piece can be downloaded again from someone else
+        honest = StubPeer(3, [0], ip='10.0.0.2')
+        self.piece_manager.add_peer_pieces(honest.pieces_bitfield)
+        asyncio.run(self.send_blocks(honest, 2))
+        self.assertTrue(self.piece_manager.have[0])
+
+    def test_corrupt_piece_from_several_peers(self):
+        first, second = StubPeer(3, [0], ip='10.0.0.1'), StubPeer(3, [0], ip='10.0.0.2')
+        self.piece_manager.add_peer_pieces(first.pieces_bitfield)
+        self.piece_manager.add_peer_pieces(second.pieces_bitfield)
+        asyncio.run(self.send_blocks(first, 1, corrupt=True))
+        asyncio.run(self.send_blocks(second, 1))
+
+        # both are suspected and the piece is downloaded from one of them alone
+        self.assertEqual((first.num_hash_failures, second.num_hash_failures), (1, 1))
+        self.assertFalse(first.is_banned or second.is_banned)
+        piece = self.piece_manager.pieces[0]
+        self.assertTrue(piece.is_suspect)
+        request = self.piece_manager.get_next_request(first)
+        self.assertEqual(request.index, 0)
+        self.assertIs(piece.owner, first)
+        self.assertIsNone(self.piece_manager.get_next_request(second))
+
+        # failing again alone gets it banned
+        asyncio.run(self.piece_manager.download_block(first, self.get_block(request)))
+        asyncio.run(self.send_blocks(first, 1, corrupt=True))
+        self.assertTrue(first.is_banned)
+        self.assertFalse(second.is_banned)
+
+    def test_repeat_offender_banned(self):
+        first, second = StubPeer(3, [0], ip='10.0.0.1'), StubPeer(3, [0], ip='10.0.0.2')
+        first.num_hash_failures = PieceManager.MAX_HASH_FAILURES - 1
+        self.piece_manager.add_peer_pieces(first.pieces_bitfield)
+        self.piece_manager.add_peer_pieces(second.pieces_bitfield)
+        asyncio.run(self.send_blocks(first, 1, corrupt=True))
+        asyncio.run(self.send_blocks(second, 1))
+
+        self.assertTrue(first.is_banned)
+        self.assertFalse(second.is_banned)
+
+    def test_endgame_duplicates_requested_blocks(self):
+        slow, fast = StubPeer(3, [0, 1, 2]), StubPeer(3, [2])
+        self.piece_manager.add_peer_pieces(slow.pieces_bitfield)
+        self.piece_manager.add_peer_pieces(fast.pieces_bitfield)
+
+        # the slow peer is asked for every block
+        requests = []
+        while True:
+            request = self.piece_manager.get_next_request(slow)
+            if request is None:
+                break
+            requests.append(request)
+        self.assertEqual(len(requests), 6)
+        self.assertTrue(self.piece_manager.is_endgame)
+
+        # the fast peer gets the blocks of the piece it has, each once
+        duplicates = [self.piece_manager.get_next_request(fast) for _ in range(2)]
+        self.assertEqual({(request.index, request.begin) for request in duplicates},
+            {(2, 0), (2, Piece.BLOCK_LENGTH)})
+        self.assertIsNone(self.piece_manager.get_next_request(fast))
+        self.assertEqual(self.piece_manager.duplicate_bytes, sum(request.length for request in duplicates))
+
+        # the first copy to arrive cancels the other one, the late copy is wasted
+        asyncio.run(self.piece_manager.download_block(fast, self.get_block(duplicates[0])))
+        self.assertEqual([(request.index, request.begin) for request in slow.cancelled],
+            [(duplicates[0].index, duplicates[0].begin)])
+        self.assertEqual(fast.cancelled, [])
+        self.assertGreater(self.piece_manager.endgame_time_saved, 0)
+
+        asyncio.run(self.piece_manager.download_block(slow, self.get_block(duplicates[0])))
+        self.assertEqual(self.piece_manager.wasted_bytes, duplicates[0].length)
+
+    def test_endgame_duplicate_bytes_capped(self):
+        slow, fast = StubPeer(3, [0, 1, 2]), StubPeer(3, [0, 1, 2])
+        self.piece_manager.add_peer_pieces(slow.pieces_bitfield)
+        self.piece_manager.add_peer_pieces(fast.pieces_bitfield)
+        while self.piece_manager.get_next_request(slow) is not None:
+            pass
+
+        self.piece_manager.duplicate_bytes = PieceManager.MAX_ENDGAME_DUPLICATE_BYTES
+        self.assertIsNone(self.piece_manager.get_next_request(fast))
+
+    def test_endgame_left_when_piece_forgotten(self):
+        slow, fast = StubPeer(3, [0, 1, 2]), StubPeer(3, [2])
+        self.piece_manager.add_peer_pieces(slow.pieces_bitfield)
+        self.piece_manager.add_peer_pieces(fast.pieces_bitfield)
+        while self.piece_manager.get_next_request(slow) is not None:
+            pass
+        duplicates = [self.piece_manager.get_next_request(fast) for _ in range(2)]
+        for request in duplicates:
+            asyncio.run(self.piece_manager.download_block(fast, self.get_block(request)))
+        self.assertTrue(self.piece_manager.is_endgame)
+
+        # a piece that is missing again is downloaded normally, not duplicated
+        self.piece_manager.forget_piece(2)
+        self.assertFalse(self.piece_manager.is_endgame)
+        self.assertEqual(self.piece_manager.duplicate_bytes, 0)
+        request = self.piece_manager.get_next_request(fast)
+        self.assertEqual((request.index, request.begin), (2, 0))
+        self.assertEqual(self.piece_manager.duplicate_bytes, 0)
+
+    def test_no_endgame_while_blocks_free(self):
+        first, second = StubPeer(3, [0, 1, 2]), StubPeer(3, [0])
+        self.piece_manager.add_peer_pieces(first.pieces_bitfield)
+        self.piece_manager.add_peer_pieces(second.pieces_bitfield)
+        self.piece_manager.get_next_request(second)
+        self.piece_manager.get_next_request(second)
+
+        self.assertIsNone(self.piece_manager.get_next_request(second))
+        self.assertFalse(self.piece_manager.is_endgame)
+
+
+class TestStreaming(TestCase):
+    def setUp(self):
+        self.piece_length = Piece.BLOCK_LENGTH
+        self.data = bytes(random.getrandbits(8) for _ in range(8 * self.piece_length - 100))
+        self.torrent = make_torrent(self.data, self.piece_length)
+        self.download_directory = tempfile.TemporaryDirectory()
+        self.piece_manager = PieceManager(self.torrent, self.download_directory.name)
+
+    def tearDown(self):
+        self.download_directory.cleanup()
+
+    def make_peer(self):
+        peer = StubPeer(8, range(8))
+        self.piece_manager.add_peer_pieces(peer.pieces_bitfield)
+        return peer
+
+    async def download_piece(self, peer, index):
+        self.piece_manager.get_piece(index).get_next_request(peer)
+        block = self.data[index * self.piece_length:][:self.piece_length]
+        await self.piece_manager.download_block(peer, messages.Piece(index, 0, block))
+
+    def test_window_requested_in_order(self):
+        self.piece_manager.stream_window = 3
+        self.piece_manager.set_read_cursor(5)
+        peer = self.make_peer()
+        self.assertEqual([self.piece_manager.get_next_request(peer).index for _ in range(3)], [5, 6, 7])
+        self.assertEqual(sorted(self.piece_manager.deadlines), [5, 6, 7])
+        self.assertLess(self.piece_manager.deadlines[5], self.piece_manager.deadlines[6])
+
+        # outside the window the usual picking goes on
+        self.assertNotIn(self.piece_manager.get_next_request(peer).index, [5, 6, 7])
+
+    def test_window_skips_complete_pieces(self):
+        peer = self.make_peer()
+        self.piece_manager.set_read_cursor(0)
+        asyncio.run(self.download_piece(peer, 0))
+        self.assertEqual(self.piece_manager.get_stream_window()[0], 1)
+        self.assertEqual(self.piece_manager.read_cursor, 1)
+
+    def test_duplicate_request_near_deadline(self):
+        self.piece_manager.stream_window = 1
+        self.piece_manager.set_read_cursor(2)
+        slow, fast = self.make_peer(), self.make_peer()
+        self.assertEqual(self.piece_manager.get_next_request(slow).index, 2)
+        self.assertNotEqual(self.piece_manager.get_next_request(fast).index, 2)
+
+        self.piece_manager.deadlines[2] = 0
+        request = self.piece_manager.get_next_request(fast)
+        self.assertEqual((request.index, request.begin), (2, 0))
+        self.assertEqual(self.piece_manager.duplicate_bytes, request.length)
+
+    def test_read_waits_until_verified(self):
+        async def async_test(self):
+            peer = self.make_peer()
+            offset, length = self.piece_length - 10, self.piece_length + 20
+            read_task = asyncio.create_task(self.piece_manager.read(offset, length))
+            await asyncio.sleep(0)
+            self.assertEqual(self.piece_manager.read_cursor, 0)
+
+            # the range spans pieces 0 to 2
+            await self.download_piece(peer, 0)
+            await self.download_piece(peer, 1)
+            await asyncio.sleep(0)
+            self.assertFalse(read_task.done())
+
+            await self.download_piece(peer, 2)
+            self.assertEqual(await asyncio.wait_for(read_task, 1), self.data[offset:offset + length])
+        asyncio.run(async_test(self))
+
+    def test_read_after_download_complete(self):
+        async def async_test(self):
+            peer = self.make_peer()
+            for index in range(8):
+                await self.download_piece(peer, index)
+            self.assertTrue(self.piece_manager.is_complete)
+            self.assertEqual(await self.piece_manager.read(100, len(self.data) - 100), self.data[100:])
+        asyncio.run(async_test(self))
+
+    def test_read_out_of_range(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.piece_manager.read(len(self.data) - 10, 20))
+
+
+class TestFilePriorities(TestCase):
+    def setUp(self):
+        # pieces 1 and 3 are shared by file b and its neighbours
+        self.piece_length = Piece.BLOCK_LENGTH
+        self.files = [(name, bytes(random.getrandbits(8) for _ in range(length))) for name, length in
+            [('a', 2 * self.piece_length - 100), ('b', self.piece_length + 200), ('c', 2 * self.piece_length)]]
+        self.data = b"".join(file_data for _, file_data in self.files)
+        self.torrent = make_multi_file_torrent(self.files, self.piece_length)
+        self.download_directory = tempfile.TemporaryDirectory()
+        self.piece_manager = PieceManager(self.torrent, self.download_directory.name)
+        self.peer = StubPeer(6, range(6))
+        self.piece_manager.add_peer_pieces(self.peer.pieces_bitfield)
+
+    def tearDown(self):
+        self.download_directory.cleanup()
+
+    async def download(self):
+        while True:
+            request = self.piece_manager.get_next_request(self.peer)
+            if request is None:
+                break
+            block = self.data[request.index * self.piece_length + request.begin:][:request.length]
+            await self.piece_manager.download_block(self.peer, messages.Piece(request.index, request.begin, block))
+
+    def read_file(self, name):
+        with open(os.path.join(self.download_directory.name, name), 'rb') as f:
+            return f.read()
+
+    def test_skipped_file_pieces_not_wanted(self):
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_SKIP)
+        self.assertEqual([self.piece_manager.is_piece_wanted(index) for index in range(6)],
+            [True, True, False, True, True, True])
+        self.assertEqual(self.piece_manager.num_wanted_pieces, 5)
+        self.assertEqual(self.piece_manager.count_wanted_pieces(self.peer.pieces_bitfield), 5)
+
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_NORMAL)
+        self.assertEqual(self.piece_manager.num_wanted_pieces, 6)
+
+    def test_skipped_file_kept_out_of_download_files(self):
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_SKIP)
+        asyncio.run(self.download())
+
+        self.assertTrue(self.piece_manager.is_complete)
+        self.assertFalse(self.piece_manager.have[2])
+        self.assertEqual(self.read_file('a'), self.files[0][1])
+        self.assertEqual(self.read_file('c'), self.files[2][1])
+        self.assertFalse(os.path.exists(os.path.join(self.download_directory.name, 'b')))
+
+    def test_file_wanted_again_after_download(self):
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_SKIP)
+        asyncio.run(self.download())
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_HIGH)
+        self.assertFalse(self.piece_manager.is_complete)
+        asyncio.run(self.download())
+
+        self.assertTrue(self.piece_manager.is_complete)
+        for name, file_data in self.files:
+            self.assertEqual(self.read_file(name), file_data)
+
+    def test_intact_pieces_kept_when_file_wanted_again(self):
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_SKIP)
+        asyncio.run(self.download())
+        self.assertFalse(self.piece_manager.is_piece_intact(1))
+
+        # the piece shared with file a finds its data of file b on disk, the one shared with file c does not
+        with open(os.path.join(self.download_directory.name, 'b'), 'wb') as f:
+            f.write(self.files[1][1][:100])
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_HIGH)
+        self.assertEqual([self.piece_manager.have[index] for index in range(6)],
+            [True, True, False, False, True, True])
+
+    def test_high_priority_file_first(self):
+        self.piece_manager.picker.random_first_pieces = 0
+        self.piece_manager.set_file_priority(2, PiecePicker.PRIORITY_HIGH)
+        self.assertIn(self.piece_manager.get_next_request(self.peer).index, [3, 4, 5])
+
+    def test_skipping_abandons_open_piece(self):
+        piece = self.piece_manager.get_piece(4)
+        piece.get_next_request(self.peer)
+        self.piece_manager.set_file_priority(2, PiecePicker.PRIORITY_SKIP)
+
+        self.assertNotIn(4, self.piece_manager.pieces)
+        self.assertEqual(self.peer.pieces_downloading, set())
+
+    def test_read_skipped_file(self):
+        self.piece_manager.set_file_priority(1, PiecePicker.PRIORITY_SKIP)
+        with self.assertRaises(ValueError):
+            asyncio.run(self.piece_manager.read(2 * self.piece_length, 10))
+
+
+class StubPieceManager(object):
+    def __init__(self):
+        self.torrent = None
+
+
+class TestPiece(TestCase):
+    def setUp(self):
+        self.piece = Piece(StubPieceManager(), 0, 1024 * Piece.BLOCK_LENGTH)
+
+    def test_each_block_handed_out_once(self):
+        peers = [StubPeer(1) for _ in range(8)]
+        begins = []
+        while True:
+            request = self.piece.get_next_request(peers[len(begins) % len(peers)])
+            if request is None:
+                break
+            begins.append(request.begin)
+
+        self.assertEqual(sorted(begins), [i * Piece.BLOCK_LENGTH for i in range(1024)])
+        self.assertEqual(self.piece.downloading_from, set(peers))
+        self.assertEqual(sum(len(blocks) for blocks in self.piece.peer_blocks.values()), 1024)
+
+    def test_released_block_handed_out_next(self):
+        peer = StubPeer(1)
+        requests = [self.piece.get_next_request(peer) for _ in range(10)]
+        self.piece.release_block(peer, 4)
+        self.assertEqual(self.piece.get_next_request(StubPeer(1)).begin, requests[4].begin)
+
+    def test_removed_peer_blocks_freed(self):
+        slow, fast = StubPeer(1), StubPeer(1)
+        for _ in range(3):
+            self.piece.get_next_request(slow)
+        self.piece.remove_peer(slow)
+
+        self.assertNotIn(slow, self.piece.downloading_from)
+        self.assertEqual(self.piece.requested_blocks, {})
+        self.assertEqual([self.piece.get_next_request(fast).begin for _ in range(4)],
+            [i * Piece.BLOCK_LENGTH for i in range(4)])
+
+if __name__ == '__main__':
+    unittest.main()
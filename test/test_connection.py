@@ -0,0 +1,158 @@
+import unittest
+from unittest import TestCase
+import asyncio
+import socket
+
+from bitsnpieces import torrent
+from bitsnpieces.connection import ConnectionManager
+from bitsnpieces.peerdb import PeerDatabase
+from bitsnpieces.utils import generate_peer_id
+
+
+class StubClient(object):
+    MAX_PEERS = 10
+
+    def __init__(self):
+        self.torrent = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+        self.peer_id = generate_peer_id()
+        self.peers = {}
+        self.peer_db = PeerDatabase()
+
+    def add_peer(self, peer):
+        self.peers[peer.address] = peer
+
+    def remove_peer(self, peer):
+        self.peers.pop(peer.address, None)
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestConnectionManager(TestCase):
+    def test_backoff_grows_and_is_capped(self):
+        async def async_test(self):
+            manager = ConnectionManager(StubClient())
+            for failures in range(1, 4):
+                base = ConnectionManager.BACKOFF_BASE * 2 ** (failures - 1)
+                backoff = manager.get_backoff(failures)
+                self.assertGreaterEqual(backoff, base * 0.5)
+                self.assertLessEqual(backoff, base * 1.5)
+            self.assertLessEqual(manager.get_backoff(100), ConnectionManager.BACKOFF_MAX * 1.5)
+        asyncio.run(async_test(self))
+
+    def test_unreachable_peer_backs_off(self):
+        async def async_test(self):
+            manager = ConnectionManager(StubClient())
+            port = unused_port()
+            manager.peer_db.add('127.0.0.1', port)
+            manager.dial_candidates()
+            await asyncio.gather(*manager.dial_tasks.values())
+
+            state = manager.peer_db.get(('127.0.0.1', port))
+            self.assertEqual(state.failures, 1)
+            self.assertFalse(state.has_succeeded)
+            self.assertEqual(manager.dial_tasks, {})
+            self.assertIsNotNone(manager.retry_handle)
+            await manager.close()
+        asyncio.run(async_test(self))
+
+    def test_unreachable_peer_forgotten(self):
+        async def async_test(self):
+            manager = ConnectionManager(StubClient())
+            port = unused_port()
+            manager.peer_db.add('127.0.0.1', port)
+            state = manager.peer_db.get(('127.0.0.1', port))
+            for _ in range(ConnectionManager.MAX_FAILURES):
+                state.next_attempt = 0
+                await manager.dial(state)
+            self.assertNotIn(('127.0.0.1', port), manager.peer_db)
+            await manager.close()
+        asyncio.run(async_test(self))
+
+    def test_concurrent_dials_bounded(self):
+        async def async_test(self):
+            accepted = []
+
+            async def silent_peer(reader, writer):
+                # accept the connection but never answer the handshake
+                accepted.append(writer)
+
+            servers = [await asyncio.start_server(silent_peer, '127.0.0.1', 0) for _ in range(5)]
+            manager = ConnectionManager(StubClient(), max_concurrent_dials=2)
+            for server in servers:
+                manager.peer_db.add('127.0.0.1', server.sockets[0].getsockname()[1])
+            manager.dial_candidates()
+            await asyncio.sleep(0.2)
+
+            self.assertEqual(len(manager.dial_tasks), 5)
+            self.assertEqual(len(accepted), 2)
+
+            await manager.close()
+            self.assertEqual(manager.dial_tasks, {})
+            for writer in accepted:
+                writer.close()
+            for server in servers:
+                server.close()
+        asyncio.run(async_test(self))
+
+    def test_successful_peers_dialled_first(self):
+        async def async_test(self):
+            client = StubClient()
+            client.MAX_PEERS = 1
+            manager = ConnectionManager(client)
+            port = unused_port()
+            manager.peer_db.add('127.0.0.1', port)
+            manager.peer_db.add('127.0.0.2', port)
+            manager.peer_db.get(('127.0.0.2', port)).has_succeeded = True
+            manager.dial_candidates()
+            self.assertEqual(list(manager.dial_tasks), [('127.0.0.2', port)])
+            await manager.close()
+        asyncio.run(async_test(self))
+
+    def test_slow_peer_replaced_by_better_candidate(self):
+        async def async_test(self):
+            class StubPeer(object):
+                inbound = False
+                download_speed = 0
+
+                def __init__(self, client, address):
+                    self.client = client
+                    self.address = address
+                    self.connected_time = 0
+                    self.disconnected = False
+
+                async def disconnect(self):
+                    self.disconnected = True
+                    self.client.remove_peer(self)
+
+            client = StubClient()
+            client.MAX_PEERS = 2
+            manager = ConnectionManager(client)
+
+            slow = StubPeer(client, ('10.0.0.1', 6881))
+            fast = StubPeer(client, ('10.0.0.2', 6881))
+            fast.download_speed = 500 * 1024
+            for peer in (slow, fast):
+                client.peer_db.add(*peer.address).has_succeeded = True
+                client.add_peer(peer)
+
+            # an unknown candidate is not better than a connected peer
+            client.peer_db.add('10.0.0.3', 6881)
+            await manager.replace_peers()
+            self.assertFalse(slow.disconnected)
+
+            # a candidate that was fast before replaces the slowest peer
+            candidate = client.peer_db.add('10.0.0.4', 6881)
+            candidate.has_succeeded = True
+            candidate.download_speed = 100 * 1024
+            await manager.replace_peers()
+            self.assertTrue(slow.disconnected)
+            self.assertFalse(fast.disconnected)
+            await manager.close()
+        asyncio.run(async_test(self))
+
+if __name__ == '__main__':
+    unittest.main()
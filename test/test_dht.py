@@ -0,0 +1,195 @@
+import os
+import unittest
+from unittest import TestCase
+import asyncio
+import tempfile
+
+from bitsnpieces.dht import (DHTNode, DHTError, RoutingTable, distance, encode_nodes, decode_nodes,
+    encode_peer, decode_peers)
+
+
+def node_id(first_byte: int, rest: int=0) -> bytes:
+    return bytes([first_byte]) + bytes([rest]) * 19
+
+
+class TestRoutingTable(TestCase):
+    def test_add_and_split(self):
+        table = RoutingTable(node_id(0))
+        for i in range(1, 256):
+            table.add(node_id(i), '10.0.0.1', 6881 + i)
+
+        # buckets far from our ID hold K nodes, the ones close to it are split
+        self.assertEqual(len(table.get_bucket(node_id(255))), RoutingTable.K)
+        self.assertGreater(len(table.buckets), 1)
+        self.assertEqual(sum(len(bucket) for bucket in table.buckets), len(table))
+        for bucket in table.buckets:
+            self.assertLessEqual(len(bucket), RoutingTable.K)
+            for node in bucket.nodes.values():
+                self.assertTrue(bucket.covers(node.node_id))
+
+        # our own ID is never added
+        self.assertIsNone(table.add(node_id(0), '10.0.0.1', 6881))
+
+    def test_full_bucket_replaces_bad_nodes(self):
+        table = RoutingTable(node_id(0))
+        for i in range(RoutingTable.K):
+            table.add(node_id(128 + i), '10.0.0.1', 7000 + i)
+        # split the first bucket so that the upper half does not cover our ID
+        for i in range(RoutingTable.K):
+            table.add(node_id(1 + i), '10.0.0.2', 7000 + i)
+
+        self.assertIsNone(table.add(node_id(200), '10.0.0.3', 6881))
+        for _ in range(RoutingTable.MAX_FAILURES):
+            table.failed(node_id(130))
+        self.assertIsNotNone(table.add(node_id(200), '10.0.0.3', 6881))
+        self.assertIsNone(table.get(node_id(130)))
+
+    def test_closest(self):
+        table = RoutingTable(node_id(0))
+        for i in range(1, 64):
+            table.add(node_id(i * 4), '10.0.0.1', 6881 + i)
+        target = node_id(41, 1)
+        closest = table.closest(target, 3)
+        self.assertEqual([node.node_id for node in closest], [node_id(40), node_id(44), node_id(32)])
+        self.assertEqual(closest, sorted(table, key=lambda node: distance(node.node_id, target))[:3])
+
+
+class TestCompactInfo(TestCase):
+    def test_nodes(self):
+        table = RoutingTable(node_id(0))
+        table.add(node_id(1), '10.0.0.1', 6881)
+        table.add(node_id(2), '192.168.0.2', 51413)
+        compact = encode_nodes(table)
+        self.assertEqual(len(compact), 52)
+        self.assertEqual(decode_nodes(compact + b'\x00'), [(node_id(1), '10.0.0.1', 6881), (node_id(2), '192.168.0.2', 51413)])
+
+    def test_peers(self):
+        values = [encode_peer('10.0.0.1', 6881), b'short', encode_peer('10.0.0.2', 6882)]
+        self.assertEqual(decode_peers(values), [('10.0.0.1', 6881), ('10.0.0.2', 6882)])
+
+
+class TestDHTNode(TestCase):
+    async def start_cluster(self, size: int) -> list:
+        """starts nodes on loopback, each bootstrapping from the first one"""
+        nodes = [DHTNode(host='127.0.0.1', port=0, bootstrap_nodes=[])]
+        await nodes[0].start()
+        for _ in range(size - 1):
+            node = DHTNode(host='127.0.0.1', port=0, bootstrap_nodes=[('127.0.0.1', nodes[0].port)])
+            await node.start()
+            nodes.append(node)
+        await asyncio.gather(*(node.bootstrapped.wait() for node in nodes))
+        # a second round lets the early nodes learn about the later ones
+        await asyncio.gather(*(node.find_node(node.node_id) for node in nodes))
+        return nodes
+
+    async def close_cluster(self, nodes):
+        for node in nodes:
+            await node.close()
+
+    def test_lookup_finds_closest_nodes(self):
+        async def async_test(self):
+            nodes = await self.start_cluster(24)
+            target = os.urandom(20)
+            found = await nodes[-1].find_node(target)
+            await self.close_cluster(nodes)
+
+            expected = sorted((node.node_id for node in nodes[:-1]), key=lambda n: distance(n, target))[:RoutingTable.K]
+            self.assertEqual([node_id for node_id, address, token in found], expected)
+        asyncio.run(async_test(self))
+
+    def test_announce_and_get_peers(self):
+        async def async_test(self):
+            nodes = await self.start_cluster(24)
+            info_hash = os.urandom(20)
+
+            self.assertEqual(await nodes[5].announce_peer(info_hash, 6881), [])
+            await nodes[9].announce_peer(info_hash, 6882)
+            peers = await nodes[17].get_peers(info_hash)
+            await self.close_cluster(nodes)
+
+            self.assertEqual(sorted(peers), [('127.0.0.1', 6881), ('127.0.0.1', 6882)])
+
+            # the peers are stored on the nodes closest to the info hash, other than the announcing ones
+            storing = [node for node in nodes if info_hash in node.peers]
+            closest = sorted(nodes, key=lambda node: distance(node.node_id, info_hash))[:RoutingTable.K + 2]
+            self.assertTrue(storing)
+            self.assertTrue(all(node in closest for node in storing))
+        asyncio.run(async_test(self))
+
+    def test_announce_needs_token(self):
+        async def async_test(self):
+            nodes = await self.start_cluster(2)
+            info_hash = os.urandom(20)
+            address = ('127.0.0.1', nodes[0].port)
+            with self.assertRaises(DHTError) as e:
+                await nodes[1].query(address, b'announce_peer', {b'info_hash': info_hash, b'port': 6881, b'token': b'x'})
+            self.assertEqual(e.exception.code, DHTError.PROTOCOL)
+
+            response = await nodes[1].query(address, b'get_peers', {b'info_hash': info_hash})
+            await nodes[1].query(address, b'announce_peer',
+                {b'info_hash': info_hash, b'port': 6881, b'token': response[b'token'], b'implied_port': 1})
+            with self.assertRaises(DHTError) as e:
+                await nodes[1].query(address, b'vote', {})
+            self.assertEqual(e.exception.code, DHTError.METHOD_UNKNOWN)
+            await self.close_cluster(nodes)
+
+            # implied_port announces the port the query came from
+            self.assertEqual(list(nodes[0].peers[info_hash]), [('127.0.0.1', nodes[1].port)])
+        asyncio.run(async_test(self))
+
+    def test_token_rotation(self):
+        node = DHTNode(bootstrap_nodes=[])
+        token = node.get_token('10.0.0.1')
+        self.assertTrue(node.is_valid_token(token, '10.0.0.1'))
+        self.assertFalse(node.is_valid_token(token, '10.0.0.2'))
+
+        # a token stays valid for one rotation of the secret
+        node.token_secret_time -= DHTNode.TOKEN_LIFETIME + 1
+        self.assertNotEqual(node.get_token('10.0.0.1'), token)
+        self.assertTrue(node.is_valid_token(token, '10.0.0.1'))
+        node.token_secret_time -= DHTNode.TOKEN_LIFETIME + 1
+        node.get_token('10.0.0.1')
+        self.assertFalse(node.is_valid_token(token, '10.0.0.1'))
+
+    def test_unanswered_query(self):
+        async def async_test(self):
+            nodes = await self.start_cluster(2)
+            silent = nodes[0]
+            silent.transport.pause_reading()
+            silent_id = silent.node_id
+
+            with self.assertRaises(asyncio.TimeoutError):
+                await nodes[1].query(('127.0.0.1', silent.port), b'ping', {}, node_id=silent_id)
+            self.assertEqual(nodes[1].routing_table.get(silent_id).failures, 1)
+            await self.close_cluster(nodes)
+        DHTNode.QUERY_TIMEOUT, timeout = 0.1, DHTNode.QUERY_TIMEOUT
+        try:
+            asyncio.run(async_test(self))
+        finally:
+            DHTNode.QUERY_TIMEOUT = timeout
+
+    def test_saved_state(self):
+        async def async_test(self, state_path):
+            nodes = await self.start_cluster(12)
+            saved = DHTNode(host='127.0.0.1', port=0, bootstrap_nodes=[], state_path=state_path)
+            await saved.start()
+            await saved.lookup(saved.node_id, b'find_node', initial=[(None, ('127.0.0.1', nodes[0].port))])
+            known = len(saved.routing_table)
+            await saved.close()
+
+            # the restarted node keeps its ID and bootstraps from the saved nodes alone
+            restarted = DHTNode(host='127.0.0.1', port=0, bootstrap_nodes=[], state_path=state_path)
+            self.assertEqual(restarted.node_id, saved.node_id)
+            self.assertEqual(len(restarted.routing_table), known)
+            await restarted.start()
+            await restarted.bootstrapped.wait()
+            self.assertTrue(any(not node.is_bad for node in restarted.routing_table))
+            await restarted.close()
+            await self.close_cluster(nodes)
+
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(async_test(self, os.path.join(directory, 'dht_state')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,288 @@
+import unittest
+from unittest import TestCase
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+from bitsnpieces import peer
+from bitsnpieces import torrent
+from bitsnpieces.bencode import encoder, decoder
+from bitsnpieces.metadata import (MetadataCache, MetadataExchange, MetadataFetcher, PIECE_LENGTH, MSG_REQUEST,
+    MSG_DATA, MSG_REJECT, encode_message, decode_message, get_num_pieces)
+from bitsnpieces.utils import generate_peer_id
+
+
+def make_metadata(num_pieces: int) -> bytes:
+    """builds a B-encoded info dictionary of a torrent with the number of pieces"""
+
+    info = OrderedDict([(b'length', num_pieces * 16384), (b'name', b'data.bin'), (b'piece length', 16384),
+        (b'pieces', bytes(i % 256 for i in range(num_pieces * 20)))])
+    return encoder.encode(info)
+
+
+class StubSeeder(object):
+    """
+    a peer that has the metadata and answers ut_metadata requests, with corrupt data if asked to, or
+    rejects the first few requests as a peer that does not have the metadata yet would
+    """
+
+    EXTENDED_ID = 3
+
+    def __init__(self, metadata: bytes, corrupt: bool=False, num_rejected: int=0):
+        self.metadata = metadata
+        self.corrupt = corrupt
+        self.num_rejected = num_rejected
+        self.served = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return ('127.0.0.1', self.server.sockets[0].getsockname()[1])
+
+    def close(self):
+        self.server.close()
+
+    async def handle(self, reader, writer):
+        try:
+            handshake, buffer = await peer.read_handshake(reader)
+            writer.write(peer.Handshake(handshake.info_hash, generate_peer_id(),
+                peer.Handshake.make_reserved_bytes(peer.Handshake.EXTENSION_PROTOCOL_BIT)).encode())
+            extension_handshake = {b'm': {b'ut_metadata': StubSeeder.EXTENDED_ID}, b'metadata_size': len(self.metadata)}
+            writer.write(peer.Extended(peer.Extended.HANDSHAKE_ID, encoder.encode(extension_handshake)).encode())
+
+            their_id = None
+            async for message in peer.PeerStreamIterator(reader, buffer):
+                if not isinstance(message, peer.Extended):
+                    continue
+                if message.extended_id == peer.Extended.HANDSHAKE_ID:
+                    their_id = decoder.decode(message.payload)[b'm'][b'ut_metadata']
+                elif message.extended_id == StubSeeder.EXTENDED_ID:
+                    request, _ = decode_message(message.payload)
+                    index = request[b'piece']
+                    if self.num_rejected > 0:
+                        self.num_rejected -= 1
+                        writer.write(peer.Extended(their_id, encode_message(MSG_REJECT, index)).encode())
+                        await writer.drain()
+                        continue
+                    data = self.metadata[index * PIECE_LENGTH:(index + 1) * PIECE_LENGTH]
+                    if self.corrupt:
+                        data = bytes(byte ^ 0xff for byte in data)
+                    self.served.append(index)
+                    writer.write(peer.Extended(their_id, encode_message(MSG_DATA, index, data, len(self.metadata))).encode())
+                    await writer.drain()
+        except (ConnectionError, peer.PeerError):
+            pass
+        writer.close()
+
+
+class StubPeer(object):
+    def __init__(self, extension_ids=None):
+        self.extension_ids = extension_ids or {}
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def disconnect(self):
+        pass
+
+
+class StubClient(object):
+    def __init__(self):
+        self.torrent = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+
+
+class TestMessages(TestCase):
+    def test_encode_decode(self):
+        message, data = decode_message(encode_message(MSG_DATA, 2, b'abc', 16387))
+        self.assertEqual(message, {b'msg_type': MSG_DATA, b'piece': 2, b'total_size': 16387})
+        self.assertEqual(data, b'abc')
+        self.assertIsNone(decode_message(b'garbage'))
+        self.assertIsNone(decode_message(encoder.encode({b'msg_type': MSG_REQUEST})))
+
+    def test_num_pieces(self):
+        self.assertEqual(get_num_pieces(1), 1)
+        self.assertEqual(get_num_pieces(PIECE_LENGTH), 1)
+        self.assertEqual(get_num_pieces(PIECE_LENGTH + 1), 2)
+
+
+class TestMetadataCache(TestCase):
+    def test_memory(self):
+        metadata = make_metadata(10)
+        info_hash = hashlib.sha1(metadata).digest()
+        cache = MetadataCache()
+        self.assertIsNone(cache.get(info_hash))
+        cache.put(info_hash, metadata)
+        self.assertEqual(cache.get(info_hash), metadata)
+
+    def test_disk(self):
+        metadata = make_metadata(10)
+        info_hash = hashlib.sha1(metadata).digest()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metadata')
+            MetadataCache(path).put(info_hash, metadata)
+            self.assertEqual(MetadataCache(path).get(info_hash), metadata)
+
+            # metadata that no longer matches its info hash is not used
+            with open(os.path.join(path, info_hash.hex()), 'wb') as f:
+                f.write(metadata[:-1])
+            self.assertIsNone(MetadataCache(path).get(info_hash))
+
+
+class TestMetadataExchange(TestCase):
+    def test_requests_answered(self):
+        async def async_test(self):
+            client = StubClient()
+            exchange = MetadataExchange(client)
+            self.assertEqual(hashlib.sha1(exchange.metadata).digest(), client.torrent.info.get_sha1())
+
+            # peers that did not tell us their ut_metadata ID are not answered
+            p = StubPeer()
+            await exchange.handle_message(p, encode_message(MSG_REQUEST, 0))
+            self.assertEqual(p.sent, [])
+
+            p = StubPeer({b'ut_metadata': 7})
+            last = get_num_pieces(exchange.metadata_size) - 1
+            await exchange.handle_message(p, encode_message(MSG_REQUEST, last))
+            await exchange.handle_message(p, encode_message(MSG_REQUEST, last + 1))
+            self.assertEqual([message.extended_id for message in p.sent], [7, 7])
+
+            message, data = decode_message(p.sent[0].payload)
+            self.assertEqual(message[b'msg_type'], MSG_DATA)
+            self.assertEqual(message[b'total_size'], exchange.metadata_size)
+            self.assertEqual(data, exchange.metadata[last * PIECE_LENGTH:])
+            message, data = decode_message(p.sent[1].payload)
+            self.assertEqual(message[b'msg_type'], MSG_REJECT)
+            self.assertEqual(data, b'')
+        asyncio.run(async_test(self))
+
+
+class TestMetadataFetcher(TestCase):
+    def make_fetcher(self, metadata, peers=(), cache=None):
+        magnet = torrent.Magnet(hashlib.sha1(metadata).digest(), peers=list(peers))
+        return MetadataFetcher(magnet, generate_peer_id(), cache=cache)
+
+    def test_pieces_handed_out(self):
+        fetcher = self.make_fetcher(make_metadata(2000))
+        first, second = ('10.0.0.1', 6881), ('10.0.0.2', 6881)
+        self.assertTrue(fetcher.set_metadata_size(40000, first))
+        self.assertFalse(fetcher.set_metadata_size(40001, second))
+
+        self.assertEqual([fetcher.get_next_piece(first), fetcher.get_next_piece(first)], [0, 1])
+        self.assertEqual(fetcher.get_next_piece(second), 2)
+
+        # every piece is requested, a slow peer's piece is asked of another one too
+        self.assertEqual(fetcher.get_next_piece(second), 0)
+        self.assertTrue(fetcher.add_piece(0, bytes(PIECE_LENGTH), second))
+        self.assertTrue(fetcher.add_piece(0, bytes(PIECE_LENGTH), first))
+        self.assertEqual(fetcher.piece_senders, {0: second})
+
+        # pieces that were not requested from the peer or have the wrong length are refused
+        self.assertFalse(fetcher.add_piece(1, bytes(PIECE_LENGTH), second))
+        self.assertFalse(fetcher.add_piece(2, bytes(PIECE_LENGTH), second))
+
+        fetcher.release_pieces(first)
+        self.assertEqual(fetcher.get_next_piece(('10.0.0.3', 6881)), 1)
+
+    def test_wrong_size_forgotten(self):
+        metadata = make_metadata(1)
+        fetcher = self.make_fetcher(metadata)
+        liar, honest = ('10.0.0.1', 6881), ('10.0.0.2', 6881)
+        self.assertTrue(fetcher.set_metadata_size(len(metadata) + 1, liar))
+        self.assertFalse(fetcher.set_metadata_size(len(metadata), honest))
+        fetcher.peer_failed(liar)
+
+        # metadata of the wrong size fails verification, and the size is taken from the next peer
+        self.assertEqual(fetcher.get_next_piece(liar), 0)
+        self.assertTrue(fetcher.add_piece(0, metadata + b'e', liar))
+        self.assertEqual(fetcher.bad, {liar})
+        self.assertEqual(fetcher.requested, {})
+        self.assertNotIn(liar, fetcher.next_attempt)
+        self.assertNotIn(liar, fetcher.failures)
+        self.assertTrue(fetcher.set_metadata_size(len(metadata), honest))
+        self.assertEqual(fetcher.get_next_piece(honest), 0)
+        self.assertTrue(fetcher.add_piece(0, metadata, honest))
+        self.assertEqual(fetcher.metadata, metadata)
+
+    def test_fetch_from_several_peers(self):
+        async def async_test(self):
+            metadata = make_metadata(2000)
+            seeders = [StubSeeder(metadata) for _ in range(2)]
+            addresses = [await seeder.start() for seeder in seeders]
+            cache = MetadataCache()
+            fetcher = self.make_fetcher(metadata, addresses, cache)
+
+            self.assertEqual(await asyncio.wait_for(fetcher.fetch(), 5), metadata)
+            self.assertTrue(all(seeder.served for seeder in seeders))
+            self.assertEqual(set(seeders[0].served) | set(seeders[1].served), {0, 1, 2})
+
+            # the next start takes it from the cache
+            self.assertEqual(await asyncio.wait_for(self.make_fetcher(metadata, cache=cache).fetch(), 1), metadata)
+            for seeder in seeders:
+                seeder.close()
+        asyncio.run(async_test(self))
+
+    def test_rejecting_peer_retried(self):
+        async def async_test(self):
+            metadata = make_metadata(10)
+            seeder = StubSeeder(metadata, num_rejected=1)
+            address = await seeder.start()
+            fetcher = self.make_fetcher(metadata, [address])
+
+            # the only peer rejects the first request and is asked again once its backoff is over
+            self.assertEqual(await asyncio.wait_for(fetcher.fetch(), 5), metadata)
+            self.assertEqual(fetcher.failures, {address: 1})
+            self.assertEqual(seeder.served, [0])
+            seeder.close()
+        MetadataFetcher.BACKOFF_BASE, backoff = 0.1, MetadataFetcher.BACKOFF_BASE
+        try:
+            asyncio.run(async_test(self))
+        finally:
+            MetadataFetcher.BACKOFF_BASE = backoff
+
+    def test_no_busy_loop_on_bad_peer(self):
+        async def async_test(self):
+            fetcher = self.make_fetcher(make_metadata(10))
+            bad = ('10.0.0.1', 6881)
+            fetcher.next_attempt[bad] = time.monotonic() - 1
+            fetcher.bad.add(bad)
+            add_peers = fetcher.add_peers
+            calls = []
+            fetcher.add_peers = lambda peers: calls.append(peers) or add_peers(peers)
+
+            # a bad peer's stale retry time does not wake the fetch loop over and over
+            task = asyncio.create_task(fetcher.fetch())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self.assertLess(len(calls), 5)
+        asyncio.run(async_test(self))
+
+    def test_corrupt_metadata_refetched(self):
+        async def async_test(self):
+            metadata = make_metadata(100)
+            corrupt, good = StubSeeder(metadata, corrupt=True), StubSeeder(metadata)
+            corrupt_address = await corrupt.start()
+            good_address = await good.start()
+            fetcher = self.make_fetcher(metadata, [corrupt_address])
+
+            task = asyncio.create_task(fetcher.fetch())
+            while not fetcher.bad:
+                await asyncio.sleep(0.01)
+            self.assertEqual(fetcher.bad, {corrupt_address})
+
+            # the peer that sent bad pieces is not asked again
+            fetcher.add_peers([corrupt_address, good_address])
+            self.assertEqual(await asyncio.wait_for(task, 5), metadata)
+            self.assertEqual(corrupt.served, [0])
+            self.assertEqual(good.served, [0])
+            corrupt.close()
+            good.close()
+        asyncio.run(async_test(self))
+
+
+if __name__ == '__main__':
+    unittest.main()
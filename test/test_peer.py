@@ -2,10 +2,16 @@ import unittest
 from unittest import TestCase
 import struct
 import random
-from bitstring import BitArray
+import time
+import asyncio
 
 from bitsnpieces import peer
+from bitsnpieces.bitfield import Bitfield
+from bitsnpieces import torrent
 from bitsnpieces.client import generate_peer_id
+from bitsnpieces.timer import TimerWheel
+from bitsnpieces.peerdb import PeerDatabase
+from bitsnpieces.bencode import encoder, decoder
 
 
 class TestDecodePeerMessages(TestCase):
@@ -58,13 +64,16 @@ class TestDecodePeerMessages(TestCase):
     
     def test_decode_bitfield(self):
         bitfield_length = 50
-        bitfield = BitArray([i % 2 for i in range(bitfield_length)])
-        bitfield_as_bytes = bitfield.tobytes()
+        bitfield = Bitfield(bitfield_length)
+        for i in range(1, bitfield_length, 2):
+            bitfield[i] = True
+        bitfield_as_bytes = bitfield.to_bytes()
         encoded = struct.pack('>Ib', 1 + len(bitfield_as_bytes), peer.BitField.ID) + bitfield_as_bytes
 
         msg = peer.BitField.decode(encoded)
         self.assertIsInstance(msg, peer.BitField)
-        self.assertEqual(msg.bitfield[:len(bitfield)], bitfield)
+        msg.bitfield.resize(bitfield_length)
+        self.assertEqual(msg.bitfield, bitfield)
 
     def test_decode_request(self):
         msg = peer.Request.decode(struct.pack('>IbIII', 13, 6, 0, 1, 16384))
@@ -89,6 +98,36 @@ class TestDecodePeerMessages(TestCase):
         self.assertEqual(msg.begin, 1)
         self.assertEqual(msg.length, 16384)
 
+    def test_decode_extended(self):
+        msg = peer.Extended.decode(struct.pack('>IbB', 5, 20, 3) + b'abc')
+        self.assertIsInstance(msg, peer.Extended)
+        self.assertEqual(msg.extended_id, 3)
+        self.assertEqual(msg.payload, b'abc')
+
+    def test_decode_fast_messages(self):
+        msg = peer.SuggestPiece.decode(struct.pack('>IbI', 5, 13, 23))
+        self.assertIsInstance(msg, peer.SuggestPiece)
+        self.assertEqual(msg.piece_index, 23)
+        self.assertIsInstance(peer.HaveAll.decode(struct.pack('>Ib', 1, 14)), peer.HaveAll)
+        self.assertIsInstance(peer.HaveNone.decode(struct.pack('>Ib', 1, 15)), peer.HaveNone)
+        msg = peer.RejectRequest.decode(struct.pack('>IbIII', 13, 16, 0, 1, 16384))
+        self.assertIsInstance(msg, peer.RejectRequest)
+        self.assertEqual((msg.index, msg.begin, msg.length), (0, 1, 16384))
+        msg = peer.AllowedFast.decode(struct.pack('>IbI', 5, 17, 42))
+        self.assertIsInstance(msg, peer.AllowedFast)
+        self.assertEqual(msg.piece_index, 42)
+
+    def test_reserved_bits(self):
+        reserved = peer.Handshake.make_reserved_bytes(peer.Handshake.EXTENSION_PROTOCOL_BIT)
+        self.assertEqual(reserved, b"\x00\x00\x00\x00\x00\x10\x00\x00")
+        handshake = peer.Handshake.decode(peer.Handshake(b'a' * 20, b'b' * 20, reserved).encode())
+        self.assertTrue(handshake.has_reserved_bit(peer.Handshake.EXTENSION_PROTOCOL_BIT))
+        self.assertFalse(peer.Handshake(b'a' * 20, b'b' * 20).has_reserved_bit(peer.Handshake.EXTENSION_PROTOCOL_BIT))
+
+        reserved = peer.Handshake.make_reserved_bytes(peer.Handshake.EXTENSION_PROTOCOL_BIT,
+            peer.Handshake.FAST_EXTENSION_BIT)
+        self.assertEqual(reserved, b"\x00\x00\x00\x00\x00\x10\x00\x04")
+
 
 class TestEncodePeerMessages(TestCase):
     def test_encode_handshake(self):
@@ -135,8 +174,10 @@ class TestEncodePeerMessages(TestCase):
     
     def test_encode_bitfield(self):
         bitfield_length = 50
-        bitfield = BitArray([i % 2 for i in range(bitfield_length)])
-        bitfield_as_bytes = bitfield.tobytes()
+        bitfield = Bitfield(bitfield_length)
+        for i in range(1, bitfield_length, 2):
+            bitfield[i] = True
+        bitfield_as_bytes = bitfield.to_bytes()
         truth = struct.pack('>Ib', 1 + len(bitfield_as_bytes), peer.BitField.ID) + bitfield_as_bytes
 
         message = peer.BitField(bitfield)
@@ -161,6 +202,14 @@ class TestEncodePeerMessages(TestCase):
         message = peer.Piece(index, begin, block)
         self.assertEqual(message.encode(), truth)
 
+    def test_encode_fast_messages(self):
+        self.assertEqual(peer.SuggestPiece(23).encode(), struct.pack('>IbI', 5, peer.SuggestPiece.ID, 23))
+        self.assertEqual(peer.HaveAll().encode(), struct.pack('>Ib', 1, peer.HaveAll.ID))
+        self.assertEqual(peer.HaveNone().encode(), struct.pack('>Ib', 1, peer.HaveNone.ID))
+        self.assertEqual(peer.RejectRequest(0, 1, 16384).encode(),
+            struct.pack('>IbIII', 13, peer.RejectRequest.ID, 0, 1, 16384))
+        self.assertEqual(peer.AllowedFast(42).encode(), struct.pack('>IbI', 5, peer.AllowedFast.ID, 42))
+
     def test_encode_cancel(self):
         index = 0
         begin = 1
@@ -168,4 +217,468 @@ class TestEncodePeerMessages(TestCase):
         truth = struct.pack('>IbIII', 13, peer.Cancel.ID, index, begin, length)
 
         message = peer.Cancel(index, begin, length)
-        self.assertEqual(message.encode(), truth)
\ No newline at end of file
+        self.assertEqual(message.encode(), truth)
+
+
+class StubPieceManager(object):
+    def __init__(self, num_pieces=0):
+        self.released = []
+        self.is_near_end = False
+        self.have = Bitfield(num_pieces)
+        self.added_pieces = []
+        self.downloaded = []
+
+    def release_request(self, p, request, timed_out=False):
+        self.released.append((p, request))
+
+    def peer_choked(self, p):
+        pass
+
+    def add_peer_pieces(self, bitfield):
+        self.added_pieces.extend(bitfield.iter_set())
+
+    def add_peer_piece(self, index):
+        self.added_pieces.append(index)
+
+    def is_piece_wanted(self, index):
+        return not self.have[index]
+
+    async def download_block(self, p, message):
+        self.downloaded.append(message)
+        return False
+
+    def remove_peer_pieces(self, bitfield):
+        pass
+
+    def count_wanted_pieces(self, bitfield):
+        return bitfield.count_and_not(self.have)
+
+    def get_allowed_fast_request(self, p):
+        return peer.Request(min(p.allowed_fast), 0, 16384)
+
+
+class StubClient(object):
+    def __init__(self):
+        self.torrent = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+        self.peer_id = generate_peer_id()
+        self.timer_wheel = TimerWheel()
+        self.piece_manager = StubPieceManager(self.torrent.info.num_pieces)
+        self.peer_db = PeerDatabase()
+        self.peer_exchange = StubPeerExchange()
+        self.metadata_exchange = StubMetadataExchange()
+        self.port = 6889
+        self.removed = []
+
+    def remove_peer(self, p):
+        self.removed.append(p)
+
+
+class StubPeerExchange(object):
+    def __init__(self):
+        self.messages = []
+
+    async def handle_message(self, p, payload):
+        self.messages.append((p, payload))
+
+
+class StubMetadataExchange(object):
+    def __init__(self):
+        self.metadata_size = 31337
+        self.messages = []
+
+    async def handle_message(self, p, payload):
+        self.messages.append((p, payload))
+
+
+class BrokenWriter(object):
+    """a stream writer whose connection fails with the error"""
+
+    def __init__(self, error):
+        self.error = error
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        raise self.error
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class ConnectedPeerTestCase(TestCase):
+    async def connected_peer(self):
+        received = asyncio.Queue()
+
+        async def remote_peer(reader, writer):
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                await received.put(data)
+            writer.close()
+
+        server = await asyncio.start_server(remote_peer, '127.0.0.1', 0)
+        client = StubClient()
+        p = peer.Peer(client, client.torrent, '127.0.0.1', server.sockets[0].getsockname()[1])
+        p.reader, p.writer = await asyncio.open_connection(p.ip, p.port)
+        p.is_connected = True
+        now = time.monotonic()
+        p.last_received = p.last_sent = p.last_block_time = now
+        return server, client, p, received
+
+
+class TestPeerTimeouts(ConnectedPeerTestCase):
+    def test_keepalive_sent_when_quiet(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            p.last_sent -= peer.Peer.KEEP_ALIVE_INTERVAL + 1
+            await p.check_timeouts()
+
+            data = await asyncio.wait_for(received.get(), 1)
+            self.assertEqual(data, peer.KeepAlive().encode())
+            self.assertTrue(p.is_connected)
+            self.assertIsNotNone(p.timeout_timer)
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_idle_connection_dropped(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            p.last_received -= peer.Peer.IDLE_TIMEOUT + 1
+            await p.check_timeouts()
+
+            self.assertFalse(p.is_connected)
+            self.assertEqual(client.removed, [p])
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_snubbing_peer_dropped(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+
+            class StubPiece(object):
+                def __init__(self):
+                    self.removed = []
+
+                def remove_peer(self, p):
+                    self.removed.append(p)
+
+            piece = StubPiece()
+            p.pieces_downloading = {piece}
+            p.outstanding_requests = {(0, 0): None}
+            p.peer_choking = False
+            p.last_block_time -= peer.Peer.SNUB_TIMEOUT + 1
+            self.assertTrue(p.is_snubbed(time.monotonic()))
+            await p.check_timeouts()
+
+            self.assertFalse(p.is_connected)
+            self.assertEqual(piece.removed, [p])
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_expired_request_released_and_cancelled(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            request = peer.Request(3, 16384, 16384)
+            await p.send_request(request)
+            self.assertEqual(await asyncio.wait_for(received.get(), 1), request.encode())
+            self.assertIn((3, 16384), p.outstanding_requests)
+
+            await p.expire_request(request)
+            self.assertEqual(p.outstanding_requests, {})
+            self.assertEqual(client.piece_manager.released, [(p, request)])
+            self.assertEqual(await asyncio.wait_for(received.get(), 1),
+                peer.Cancel(3, 16384, 16384).encode())
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_arrived_request_not_expired(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            request = peer.Request(3, 0, 16384)
+            await p.send_request(request)
+            p.complete_request(3, 0)
+
+            await p.expire_request(request)
+            self.assertEqual(client.piece_manager.released, [])
+            self.assertEqual(len(client.timer_wheel), 0)
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_banned_peer_disconnected(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            client.peer_db.add(p.ip, p.port)
+            await p.ban()
+
+            self.assertFalse(p.is_connected)
+            self.assertEqual(client.removed, [p])
+            self.assertTrue(client.peer_db.is_banned(p.ip))
+            self.assertEqual(len(client.peer_db), 0)
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_duplicate_request_cancelled(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            request = peer.Request(3, 0, 16384)
+            await p.send_request(request)
+            self.assertEqual(await asyncio.wait_for(received.get(), 1), request.encode())
+
+            await p.cancel_request(request)
+            self.assertEqual(p.outstanding_requests, {})
+            self.assertEqual(len(client.timer_wheel), 0)
+            self.assertEqual(await asyncio.wait_for(received.get(), 1), peer.Cancel(3, 0, 16384).encode())
+
+            # nothing is sent for a request that is no longer outstanding
+            await p.cancel_request(request)
+            self.assertTrue(received.empty())
+            self.assertEqual(client.piece_manager.released, [])
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+
+class TestDisconnectedPeer(ConnectedPeerTestCase):
+    def test_buffered_pieces_not_counted(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            bitfield = Bitfield(len(p.pieces_bitfield))
+            bitfield[0] = True
+            p.reader = asyncio.StreamReader()
+            p.reader.feed_data(peer.BitField(bitfield).encode() + peer.Have(1).encode())
+            await p.disconnect()
+
+            # the peer's pieces were already taken out of the availability, they are not added back
+            await asyncio.wait_for(p.start_receiving(), 1)
+            self.assertEqual(client.piece_manager.added_pieces, [])
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_blocks_of_banned_peer_dropped(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            p.reader = asyncio.StreamReader()
+            p.reader.feed_data(peer.Piece(0, 0, bytes(16384)).encode())
+            await p.ban()
+
+            await asyncio.wait_for(p.start_receiving(), 1)
+            self.assertEqual(client.piece_manager.downloaded, [])
+            server.close()
+        asyncio.run(async_test(self))
+
+
+class TestPeerInterest(ConnectedPeerTestCase):
+    def test_interested_on_transition_only(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            p.num_wanted_pieces = 2
+            await p.update_interest()
+            self.assertTrue(p.am_interested)
+            self.assertEqual(await asyncio.wait_for(received.get(), 1), peer.Interested().encode())
+
+            # no message while interest does not change
+            p.num_wanted_pieces = 1
+            await p.update_interest()
+            self.assertTrue(received.empty())
+
+            p.num_wanted_pieces = 0
+            await p.update_interest()
+            self.assertFalse(p.am_interested)
+            self.assertEqual(await asyncio.wait_for(received.get(), 1), peer.NotInterested().encode())
+            self.assertTrue(p.is_connected)
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_useless_peer_dropped_near_end(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            client.piece_manager.is_near_end = True
+            p.peer_interested = True
+            await p.update_interest()
+            self.assertTrue(p.is_connected)
+
+            p.peer_interested = False
+            await p.update_interest()
+            self.assertFalse(p.is_connected)
+            server.close()
+        asyncio.run(async_test(self))
+
+
+class TestExtensionProtocol(ConnectedPeerTestCase):
+    def test_extension_handshake_sent(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+
+            # nothing is sent to peers that do not support the extension protocol
+            await p.send_extension_handshake()
+            self.assertTrue(received.empty())
+
+            p.supports_extensions = True
+            await p.send_extension_handshake()
+            data = await asyncio.wait_for(received.get(), 1)
+            message = peer.Extended.decode(data)
+            self.assertEqual(message.extended_id, peer.Extended.HANDSHAKE_ID)
+            handshake = decoder.decode(message.payload)
+            self.assertEqual(handshake[b'm'], peer.Peer.EXTENSIONS)
+            self.assertEqual(handshake[b'p'], 6889)
+            self.assertEqual(handshake[b'metadata_size'], 31337)
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_extension_handshake_received(self):
+        async def async_test(self):
+            client = StubClient()
+            p = peer.Peer(client, client.torrent, '10.0.0.1', 50000, inbound=True)
+            self.assertIsNone(p.listen_address)
+
+            handshake = {b'm': {b'ut_pex': 2, b'ut_metadata': 3}, b'p': 6881, b'v': b'test'}
+            await p.handle_extended(peer.Extended(0, encoder.encode(handshake)))
+            self.assertEqual(p.extension_ids, {b'ut_pex': 2, b'ut_metadata': 3})
+            self.assertEqual(p.listen_address, ('10.0.0.1', 6881))
+
+            # a later handshake disables an extension
+            await p.handle_extended(peer.Extended(0, encoder.encode({b'm': {b'ut_metadata': 0}})))
+            self.assertEqual(p.extension_ids, {b'ut_pex': 2})
+
+            # malformed handshakes are ignored
+            await p.handle_extended(peer.Extended(0, b'garbage'))
+            self.assertEqual(p.extension_ids, {b'ut_pex': 2})
+
+            # messages of our extensions arrive with our IDs
+            await p.handle_extended(peer.Extended(peer.Peer.EXTENSIONS[b'ut_pex'], b'de'))
+            self.assertEqual(client.peer_exchange.messages, [(p, b'de')])
+            await p.handle_extended(peer.Extended(peer.Peer.EXTENSIONS[b'ut_metadata'], b'de'))
+            self.assertEqual(client.metadata_exchange.messages, [(p, b'de')])
+        asyncio.run(async_test(self))
+
+
+class TestFastExtension(ConnectedPeerTestCase):
+    async def read_messages(self, received, *messages):
+        expected = b"".join(message.encode() for message in messages)
+        data = b""
+        while len(data) < len(expected):
+            data += await asyncio.wait_for(received.get(), 1)
+        return data, expected
+
+    def test_have_all_or_none_sent(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+
+            # peers without the Fast Extension get a bitfield, and only once we have some pieces
+            await p.send_pieces()
+            self.assertTrue(received.empty())
+
+            p.supports_fast = True
+            await p.send_pieces()
+            self.assertEqual(await asyncio.wait_for(received.get(), 1), peer.HaveNone().encode())
+
+            client.piece_manager.have.set_all()
+            await p.send_pieces()
+            self.assertEqual(await asyncio.wait_for(received.get(), 1), peer.HaveAll().encode())
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_rejected_request_released(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            request = peer.Request(3, 16384, 16384)
+            await p.send_request(request)
+
+            p.reject_request(peer.RejectRequest(3, 16384, 16384))
+            self.assertEqual(p.outstanding_requests, {})
+            self.assertEqual(len(client.timer_wheel), 0)
+            self.assertEqual(p.num_rejected_requests, 1)
+            self.assertEqual([(released.index, released.begin) for _, released in client.piece_manager.released],
+                [(3, 16384)])
+
+            # requests that are not outstanding are not released again
+            p.reject_request(peer.RejectRequest(3, 16384, 16384))
+            self.assertEqual(len(client.piece_manager.released), 1)
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_fast_messages_received(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            p.supports_fast = True
+            p.reader = asyncio.StreamReader()
+            for message in (peer.HaveAll(), peer.SuggestPiece(5), peer.Request(1, 0, 16384), peer.AllowedFast(3)):
+                p.reader.feed_data(message.encode())
+            p.reader.feed_eof()
+            await p.start_receiving()
+
+            self.assertTrue(p.pieces_bitfield.all())
+            self.assertEqual(list(p.suggested_pieces), [5])
+            self.assertEqual(p.allowed_fast, {3})
+
+            # we do not upload, so the request is rejected, and the allowed fast piece is requested
+            # even though the peer chokes us
+            data, expected = await self.read_messages(received, peer.Interested(),
+                peer.RejectRequest(1, 0, 16384), peer.Request(3, 0, 16384))
+            self.assertEqual(data, expected)
+            self.assertIn((3, 0), p.outstanding_requests)
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+    def test_fast_message_without_extension(self):
+        async def async_test(self):
+            server, client, p, received = await self.connected_peer()
+            p.reader = asyncio.StreamReader()
+            p.reader.feed_data(peer.HaveAll().encode() + peer.Have(1).encode())
+
+            # the peer did not negotiate the Fast Extension, nothing after its message is consumed
+            await asyncio.wait_for(p.start_receiving(), 1)
+            self.assertFalse(p.pieces_bitfield.any())
+
+            await p.disconnect()
+            server.close()
+        asyncio.run(async_test(self))
+
+
+class TestHandshake(TestCase):
+    def test_accept_fails_when_handshake_not_sent(self):
+        async def async_test(self):
+            client = StubClient()
+            p = peer.Peer(client, client.torrent, '10.0.0.1', 50000, inbound=True)
+            handshake = peer.Handshake(client.torrent.info.get_sha1(), generate_peer_id())
+
+            accepted = await p.accept(asyncio.StreamReader(), BrokenWriter(ConnectionResetError()), handshake)
+            self.assertFalse(accepted)
+            self.assertFalse(p.is_connected)
+            self.assertIsNone(p.communication_task)
+            self.assertEqual(client.removed, [p])
+        asyncio.run(async_test(self))
+
+    def test_handshake_error_disconnects(self):
+        async def async_test(self):
+            client = StubClient()
+            p = peer.Peer(client, client.torrent, '10.0.0.1', 50000)
+            p.reader, p.writer = asyncio.StreamReader(), BrokenWriter(BrokenPipeError())
+            p.is_connected = True
+
+            self.assertFalse(await p.handshake())
+            self.assertFalse(p.is_connected)
+            self.assertEqual(client.removed, [p])
+        asyncio.run(async_test(self))
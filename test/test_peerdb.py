@@ -0,0 +1,60 @@
+import unittest
+from unittest import TestCase
+import time
+
+from bitsnpieces.peerdb import PeerDatabase
+
+
+class TestPeerDatabase(TestCase):
+    def test_add_merges_duplicates(self):
+        peer_db = PeerDatabase()
+        first = peer_db.add('10.0.0.1', 6881, 'tracker')
+        second = peer_db.add('10.0.0.1', 6881, 'pex')
+        peer_db.add('10.0.0.1', 6882, 'tracker')
+
+        self.assertIs(first, second)
+        self.assertEqual(first.sources, {'tracker', 'pex'})
+        self.assertEqual(len(peer_db), 2)
+        self.assertIn(('10.0.0.1', 6881), peer_db)
+
+    def test_candidates_ordered_by_score(self):
+        peer_db = PeerDatabase()
+        new = peer_db.add('10.0.0.1', 6881)
+        failed = peer_db.add('10.0.0.2', 6881)
+        failed.failures = 2
+        fast = peer_db.add('10.0.0.3', 6881)
+        fast.has_succeeded = True
+        fast.download_speed = 100 * 1024
+
+        self.assertEqual(peer_db.get_candidates(), [fast, new, failed])
+
+    def test_candidates_skip_excluded_and_backing_off(self):
+        peer_db = PeerDatabase()
+        peer_db.add('10.0.0.1', 6881)
+        backing_off = peer_db.add('10.0.0.2', 6881)
+        backing_off.next_attempt = time.monotonic() + 60
+        available = peer_db.add('10.0.0.3', 6881)
+
+        self.assertEqual(peer_db.get_candidates(exclude={('10.0.0.1', 6881)}), [available])
+        self.assertEqual(peer_db.get_next_attempt(), backing_off.next_attempt)
+
+    def test_banned_ip_forgotten_and_refused(self):
+        peer_db = PeerDatabase()
+        peer_db.add('10.0.0.1', 6881)
+        peer_db.add('10.0.0.1', 6882)
+        other = peer_db.add('10.0.0.2', 6881)
+        peer_db.ban('10.0.0.1')
+
+        self.assertEqual(list(peer_db), [other])
+        self.assertIsNone(peer_db.add('10.0.0.1', 6881, 'pex'))
+        self.assertTrue(peer_db.is_banned('10.0.0.1'))
+
+    def test_hash_failures_lower_score(self):
+        peer_db = PeerDatabase()
+        honest = peer_db.add('10.0.0.1', 6881)
+        corrupt = peer_db.add('10.0.0.2', 6881)
+        corrupt.hash_failures = 1
+        self.assertEqual(peer_db.get_candidates(), [honest, corrupt])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import unittest
+from unittest import TestCase
+import socket
+import asyncio
+
+from bitsnpieces.bencode import encoder, decoder
+from bitsnpieces.bitfield import Bitfield
+from bitsnpieces.peer import Extended
+from bitsnpieces.pex import PeerExchange, encode_peers, decode_peers
+from bitsnpieces.timer import TimerWheel
+
+
+class StubPeer(object):
+    def __init__(self, ip, port, inbound=False, extension_ids=None, seed=False):
+        self.ip = ip
+        self.listen_port = None if inbound else port
+        self.inbound = inbound
+        self.is_connected = True
+        self.extension_ids = extension_ids or {}
+        self.pieces_bitfield = Bitfield(8)
+        if seed:
+            for i in range(8):
+                self.pieces_bitfield[i] = True
+        self.pex_sent = set()
+        self.last_pex_received = None
+        self.sent = []
+
+    @property
+    def listen_address(self):
+        return None if self.listen_port is None else (self.ip, self.listen_port)
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def disconnect(self):
+        self.is_connected = False
+
+
+class StubClient(object):
+    def __init__(self, peers=()):
+        self.peers = {(p.ip, p.listen_port): p for p in peers}
+        self.timer_wheel = TimerWheel()
+        self.added = []
+
+    async def add_peers(self, peers, source="tracker"):
+        self.added.append((peers, source))
+
+
+class TestCompactPeers(TestCase):
+    def test_ipv4(self):
+        data = encode_peers([('10.0.0.1', 6881), ('192.168.1.2', 51413)])
+        self.assertEqual(len(data), 12)
+        self.assertEqual(decode_peers(data + b'\x01'), [('10.0.0.1', 6881), ('192.168.1.2', 51413)])
+
+    def test_ipv6(self):
+        data = encode_peers([('2001:db8::1', 6881)], socket.AF_INET6)
+        self.assertEqual(len(data), 18)
+        self.assertEqual(decode_peers(data, socket.AF_INET6), [('2001:db8::1', 6881)])
+
+
+class TestPeerExchange(TestCase):
+    def get_update(self, pex, peer):
+        """returns the next message for the peer and records it as sent, None if nothing changed"""
+
+        swarm = pex.get_swarm()
+        added, dropped = pex.get_changes(peer, swarm)
+        if not added and not dropped:
+            return None
+        peer.pex_sent.difference_update(dropped)
+        peer.pex_sent.update(added)
+        return pex.get_update(added, dropped, swarm)
+
+    def test_added_and_dropped_deltas(self):
+        target = StubPeer('10.0.0.1', 6881, extension_ids={b'ut_pex': 2})
+        others = [StubPeer('10.0.0.2', 6882, seed=True), StubPeer('10.0.0.3', 6883, inbound=True),
+            StubPeer('2001:db8::4', 6884)]
+        client = StubClient([target] + others)
+        pex = PeerExchange(client)
+
+        # the inbound peer's listen port is unknown, the target is not told about itself
+        message = self.get_update(pex, target)
+        self.assertEqual(decode_peers(message[b'added']), [('10.0.0.2', 6882)])
+        self.assertEqual(message[b'added.f'], bytes([PeerExchange.FLAG_REACHABLE | PeerExchange.FLAG_SEED]))
+        self.assertEqual(decode_peers(message[b'added6'], socket.AF_INET6), [('2001:db8::4', 6884)])
+        self.assertNotIn(b'dropped', message)
+
+        # nothing changed
+        self.assertIsNone(self.get_update(pex, target))
+
+        # a dropped peer and a newly known one
+        del client.peers[('10.0.0.2', 6882)]
+        others[1].listen_port = 6890
+        message = self.get_update(pex, target)
+        self.assertEqual(decode_peers(message[b'added']), [('10.0.0.3', 6890)])
+        self.assertEqual(message[b'added.f'], bytes([0]))
+        self.assertEqual(decode_peers(message[b'dropped']), [('10.0.0.2', 6882)])
+        self.assertEqual(target.pex_sent, {('10.0.0.3', 6890), ('2001:db8::4', 6884)})
+
+    def test_added_bounded(self):
+        target = StubPeer('10.0.0.1', 6881, extension_ids={b'ut_pex': 2})
+        others = [StubPeer(f'10.0.1.{i}', 6881) for i in range(PeerExchange.MAX_ADDED + 10)]
+        pex = PeerExchange(StubClient([target] + others))
+
+        message = self.get_update(pex, target)
+        self.assertEqual(len(decode_peers(message[b'added'])), PeerExchange.MAX_ADDED)
+        message = self.get_update(pex, target)
+        self.assertEqual(len(decode_peers(message[b'added'])), 10)
+
+    def test_send_updates(self):
+        async def async_test(self):
+            supporting = StubPeer('10.0.0.1', 6881, extension_ids={b'ut_pex': 2})
+            other = StubPeer('10.0.0.2', 6882)
+            client = StubClient([supporting, other])
+            pex = PeerExchange(client)
+
+            await pex.send_updates()
+            self.assertEqual(other.sent, [])
+            self.assertEqual(len(supporting.sent), 1)
+            message = supporting.sent[0]
+            self.assertIsInstance(message, Extended)
+            self.assertEqual(message.extended_id, 2)
+            self.assertEqual(decode_peers(decoder.decode(message.payload)[b'added']), [('10.0.0.2', 6882)])
+
+            # the next round is scheduled, and sends nothing if nothing changed
+            self.assertIsNotNone(pex.timer)
+            await pex.send_updates()
+            self.assertEqual(len(supporting.sent), 1)
+            pex.stop()
+            self.assertEqual(len(client.timer_wheel), 0)
+        asyncio.run(async_test(self))
+
+    def test_unsent_update_not_recorded(self):
+        async def async_test(self):
+            target = StubPeer('10.0.0.1', 6881, extension_ids={b'ut_pex': 2})
+            named = StubPeer('peer.example.com', 6882)
+            other = StubPeer('10.0.0.3', 6883)
+            pex = PeerExchange(StubClient([target, named, other]))
+
+            # peers known by host name are not exchanged
+            self.assertEqual(set(pex.get_swarm()), {('10.0.0.1', 6881), ('10.0.0.3', 6883)})
+
+            # peers a message failed to reach are told again in the next round
+            async def fail(message):
+                raise ConnectionResetError()
+            target.send = fail
+            await pex.send_updates()
+            self.assertEqual(target.pex_sent, set())
+            target.is_connected = True
+            del target.send
+            await pex.send_updates()
+            self.assertEqual(target.pex_sent, {('10.0.0.3', 6883)})
+            pex.stop()
+        asyncio.run(async_test(self))
+
+    def test_handle_message(self):
+        async def async_test(self):
+            sender = StubPeer('10.0.0.1', 6881)
+            client = StubClient([sender])
+            pex = PeerExchange(client)
+
+            payload = encoder.encode({b'added': encode_peers([('10.0.0.5', 6881), ('10.0.0.6', 0)]),
+                b'added.f': bytes([0x10, 0]), b'added6': encode_peers([('2001:db8::7', 6881)], socket.AF_INET6),
+                b'dropped': encode_peers([('10.0.0.8', 6881)])})
+            await pex.handle_message(sender, payload)
+            self.assertEqual(client.added, [([('10.0.0.5', 6881), ('2001:db8::7', 6881)], "pex")])
+
+            # a peer that sends too often is ignored
+            await pex.handle_message(sender, payload)
+            self.assertEqual(len(client.added), 1)
+
+            # malformed messages are ignored
+            sender.last_pex_received = None
+            await pex.handle_message(sender, b'garbage')
+            self.assertEqual(len(client.added), 1)
+        asyncio.run(async_test(self))
+
+
+if __name__ == '__main__':
+    unittest.main()
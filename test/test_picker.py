@@ -0,0 +1,81 @@
+import unittest
+from unittest import TestCase
+
+from bitsnpieces.picker import PiecePicker
+from bitsnpieces.bitfield import Bitfield
+
+
+def bitfield(num_pieces, pieces):
+    result = Bitfield(num_pieces)
+    for index in pieces:
+        result[index] = True
+    return result
+
+
+class TestPiecePicker(TestCase):
+    def test_rarest_first(self):
+        picker = PiecePicker(6, random_first_pieces=0)
+        picker.add_peer(bitfield(6, {0, 1, 2, 3}))
+        picker.add_peer(bitfield(6, {0, 1, 2}))
+        picker.add_peer(bitfield(6, {0, 1}))
+
+        candidates = list(picker.iter_candidates(bitfield(6, {0, 1, 2, 3})))
+        self.assertEqual(candidates[0], 3)
+        self.assertEqual(candidates[1], 2)
+        self.assertEqual(set(candidates[2:]), {0, 1})
+
+    def test_only_pieces_the_peer_has(self):
+        picker = PiecePicker(6, random_first_pieces=0)
+        picker.add_peer(bitfield(6, {0, 1, 2, 3, 4, 5}))
+        self.assertEqual(list(picker.iter_candidates(bitfield(6, {4}))), [4])
+
+    def test_have_and_disconnect_update_availability(self):
+        picker = PiecePicker(4, random_first_pieces=0)
+        seed = bitfield(4, {0, 1, 2, 3})
+        picker.add_peer(seed)
+        picker.add_piece_holder(2)
+        picker.add_piece_holder(2)
+        self.assertEqual(list(picker.availability), [1, 1, 3, 1])
+        self.assertEqual(list(picker.iter_candidates(bitfield(4, {2, 3}))), [3, 2])
+
+        picker.remove_peer(seed)
+        self.assertEqual(list(picker.availability), [0, 0, 2, 0])
+        self.assertEqual(list(picker.iter_candidates(seed)), [2])
+
+    def test_complete_pieces_not_picked(self):
+        picker = PiecePicker(3, random_first_pieces=0)
+        picker.add_peer(bitfield(3, {0, 1, 2}))
+        picker.piece_complete(1)
+        self.assertEqual(set(picker.iter_candidates(bitfield(3, {0, 1, 2}))), {0, 2})
+
+        picker.piece_failed(1)
+        self.assertEqual(set(picker.iter_candidates(bitfield(3, {0, 1, 2}))), {0, 1, 2})
+
+    def test_random_first_pieces(self):
+        picker = PiecePicker(1000, random_first_pieces=1)
+        picker.add_peer(bitfield(1000, range(1000)))
+        picker.add_piece_holder(999)
+
+        # rarest first would always start with the lowest index of the rarest bucket
+        first_picks = {next(picker.iter_candidates(bitfield(1000, range(1000)))) for _ in range(20)}
+        self.assertGreater(len(first_picks), 1)
+
+        picker.piece_complete(500)
+        self.assertEqual(next(picker.iter_candidates(bitfield(1000, range(1000)))), 0)
+
+    def test_priorities(self):
+        picker = PiecePicker(4, random_first_pieces=0)
+        picker.add_peer(bitfield(4, {0, 1, 2, 3}))
+        picker.add_piece_holder(3)
+        picker.set_priority(0, PiecePicker.PRIORITY_SKIP)
+        picker.set_priority(3, PiecePicker.PRIORITY_HIGH)
+        picker.set_priority(1, PiecePicker.PRIORITY_LOW)
+
+        # the more available high priority piece comes before the rare low priority one
+        self.assertEqual(list(picker.iter_candidates(bitfield(4, {0, 1, 2, 3}))), [3, 2, 1])
+
+        picker.set_priority(0, PiecePicker.PRIORITY_NORMAL)
+        self.assertEqual(set(picker.iter_candidates(bitfield(4, {0, 1, 2, 3}))), {0, 1, 2, 3})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+from unittest import TestCase
+import asyncio
+
+from bitsnpieces import peer
+from bitsnpieces.server import PeerServer
+from bitsnpieces.utils import generate_peer_id
+
+
+class StubClient(object):
+    def __init__(self, info_hash, max_peers=10):
+        self.info_hash = info_hash
+        self.max_peers = max_peers
+        self.peers = []
+        self.accepted = asyncio.Event()
+
+    async def accept_peer(self, reader, writer, handshake, buffer, ip, port):
+        if len(self.peers) >= self.max_peers:
+            return False
+        self.peers.append((handshake.peer_id, buffer))
+        self.accepted.set()
+        writer.close()
+        return True
+
+
+class TestPeerServer(TestCase):
+    def test_routes_by_info_hash(self):
+        async def async_test(self):
+            server = PeerServer(host='127.0.0.1', port=0)
+            client_a = StubClient(b'a' * 20)
+            client_b = StubClient(b'b' * 20)
+            server.add_torrent(client_a)
+            server.add_torrent(client_b)
+            await server.start()
+
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            peer_id = generate_peer_id()
+            writer.write(peer.Handshake(b'b' * 20, peer_id).encode() + peer.Interested().encode())
+            await asyncio.wait_for(client_b.accepted.wait(), 5)
+
+            self.assertEqual(client_a.peers, [])
+            self.assertEqual(client_b.peers, [(peer_id, peer.Interested().encode())])
+
+            writer.close()
+            await server.close()
+        asyncio.run(async_test(self))
+
+    def test_unknown_info_hash_closed(self):
+        async def async_test(self):
+            server = PeerServer(host='127.0.0.1', port=0)
+            server.add_torrent(StubClient(b'a' * 20))
+            await server.start()
+
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(peer.Handshake(b'c' * 20, generate_peer_id()).encode())
+            data = await asyncio.wait_for(reader.read(), 5)
+            self.assertEqual(data, b'')
+
+            writer.close()
+            await server.close()
+        asyncio.run(async_test(self))
+
+    def test_torrent_connection_limit(self):
+        async def async_test(self):
+            server = PeerServer(host='127.0.0.1', port=0)
+            client = StubClient(b'a' * 20, max_peers=0)
+            server.add_torrent(client)
+            await server.start()
+
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(peer.Handshake(b'a' * 20, generate_peer_id()).encode())
+            data = await asyncio.wait_for(reader.read(), 5)
+            self.assertEqual(data, b'')
+            self.assertEqual(client.peers, [])
+
+            writer.close()
+            await server.close()
+        asyncio.run(async_test(self))
+
+    def test_half_open_limit(self):
+        async def async_test(self):
+            server = PeerServer(host='127.0.0.1', port=0, max_half_open=1)
+            server.add_torrent(StubClient(b'a' * 20))
+            await server.start()
+
+            # the first connection never completes its handshake
+            _, silent_writer = await asyncio.open_connection('127.0.0.1', server.port)
+            await asyncio.sleep(0.1)
+            self.assertEqual(server.num_half_open, 1)
+
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            data = await asyncio.wait_for(reader.read(), 5)
+            self.assertEqual(data, b'')
+
+            silent_writer.close()
+            writer.close()
+            await server.close()
+        asyncio.run(async_test(self))
+
+if __name__ == '__main__':
+    unittest.main()
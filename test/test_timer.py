@@ -0,0 +1,67 @@
+import unittest
+from unittest import TestCase
+import asyncio
+
+from bitsnpieces.timer import TimerWheel
+
+
+class TestTimerWheel(TestCase):
+    def test_fires_after_delay(self):
+        wheel = TimerWheel(tick=1, num_slots=8)
+        fired = []
+        wheel.schedule(3, lambda: fired.append('a'))
+
+        wheel.advance()
+        wheel.advance()
+        self.assertEqual(fired, [])
+        wheel.advance()
+        self.assertEqual(fired, ['a'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_delay_longer_than_wheel(self):
+        wheel = TimerWheel(tick=1, num_slots=4)
+        fired = []
+        wheel.schedule(10, lambda: fired.append('a'))
+
+        for _ in range(9):
+            wheel.advance()
+        self.assertEqual(fired, [])
+        wheel.advance()
+        self.assertEqual(fired, ['a'])
+
+    def test_delay_rounded_up_to_tick(self):
+        wheel = TimerWheel(tick=0.5, num_slots=8)
+        fired = []
+        wheel.schedule(0.7, lambda: fired.append('a'))
+
+        wheel.advance()
+        self.assertEqual(fired, [])
+        wheel.advance()
+        self.assertEqual(fired, ['a'])
+
+    def test_cancel(self):
+        wheel = TimerWheel(tick=1, num_slots=8)
+        fired = []
+        timer = wheel.schedule(1, lambda: fired.append('a'))
+        wheel.cancel(timer)
+
+        wheel.advance()
+        self.assertEqual(fired, [])
+        self.assertEqual(len(wheel), 0)
+
+    def test_coroutine_callback(self):
+        async def async_test(self):
+            wheel = TimerWheel(tick=0.01, num_slots=8)
+            fired = asyncio.Event()
+
+            async def callback():
+                fired.set()
+
+            wheel.schedule(0.01, callback)
+            wheel.start()
+            await asyncio.wait_for(fired.wait(), 1)
+            await wheel.stop()
+        asyncio.run(async_test(self))
+
+if __name__ == '__main__':
+    unittest.main()
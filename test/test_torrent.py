@@ -1,7 +1,10 @@
 import unittest
 from unittest import TestCase
+import base64
+import hashlib
 
 from bitsnpieces import torrent
+from bitsnpieces.torrent import TorrentError
 
 class TestTorrentFile(TestCase):
     def test_torrent_load_ubuntu(self):
@@ -17,5 +20,51 @@ class TestTorrentFile(TestCase):
         self.assertEqual(len(torfile.info.files), 1)
         self.assertEqual(torfile.info.files[0].path, "ubuntu-20.04.1-desktop-amd64.iso")
 
+    def test_info_hash_cached(self):
+        torfile = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+        info_hash = torfile.info.get_sha1()
+        self.assertEqual(info_hash, hashlib.sha1(torfile.info.encode()).digest())
+        self.assertIs(torfile.info.get_sha1(), info_hash)
+
+
+class TestMagnet(TestCase):
+    info_hash = bytes(range(20))
+
+    def test_parse_hex(self):
+        magnet = torrent.parse_magnet(f"magnet:?xt=urn:btih:{self.info_hash.hex().upper()}&dn=some+file"
+            "&tr=http%3A%2F%2Ftracker.test%2Fannounce&tr=udp%3A%2F%2Ftracker.test%3A6969"
+            "&tr=http%3A%2F%2Ftracker.test%2Fannounce&x.pe=10.0.0.1:6881&x.pe=[::1]:6882&x.pe=bad")
+        self.assertEqual(magnet.info_hash, self.info_hash)
+        self.assertEqual(magnet.name, "some file")
+        self.assertEqual(magnet.trackers, ["http://tracker.test/announce", "udp://tracker.test:6969"])
+        self.assertEqual(magnet.peers, [("10.0.0.1", 6881), ("::1", 6882)])
+
+    def test_parse_base32(self):
+        encoded = base64.b32encode(self.info_hash).decode().lower()
+        self.assertEqual(torrent.parse_magnet(f"magnet:?xt=urn:btih:{encoded}").info_hash, self.info_hash)
+
+    def test_parse_invalid(self):
+        for uri in ("http://example.com/?xt=urn:btih:" + self.info_hash.hex(), "magnet:?dn=name",
+                "magnet:?xt=urn:btih:1234", "magnet:?xt=urn:sha1:" + self.info_hash.hex()):
+            with self.assertRaises(TorrentError):
+                torrent.parse_magnet(uri)
+
+    def test_to_torrent(self):
+        torfile = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+        info = torfile.info.encode()
+        magnet = torrent.Magnet(torfile.info.get_sha1(), trackers=["http://tracker.test/announce"])
+
+        # without metadata the torrent is only good for finding peers
+        empty = magnet.to_torrent()
+        self.assertEqual(empty.info.get_sha1(), magnet.info_hash)
+        self.assertEqual(empty.announce_list, [["http://tracker.test/announce"]])
+        self.assertEqual(empty.info.files, [])
+
+        built = magnet.to_torrent(info)
+        self.assertEqual(built.info.get_sha1(), torfile.info.get_sha1())
+        self.assertEqual(built.info.piece_length, 262144)
+        self.assertEqual(built.info.files[0].path, "ubuntu-20.04.1-desktop-amd64.iso")
+        self.assertEqual(built.announce, "http://tracker.test/announce")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,10 +1,15 @@
 import unittest
 from unittest import TestCase
 import asyncio
+import struct
+from urllib.parse import unquote_to_bytes
+from aiohttp import web
 
 from bitsnpieces.utils import generate_peer_id
 from bitsnpieces import torrent
-from bitsnpieces.tracker import Tracker
+from bitsnpieces.bencode import decoder, encoder
+from bitsnpieces.tracker import (Tracker, UDPTracker, TrackerList, HTTPTrackerSession, TrackerResponse,
+    create_tracker, scrape)
 
 
 class TestTracker(TestCase):
@@ -21,4 +26,452 @@ class TestTracker(TestCase):
             await tracker.close()   # close the tracker client session
 
             self.assertEqual(tracker_response.failed, False)
-        asyncio.run(async_test(self))
\ No newline at end of file
+        asyncio.run(async_test(self))
+
+
+class TestTrackerResponse(TestCase):
+    def test_compact_peers(self):
+        response = TrackerResponse(encoder.encode({b'interval': 1800,
+            b'peers': bytes([10, 0, 0, 1, 0x1a, 0xe1, 192, 168, 1, 255, 0xff, 0xff, 1, 2, 3])}))
+        # the truncated last peer is ignored
+        self.assertEqual(response.peers, [('10.0.0.1', 6881), ('192.168.1.255', 65535)])
+
+    def test_compact_peers6(self):
+        response = TrackerResponse(encoder.encode({b'interval': 1800, b'peers': bytes([10, 0, 0, 1, 0x1a, 0xe1]),
+            b'peers6': bytes([0x20, 0x01, 0x0d, 0xb8] + [0] * 11 + [1, 0x1a, 0xe2])}))
+        self.assertEqual(response.peers, [('10.0.0.1', 6881), ('2001:db8::1', 6882)])
+
+    def test_dict_peers(self):
+        response = TrackerResponse(encoder.encode({b'interval': 1800, b'peers': [
+            {b'peer id': b'a' * 20, b'ip': b'10.0.0.1', b'port': 6881},
+            {b'ip': b'tracker.example.com', b'port': 6882},
+            {b'ip': b'10.0.0.3'}]}))
+        self.assertEqual(response.peers, [('10.0.0.1', 6881), ('tracker.example.com', 6882)])
+
+    def test_no_peers(self):
+        response = TrackerResponse(encoder.encode({b'interval': 1800}))
+        self.assertEqual(response.peers, [])
+
+        response = TrackerResponse(encoder.encode({b'failure reason': b'unregistered torrent'}))
+        self.assertTrue(response.failed)
+        self.assertIsNone(response.peers)
+
+
+class StubUDPTracker(asyncio.DatagramProtocol):
+    """answers BEP 15 requests, ignoring the first few or the given datagram numbers"""
+
+    CONNECTION_ID = 0x1234
+
+    def __init__(self, peers=b"", num_dropped=0, error=None, truncated=False, dropped=()):
+        self.peers = peers
+        self.num_dropped = num_dropped
+        self.dropped = set(dropped)
+        self.error = error
+        self.truncated = truncated
+        self.actions = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection_id, action, transaction_id = struct.unpack_from('>QII', data)
+        self.actions.append(action)
+        if self.num_dropped > 0:
+            self.num_dropped -= 1
+            return
+        if len(self.actions) - 1 in self.dropped:
+            return
+
+        if action == UDPTracker.ACTION_CONNECT and connection_id == UDPTracker.PROTOCOL_ID:
+            response = struct.pack('>IIQ', action, transaction_id, StubUDPTracker.CONNECTION_ID)
+        elif connection_id != StubUDPTracker.CONNECTION_ID or self.error is not None:
+            response = struct.pack('>II', UDPTracker.ACTION_ERROR, transaction_id) + (self.error or b"bad connection ID")
+        elif action == UDPTracker.ACTION_ANNOUNCE:
+            response = struct.pack('>IIIII', action, transaction_id, 1800, 2, 3) + self.peers
+            if self.truncated:
+                response = response[:12]
+        elif action == UDPTracker.ACTION_SCRAPE:
+            num_hashes = (len(data) - 16) // 20
+            response = struct.pack('>II', action, transaction_id) + b"".join(
+                struct.pack('>III', 10 + i, 20 + i, 30 + i) for i in range(num_hashes))
+        self.transport.sendto(response, addr)
+
+
+class TestUDPTracker(TestCase):
+    def setUp(self):
+        self.torrent = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+
+    async def start_tracker(self, stub, **kwargs):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: stub, local_addr=('127.0.0.1', 0))
+        port = transport.get_extra_info('sockname')[1]
+        tracker = UDPTracker(self.torrent, url=f"udp://127.0.0.1:{port}/announce", **kwargs)
+        return transport, tracker
+
+    def test_announce(self):
+        async def async_test(self):
+            stub = StubUDPTracker(peers=bytes([10, 0, 0, 1, 0x1a, 0xe1, 10, 0, 0, 2, 0x1a, 0xe2]))
+            transport, tracker = await self.start_tracker(stub)
+            response = await tracker.announce(generate_peer_id(), 6889, 0, 0, "started")
+            await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            await tracker.close()
+            transport.close()
+
+            self.assertFalse(response.failed)
+            self.assertEqual(response.interval, 1800)
+            self.assertEqual((response.complete, response.incomplete), (3, 2))
+            self.assertEqual(response.peers, [('10.0.0.1', 6881), ('10.0.0.2', 6882)])
+
+            # the connection ID is reused
+            self.assertEqual(stub.actions, [UDPTracker.ACTION_CONNECT, UDPTracker.ACTION_ANNOUNCE,
+                UDPTracker.ACTION_ANNOUNCE])
+        asyncio.run(async_test(self))
+
+    def test_lost_requests_retransmitted(self):
+        async def async_test(self):
+            stub = StubUDPTracker(num_dropped=2)
+            transport, tracker = await self.start_tracker(stub, timeout=0.05)
+            response = await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            await tracker.close()
+            transport.close()
+
+            self.assertEqual(response.interval, 1800)
+            self.assertEqual(stub.actions[:3], [UDPTracker.ACTION_CONNECT] * 3)
+        asyncio.run(async_test(self))
+
+    def test_lost_announce_keeps_connection_id(self):
+        async def async_test(self):
+            stub = StubUDPTracker()
+            transport, tracker = await self.start_tracker(stub, timeout=0.05)
+            await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            stub.num_dropped = 1
+            response = await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            await tracker.close()
+            transport.close()
+
+            self.assertEqual(response.interval, 1800)
+            self.assertEqual(stub.actions, [UDPTracker.ACTION_CONNECT] + [UDPTracker.ACTION_ANNOUNCE] * 3)
+        asyncio.run(async_test(self))
+
+    def test_retransmissions_shared_with_connect(self):
+        async def async_test(self):
+            # the first connect is lost, so the announce only has the two tries left
+            stub = StubUDPTracker(dropped={0, 2, 3})
+            transport, tracker = await self.start_tracker(stub, timeout=0.01, max_retransmissions=2)
+            with self.assertRaises(ConnectionError):
+                await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            await tracker.close()
+            transport.close()
+
+            self.assertEqual(stub.actions, [UDPTracker.ACTION_CONNECT] * 2 + [UDPTracker.ACTION_ANNOUNCE] * 2)
+        asyncio.run(async_test(self))
+
+    def test_invalid_announce_fails(self):
+        async def async_test(self):
+            stub = StubUDPTracker(truncated=True)
+            transport, tracker = await self.start_tracker(stub, raise_on_failure=False)
+            response = await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            self.assertTrue(response.failed)
+            self.assertIn("short", response.failure_reason)
+
+            response = await tracker.announce(generate_peer_id(), 6889, 0, 0, "paused")
+            self.assertTrue(response.failed)
+            self.assertIn("paused", response.failure_reason)
+            await tracker.close()
+            transport.close()
+        asyncio.run(async_test(self))
+
+    def test_announce_values_packed(self):
+        async def async_test(self):
+            stub = StubUDPTracker()
+            transport, tracker = await self.start_tracker(stub, raise_on_failure=False)
+
+            # bytes downloaded again after hash failures do not make what is left negative
+            response = await tracker.announce(generate_peer_id(), 6889, 0, tracker.torrent.total_size + 1)
+            self.assertFalse(response.failed)
+
+            response = await tracker.announce(generate_peer_id(), 6889, 0, 0, numwant=2 ** 40)
+            self.assertTrue(response.failed)
+            await tracker.close()
+            transport.close()
+        asyncio.run(async_test(self))
+
+    def test_no_response(self):
+        async def async_test(self):
+            stub = StubUDPTracker(num_dropped=100)
+            transport, tracker = await self.start_tracker(stub, timeout=0.01, max_retransmissions=2)
+            with self.assertRaises(ConnectionError):
+                await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            await tracker.close()
+            transport.close()
+
+            self.assertEqual(len(stub.actions), 3)
+        asyncio.run(async_test(self))
+
+    def test_error_response(self):
+        async def async_test(self):
+            stub = StubUDPTracker(error=b"torrent not registered")
+            transport, tracker = await self.start_tracker(stub, raise_on_failure=False)
+            response = await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            await tracker.close()
+            transport.close()
+
+            self.assertTrue(response.failed)
+            self.assertIn("torrent not registered", response.failure_reason)
+        asyncio.run(async_test(self))
+
+    def test_scrape(self):
+        async def async_test(self):
+            stub = StubUDPTracker()
+            transport, tracker = await self.start_tracker(stub)
+            info_hashes = [bytes([i]) * 20 for i in range(100)]
+            stats = await tracker.scrape(info_hashes)
+            await tracker.close()
+            transport.close()
+
+            self.assertEqual(stats[info_hashes[0]], {'complete': 10, 'downloaded': 20, 'incomplete': 30})
+            self.assertEqual(len(stats), 100)
+            # split in two requests after connecting
+            self.assertEqual(stub.actions, [UDPTracker.ACTION_CONNECT] + [UDPTracker.ACTION_SCRAPE] * 2)
+        asyncio.run(async_test(self))
+
+    def test_tracker_chosen_by_scheme(self):
+        self.assertIsInstance(create_tracker(self.torrent, "udp://tracker.example.com:80"), UDPTracker)
+
+
+class StubHTTPTracker(object):
+    """answers HTTP announces, recording the query and the client connection of each"""
+    def __init__(self, max_scrape_hashes=None, scrape_status=None):
+        self.queries = []
+        self.connections = []
+        self.runner = None
+        self.max_scrape_hashes = max_scrape_hashes
+        self.scrape_status = scrape_status
+        self.scrapes = []
+
+    async def handle_announce(self, request):
+        self.queries.append(request.query)
+        self.connections.append(request.transport.get_extra_info('peername'))
+        response = {b'interval': 1800, b'tracker id': b'abc', b'peers': bytes([10, 0, 0, 1, 0x1a, 0xe1])}
+        return web.Response(body=encoder.encode(response))
+
+    async def handle_scrape(self, request):
+        info_hashes = [unquote_to_bytes(value) for name, value in
+            (param.split('=', 1) for param in request.rel_url.raw_query_string.split('&')) if name == 'info_hash']
+        self.scrapes.append(info_hashes)
+        if self.scrape_status is not None:
+            return web.Response(status=self.scrape_status)
+        if self.max_scrape_hashes is not None and len(info_hashes) > self.max_scrape_hashes:
+            return web.Response(status=414)
+        files = {info_hash: {b'complete': 5, b'downloaded': 20, b'incomplete': info_hash[0]}
+            for info_hash in info_hashes if info_hash[0] % 2 == 0}
+        return web.Response(body=encoder.encode({b'files': files}))
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get('/announce', self.handle_announce)
+        app.router.add_get('/scrape', self.handle_scrape)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/announce"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class TestHTTPTrackerSession(TestCase):
+    def test_shared_session(self):
+        async def async_test(self):
+            stub = StubHTTPTracker()
+            url = await stub.start()
+            torfile = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+
+            # trackers of two torrents share one session and its connections
+            http_session = HTTPTrackerSession()
+            trackers = [Tracker(torfile, url=url, http_session=http_session) for _ in range(2)]
+            for tracker in trackers:
+                response = await tracker.announce(generate_peer_id(), 6889, 0, 0, "started")
+                self.assertEqual(response.peers, [('10.0.0.1', 6881)])
+                await tracker.close()
+            self.assertEqual(len(stub.connections), 2)
+            self.assertEqual(stub.connections[0], stub.connections[1])
+
+            # closing the trackers left the shared session open
+            self.assertFalse(http_session.session.closed)
+            await http_session.close()
+            await stub.stop()
+        asyncio.run(async_test(self))
+
+    def test_tracker_id(self):
+        async def async_test(self):
+            stub = StubHTTPTracker()
+            url = await stub.start()
+            tracker = Tracker(torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent"), url=url)
+            await tracker.announce(generate_peer_id(), 6889, 0, 0, "started", numwant=20)
+            await tracker.announce(generate_peer_id(), 6889, 0, 0)
+            await tracker.close()
+            await stub.stop()
+
+            self.assertNotIn('trackerid', stub.queries[0])
+            self.assertEqual(stub.queries[0]['numwant'], '20')
+            self.assertEqual(stub.queries[1]['trackerid'], 'abc')
+            self.assertTrue(tracker.http_session.session is None)
+        asyncio.run(async_test(self))
+
+
+class TestScrape(TestCase):
+    def test_scrape_url(self):
+        torfile = torrent.load("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent")
+        def scrape_url(url):
+            return Tracker(torfile, url=url).scrape_url
+        self.assertEqual(scrape_url("http://example.com/announce"), "http://example.com/scrape")
+        self.assertEqual(scrape_url("http://example.com/x/announce.php"), "http://example.com/x/scrape.php")
+        self.assertEqual(scrape_url("http://example.com/announce?key=1"), "http://example.com/scrape?key=1")
+        self.assertIsNone(scrape_url("http://example.com/a"))
+        self.assertIsNone(scrape_url("http://example.com/announce/x"))
+        self.assertIsNone(scrape_url("http://announce.example.com"))
+
+    def test_batched_http_scrape(self):
+        async def async_test(self):
+            stub = StubHTTPTracker(max_scrape_hashes=40)
+            url = await stub.start()
+            info_hashes = [bytes([i]) + bytes(range(100, 119)) for i in range(100)]
+            tracker = Tracker(None, url=url)
+            stats = await tracker.scrape(info_hashes)
+            await tracker.close()
+            await stub.stop()
+
+            # info hashes the tracker does not know are left out
+            self.assertEqual(sorted(stats), info_hashes[::2])
+            self.assertEqual(stats[info_hashes[10]], {'complete': 5, 'downloaded': 20, 'incomplete': 10})
+
+            # the first request was refused, then batches small enough for the tracker are sent
+            self.assertEqual([len(info_hashes) for info_hashes in stub.scrapes], [64, 32, 32, 32, 4])
+            self.assertEqual(tracker.max_scrape_hashes, 32)
+        asyncio.run(async_test(self))
+
+    def test_failed_http_scrape_not_batched(self):
+        async def async_test(self):
+            stub = StubHTTPTracker(scrape_status=503)
+            url = await stub.start()
+            info_hashes = [bytes([i]) * 20 for i in range(100)]
+            tracker = Tracker(None, url=url)
+            with self.assertRaises(ConnectionError):
+                await tracker.scrape(info_hashes)
+            await tracker.close()
+            await stub.stop()
+
+            # a tracker that is down is not asked again in smaller batches
+            self.assertEqual([len(info_hashes) for info_hashes in stub.scrapes], [64])
+            self.assertEqual(tracker.max_scrape_hashes, Tracker.MAX_SCRAPE_HASHES)
+        asyncio.run(async_test(self))
+
+    def test_scrape_many_trackers(self):
+        async def async_test(self):
+            http_stub = StubHTTPTracker()
+            http_url = await http_stub.start()
+            udp_stub = StubUDPTracker()
+            loop = asyncio.get_running_loop()
+            transport, _ = await loop.create_datagram_endpoint(lambda: udp_stub, local_addr=('127.0.0.1', 0))
+            udp_url = f"udp://127.0.0.1:{transport.get_extra_info('sockname')[1]}/announce"
+
+            info_hashes = [bytes([i]) * 20 for i in range(4)]
+            stats = await scrape({http_url: info_hashes[:2], udp_url: info_hashes,
+                "http://127.0.0.1:1/a": info_hashes})
+            await http_stub.stop()
+            transport.close()
+
+            self.assertEqual(sorted(stats), sorted([http_url, udp_url]))
+            self.assertEqual(list(stats[http_url]), [info_hashes[0]])
+            self.assertEqual(sorted(stats[udp_url]), info_hashes)
+        asyncio.run(async_test(self))
+
+
+class TestTrackerList(TestCase):
+    async def start_trackers(self, stubs):
+        loop = asyncio.get_running_loop()
+        transports, urls = [], []
+        for stub in stubs:
+            transport, _ = await loop.create_datagram_endpoint(lambda: stub, local_addr=('127.0.0.1', 0))
+            transports.append(transport)
+            urls.append(f"udp://127.0.0.1:{transport.get_extra_info('sockname')[1]}/announce")
+        return transports, urls
+
+    def make_tracker_list(self, tiers):
+        with open("test/data/ubuntu-20.04.1-desktop-amd64.iso.torrent", 'rb') as f:
+            meta_info = decoder.decode(f.read())
+        meta_info[b'announce'] = tiers[0][0].encode()
+        meta_info[b'announce-list'] = [[url.encode() for url in tier] for tier in tiers]
+        tracker_list = TrackerList(torrent.Torrent(meta_info), timeout=0.2)
+        for tier in tracker_list.tiers:
+            for tracker in tier:
+                tracker.timeout = 0.05
+                tracker.max_retransmissions = 0
+        return tracker_list
+
+    def test_dead_tracker_in_tier(self):
+        async def async_test(self):
+            dead, alive = StubUDPTracker(num_dropped=100), StubUDPTracker(peers=bytes([10, 0, 0, 1, 0x1a, 0xe1]))
+            transports, urls = await self.start_trackers([dead, alive])
+            tracker_list = self.make_tracker_list([urls])
+
+            received = []
+            async def on_response(response):
+                received.append(response)
+
+            response = await tracker_list.announce(generate_peer_id(), 6889, 0, 0, "started", on_response)
+            self.assertEqual(response.peers, [('10.0.0.1', 6881)])
+            self.assertEqual(len(received), 1)
+
+            # the tracker that answered is tried first from now on
+            self.assertEqual(tracker_list.tiers[0][0].url, urls[1])
+            self.assertEqual(tracker_list.url, urls[1])
+
+            await tracker_list.close()
+            for transport in transports:
+                transport.close()
+        asyncio.run(async_test(self))
+
+    def test_fail_over_to_next_tier(self):
+        async def async_test(self):
+            dead, alive = StubUDPTracker(num_dropped=100), StubUDPTracker(peers=bytes([10, 0, 0, 2, 0x1a, 0xe1]))
+            transports, urls = await self.start_trackers([dead, alive])
+            tracker_list = self.make_tracker_list([[urls[0]], [urls[1]]])
+
+            response = await tracker_list.announce(generate_peer_id(), 6889, 0, 0)
+            self.assertEqual(response.peers, [('10.0.0.2', 6881)])
+
+            await tracker_list.close()
+            for transport in transports:
+                transport.close()
+        asyncio.run(async_test(self))
+
+    def test_peers_merged(self):
+        async def async_test(self):
+            first = StubUDPTracker(peers=bytes([10, 0, 0, 1, 0x1a, 0xe1, 10, 0, 0, 2, 0x1a, 0xe1]))
+            second = StubUDPTracker(peers=bytes([10, 0, 0, 2, 0x1a, 0xe1, 10, 0, 0, 3, 0x1a, 0xe1]))
+            transports, urls = await self.start_trackers([first, second])
+            tracker_list = self.make_tracker_list([urls])
+
+            response = await tracker_list.announce(generate_peer_id(), 6889, 0, 0)
+            self.assertEqual(sorted(ip for ip, port in response.peers), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+            self.assertEqual(response.interval, 1800)
+
+            await tracker_list.close()
+            for transport in transports:
+                transport.close()
+        asyncio.run(async_test(self))
+
+    def test_no_tracker_answers(self):
+        async def async_test(self):
+            transports, urls = await self.start_trackers([StubUDPTracker(num_dropped=100)])
+            tracker_list = self.make_tracker_list([urls])
+            with self.assertRaises(ConnectionError):
+                await tracker_list.announce(generate_peer_id(), 6889, 0, 0)
+
+            await tracker_list.close()
+            for transport in transports:
+                transport.close()
+        asyncio.run(async_test(self))